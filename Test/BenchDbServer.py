@@ -0,0 +1,147 @@
+"""
+数据库连接压测: 对比每次操作都 openDb/closeDb 的写法、每个线程保持长连接的写法, 以及聊天记录批量写入
+
+在项目根目录执行:
+    python Test/BenchDbServer.py --rounds 5000 --threads 4 --output logs/bench_db_server.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import servers.db_server as db_server
+from servers.db_server import DbInitServer, DbUserServer, DbRoomServer, DbMsgServer, openDb, closeDb
+from utils.common import logger
+
+def legacySearchWhiteRoom(roomId):
+    """
+    原来的写法: 每次查询都打开/关闭数据库文件
+    """
+    conn, cursor = openDb(db_server.roomDb)
+    try:
+        cursor.execute('SELECT roomId FROM whiteRoom WHERE roomId=?', (roomId,))
+        return bool(cursor.fetchone())
+    finally:
+        closeDb(conn, cursor)
+
+def legacySearchAdmin(wxId, roomId):
+    conn, cursor = openDb(db_server.userDb)
+    try:
+        cursor.execute('SELECT wxId FROM Admin WHERE wxId=? AND roomId=?', (wxId, roomId))
+        return bool(cursor.fetchone())
+    finally:
+        closeDb(conn, cursor)
+
+def legacyAddChatMessage(wxId, wxName, roomId, content):
+    conn, cursor = openDb(db_server.messageDb)
+    try:
+        cursor.execute('INSERT INTO chatMessage (wxId, wxName, roomId, content) VALUES (?, ?, ?, ?)', (wxId, wxName, roomId, content))
+        conn.commit()
+        return True
+    finally:
+        closeDb(conn, cursor)
+
+def makeOps(mode):
+    """
+    一条群消息的典型数据库访问: 查白名单群、查管理员、写聊天记录
+    :return: {操作名: 函数}
+    """
+    if mode == 'legacy':
+        return {
+            'searchWhiteRoom': lambda i: legacySearchWhiteRoom('room@chatroom'),
+            'searchAdmin': lambda i: legacySearchAdmin(f'wxid_{i % 50}', 'room@chatroom'),
+            'addChatMessage': lambda i: legacyAddChatMessage(f'wxid_{i % 50}', '成员', 'room@chatroom', f'消息{i}'),
+        }
+    drs, dus, dms = DbRoomServer(), DbUserServer(), DbMsgServer()
+    return {
+        'searchWhiteRoom': lambda i: drs.searchWhiteRoom('room@chatroom'),
+        'searchAdmin': lambda i: dus.searchAdmin(f'wxid_{i % 50}', 'room@chatroom'),
+        'addChatMessage': lambda i: dms.addChatMessage(f'wxid_{i % 50}', '成员', 'room@chatroom', f'消息{i}'),
+    }
+
+def runOps(ops, rounds, threads):
+    """
+    :return: {操作名: 每次操作平均微秒数}
+    """
+    result = {}
+    for name, func in ops.items():
+        per = rounds // threads
+
+        def work():
+            for i in range(per):
+                func(i)
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        result[name] = round((time.perf_counter() - start) / (per * threads) * 1e6, 2)
+    return result
+
+def runBench(rounds=5000, threads=4):
+    tempDir = tempfile.TemporaryDirectory()
+    patches = [
+        patch.object(db_server, 'userDb', os.path.join(tempDir.name, 'user.db')),
+        patch.object(db_server, 'roomDb', os.path.join(tempDir.name, 'room.db')),
+        patch.object(db_server, 'messageDb', os.path.join(tempDir.name, 'message.db')),
+    ]
+    for p in patches:
+        p.start()
+    logLevel = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        DbInitServer().initDb(background=False)
+        DbRoomServer().addWhiteRoom('room@chatroom', '压测群')
+        report = {'rounds': rounds, 'threads': threads, 'ops': {}}
+        legacy = runOps(makeOps('legacy'), rounds, threads)
+        pooled = runOps(makeOps('pooled'), rounds, threads)
+        for name in legacy:
+            report['ops'][name] = {
+                'legacyUs': legacy[name],
+                'pooledUs': pooled[name],
+                'speedup': round(legacy[name] / pooled[name], 2) if pooled[name] else 0.0,
+            }
+        # 批量写入: 计时包含退出时写完队列
+        writer = db_server.chatMsgWriter.start()
+        start = time.perf_counter()
+        runOps({'addChatMessage': makeOps('pooled')['addChatMessage']}, rounds, threads)
+        writer.shutdown()
+        batched = (time.perf_counter() - start) / (rounds // threads * threads) * 1e6
+        report['ops']['addChatMessage']['batchedUs'] = round(batched, 2)
+        report['ops']['addChatMessage']['batchedSpeedup'] = round(legacy['addChatMessage'] / batched, 2) if batched else 0.0
+        report['chatWriter'] = writer.metrics()
+        report['connections'] = db_server.dbConnections.metrics()
+        return report
+    finally:
+        logger.setLevel(logLevel)
+        db_server.closeAllDb()
+        for p in reversed(patches):
+            p.stop()
+        tempDir.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description='数据库连接压测')
+    parser.add_argument('--rounds', type=int, default=5000, help='每种操作的总次数')
+    parser.add_argument('--threads', type=int, default=4, help='并发线程数')
+    parser.add_argument('--output', default='', help='报告输出文件, 不填则只打印')
+    args = parser.parse_args()
+    report = runBench(args.rounds, args.threads)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        folder = os.path.dirname(args.output)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f'报告已保存到 {args.output}')
+
+if __name__ == '__main__':
+    main()
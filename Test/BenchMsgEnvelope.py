@@ -0,0 +1,112 @@
+"""
+消息信封压测: 对比原来每个处理函数各自用 ElementTree 解析 XML 的写法和 MsgEnvelope 解析一次的写法
+
+在项目根目录执行:
+    python Test/BenchMsgEnvelope.py --rounds 20000 --output logs/bench_msg_envelope.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import xml.etree.ElementTree as ET
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.wxmsg import LiteMsg, MsgEnvelope
+
+BOT_WXID = 'wxid_benchbot'
+
+def makeSamples():
+    """
+    :return: {消息类别: LiteMsg}
+    """
+    atXml = f'<msgsource><atuserlist><![CDATA[{BOT_WXID},wxid_m1]]></atuserlist><silence>0</silence><membercount>50</membercount></msgsource>'
+    quote = ('<msg><fromusername>wxid_m1</fromusername><scene>0</scene><appmsg appid="" sdkver="0"><title>这是什么意思</title><des />'
+             '<action /><type>57</type><showtype>0</showtype><refermsg><type>1</type><svrid>123</svrid><fromusr>room@chatroom</fromusr>'
+             '<chatusr>wxid_m2</chatusr><displayname>成员2</displayname><content>原消息内容</content></refermsg></appmsg></msg>')
+    article = ('<msg><appmsg appid="" sdkver="0"><title>文章标题</title><des>简介</des><url>https://mp.weixin.qq.com/s/abc</url><type>5</type>'
+               '<sourcedisplayname>压测公众号</sourcedisplayname><webviewshared><shareUrlOriginal>https://mp.weixin.qq.com/s/abc</shareUrlOriginal>'
+               '<shareUrlOpen>https://mp.weixin.qq.com/s/abc</shareUrlOpen></webviewshared></appmsg></msg>')
+    gh = ('<msg><appmsg appid="" sdkver="0"><title>推送标题</title><des>摘要</des><url>https://mp.weixin.qq.com/s/gh</url><type>5</type>'
+          '<mmreader><category count="2"><item><title>推送标题</title><url>https://mp.weixin.qq.com/s/gh</url></item>'
+          '<item><title>第二篇</title><url>https://mp.weixin.qq.com/s/gh2</url></item></category></mmreader></appmsg></msg>')
+    return {
+        'atText': LiteMsg(id=1, type=1, sender='wxid_m1', roomid='room@chatroom', content='@机器人 讲个笑话', xml=atXml, is_group=True),
+        'quote': LiteMsg(id=2, type=49, sender='wxid_m1', roomid='room@chatroom', content=quote, xml=atXml, is_group=True),
+        'article': LiteMsg(id=3, type=49, sender='wxid_m1', roomid='room@chatroom', content=article, xml='<msgsource />', is_group=True),
+        'gh': LiteMsg(id=4, type=49, sender='gh_bench', roomid='gh_bench', content=gh),
+    }
+
+def legacyHandle(kind, msg):
+    """
+    原来的写法: 分类和处理各自调用 is_at, @列表和 appmsg 各自用 ElementTree 解析
+    """
+    if kind == 'gh':
+        appmsg = ET.fromstring(msg.content).find('appmsg')
+        return appmsg.find('title').text, appmsg.find('url').text
+    # classifyMsg 与 mainHandle 各判断一次是否@机器人
+    atBot = msg.is_at(BOT_WXID) and msg.is_at(BOT_WXID)
+    if kind == 'atText':
+        element = ET.fromstring(msg.xml).find('.//atuserlist')
+        return atBot, element.text.replace(' ', '').strip().strip(',').split(',')
+    root = ET.fromstring(msg.content)
+    appmsg = root.find('appmsg')
+    eType = appmsg.find('type').text
+    if eType == '57':
+        refermsg = appmsg.find('refermsg')
+        return atBot, appmsg.find('title').text, refermsg.find('type').text, refermsg.find('content').text, root.find('fromusername').text
+    return atBot, appmsg.find('sourcedisplayname').text, appmsg.find('title').text, appmsg.find('des').text, appmsg.find('webviewshared').find('shareUrlOpen').text
+
+def envelopeHandle(kind, msg):
+    """
+    信封写法: 分发时包装一次, 各处理函数读取缓存字段
+    """
+    msg = MsgEnvelope.wrap(msg)
+    if kind == 'gh':
+        return msg.appTitle, msg.appUrl
+    atBot = msg.is_at(BOT_WXID) and msg.is_at(BOT_WXID)
+    if kind == 'atText':
+        return atBot, list(msg.atUserList)
+    if msg.appType == '57':
+        return (atBot, msg.appTitle) + tuple(msg.refer) + (msg.fromUser,)
+    return atBot, msg.sourceName, msg.appTitle, msg.appDes, msg.shareUrlOpen
+
+def timeIt(func, kind, msg, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(kind, msg)
+    return time.perf_counter() - start
+
+def runBench(rounds=20000):
+    report = {'rounds': rounds, 'kinds': {}}
+    for kind, msg in makeSamples().items():
+        # 两种写法的结果必须一致
+        assert legacyHandle(kind, msg) == envelopeHandle(kind, msg), kind
+        legacy = timeIt(legacyHandle, kind, msg, rounds)
+        envelope = timeIt(envelopeHandle, kind, msg, rounds)
+        report['kinds'][kind] = {
+            'legacyUs': round(legacy / rounds * 1e6, 3),
+            'envelopeUs': round(envelope / rounds * 1e6, 3),
+            'speedup': round(legacy / envelope, 2) if envelope else 0.0,
+        }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='消息信封解析压测')
+    parser.add_argument('--rounds', type=int, default=20000, help='每类消息的处理次数')
+    parser.add_argument('--output', default='', help='报告输出文件, 不填则只打印')
+    args = parser.parse_args()
+    report = runBench(args.rounds)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        folder = os.path.dirname(args.output)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f'报告已保存到 {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+消息处理全流程压测: 用合成消息驱动 Single/Room/GhMsgHandler.mainHandle,
+LLM 和 HTTP 请求均为模拟, 统计吞吐、延迟分位数以及每条消息的数据库/HTTP/LLM 调用次数
+
+在项目根目录执行:
+    python Test/BenchMsgPipeline.py --messages 2000 --llm-latency 0.05 --output logs/bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from unittest.mock import patch
+
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.common import logger
+from utils.fake_wcf import FakeWcf
+from utils.wxmsg import LiteMsg
+from utils.replay import percentile
+import servers.db_server as db_server
+from servers.db_server import DbInitServer, DbUserServer, DbRoomServer, DbMsgServer
+from servers.msg_server import SingleMsgHandler, RoomMsgHandler, GhMsgHandler
+from servers.dispatch_server import LaneExecutor
+from servers.route_server import routeTable
+
+BOT_WXID = 'wxid_benchbot'
+ROOM_NUM = 20
+MEMBER_NUM = 50
+USER_NUM = 50
+
+# 各类消息占比
+WORKLOAD = {
+    'chatter': 0.50,    # 群聊闲聊, 只记录
+    'atQuestion': 0.15, # 群聊@机器人提问
+    'private': 0.10,    # 私聊提问
+    'quote': 0.05,      # 群聊引用消息 type 49/57
+    'article': 0.03,    # 群聊分享公众号文章 type 49/5
+    'image': 0.07,      # 群聊图片 type 3
+    'join': 0.05,       # 入群系统消息 type 10000
+    'gh': 0.05,         # 公众号推送
+}
+
+ARTICLE_HTML = '<html><body><div id="js_content">' + '正文内容。' * 200 + '</div><script>var ct = "1700000000";</script></body></html>'
+
+class CallCounter:
+    def __init__(self):
+        """
+        按线程记录当前消息产生的调用次数
+        """
+        self.local = threading.local()
+
+    def begin(self):
+        self.local.counts = {'db': 0, 'http': 0, 'llm': 0}
+
+    def end(self):
+        counts = self.local.counts
+        self.local.counts = None
+        return counts
+
+    def incr(self, kind):
+        counts = getattr(self.local, 'counts', None)
+        if counts is not None:
+            counts[kind] += 1
+
+def wrapCounted(counter, kind, func):
+    def wrapper(*args, **kwargs):
+        counter.incr(kind)
+        return func(*args, **kwargs)
+    return wrapper
+
+def buildWorld(wcf, rng):
+    """
+    构造联系人、群成员和白名单数据
+    :return: (群列表, {群: 成员列表}, 私聊好友列表)
+    """
+    rooms = [f'bench{i}@chatroom' for i in range(ROOM_NUM)]
+    members = {}
+    dus, drs = DbUserServer(), DbRoomServer()
+    for roomId in rooms:
+        roomMembers = {f'wxid_{roomId[:-9]}_m{j}': f'成员{j}' for j in range(MEMBER_NUM)}
+        roomMembers[BOT_WXID] = '机器人'
+        wcf.addRoom(roomId, f'压测群{roomId[5:-9]}', roomMembers)
+        members[roomId] = [wxid for wxid in roomMembers if wxid != BOT_WXID]
+        drs.addWhiteRoom(roomId, f'压测群{roomId[5:-9]}')
+        # 一半的群开启回复
+        if rng.random() < 0.5:
+            drs.addResponseRoom(roomId, f'压测群{roomId[5:-9]}')
+    users = [f'wxid_user{i}' for i in range(USER_NUM)]
+    for wxid in users:
+        wcf.addContact(wxid, f'好友{wxid[9:]}')
+        dus.addUser(wxid, f'好友{wxid[9:]}')
+    wcf.addContact('gh_bench', '压测公众号')
+    routeTable.refresh()
+    return rooms, members, users
+
+def makeMsg(kind, msgId, rng, rooms, members, users):
+    """
+    :return: (处理器名称, LiteMsg)
+    """
+    now = int(time.time())
+    if kind == 'private':
+        sender = rng.choice(users)
+        return 'single', LiteMsg(id=msgId, type=1, ts=now, sender=sender, roomid=sender, content=f'帮我写一句诗 {msgId}')
+    if kind == 'gh':
+        content = f'<msg><appmsg><title>推送{msgId}</title><url>https://mp.weixin.qq.com/s/{msgId}</url><type>5</type></appmsg></msg>'
+        return 'gh', LiteMsg(id=msgId, type=49, ts=now, sender='gh_bench', roomid='gh_bench', content=content)
+    roomId = rng.choice(rooms)
+    sender = rng.choice(members[roomId])
+    atXml = f'<msgsource><atuserlist>{BOT_WXID}</atuserlist></msgsource>'
+    if kind == 'chatter':
+        msg = LiteMsg(id=msgId, type=1, content=f'今天天气不错 {msgId}', xml='<msgsource />')
+    elif kind == 'atQuestion':
+        msg = LiteMsg(id=msgId, type=1, content=f'@机器人 讲个笑话 {msgId}', xml=atXml)
+    elif kind == 'quote':
+        content = (f'<msg><fromusername>{sender}</fromusername><appmsg><title>这是什么意思</title><type>57</type>'
+                   f'<refermsg><type>1</type><content>原消息 {msgId}</content></refermsg></appmsg></msg>')
+        msg = LiteMsg(id=msgId, type=49, content=content, xml=atXml)
+    elif kind == 'article':
+        content = (f'<msg><appmsg><title>文章{msgId}</title><des>简介</des><url>https://mp.weixin.qq.com/s/{msgId}</url><type>5</type>'
+                   f'<sourcedisplayname>压测公众号</sourcedisplayname><webviewshared><shareUrlOriginal>https://mp.weixin.qq.com/s/{msgId}</shareUrlOriginal>'
+                   f'<shareUrlOpen>https://mp.weixin.qq.com/s/{msgId}</shareUrlOpen></webviewshared></appmsg></msg>')
+        msg = LiteMsg(id=msgId, type=49, content=content, xml='<msgsource />')
+    elif kind == 'image':
+        msg = LiteMsg(id=msgId, type=3, content='', extra=f'{msgId}.dat')
+    else:
+        msg = LiteMsg(id=msgId, type=10000, content=f'"成员1"邀请"新人{msgId}"加入了群聊')
+        sender = 'system'
+    msg.ts, msg.sender, msg.roomid, msg.is_group = now, sender, roomId, True
+    return 'room', msg
+
+def summarize(samples, duration=None):
+    latencies = sorted(sample['latency'] for sample in samples)
+    count = len(samples)
+    result = {
+        'messages': count,
+        'p50': round(percentile(latencies, 50) * 1000, 3),
+        'p95': round(percentile(latencies, 95) * 1000, 3),
+        'p99': round(percentile(latencies, 99) * 1000, 3),
+        'max': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+    for kind in ('db', 'http', 'llm'):
+        result[f'{kind}PerMsg'] = round(sum(sample[kind] for sample in samples) / count, 3) if count else 0.0
+    if duration is not None:
+        result['duration'] = round(duration, 3)
+        result['msgsPerSec'] = round(count / duration, 2) if duration else 0.0
+    return result
+
+def gitVersion():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return ''
+
+def runBench(messages=2000, llmLatency=0.05, httpLatency=0.02, lanes=8, seed=42):
+    rng = random.Random(seed)
+    counter = CallCounter()
+    tempDir = tempfile.TemporaryDirectory()
+    picFolder = os.path.join(tempDir.name, 'pic')
+    os.makedirs(picFolder)
+
+    def fakeUnillm(model_name_list, messages, **kwargs):
+        counter.incr('llm')
+        time.sleep(llmLatency)
+        # 图片广告判断回复 "否", 其余返回普通回复
+        return '否' if isinstance(messages[-1]['content'], list) else '好的, 这是压测回复'
+
+    def fakeRequest(session, method, url, **kwargs):
+        counter.incr('http')
+        time.sleep(httpLatency)
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = ARTICLE_HTML.encode('utf-8')
+        return response
+
+    patches = [
+        patch.object(db_server, 'userDb', os.path.join(tempDir.name, 'user.db')),
+        patch.object(db_server, 'roomDb', os.path.join(tempDir.name, 'room.db')),
+        patch.object(db_server, 'messageDb', os.path.join(tempDir.name, 'message.db')),
+        patch('servers.api_server.unillm', new=fakeUnillm),
+        patch('requests.Session.request', new=fakeRequest),
+        patch('servers.msg_server.returnPicCacheFolder', return_value=picFolder),
+    ]
+    # 统计数据库调用: 每个公开方法算一次
+    for cls in (DbUserServer, DbRoomServer, DbMsgServer):
+        for name, func in list(vars(cls).items()):
+            if callable(func) and not name.startswith('_'):
+                patches.append(patch.object(cls, name, wrapCounted(counter, 'db', func)))
+    for p in patches:
+        p.start()
+    logLevel = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        DbInitServer().initDb(background=False)
+        wcf = FakeWcf(selfWxid=BOT_WXID, selfName='机器人', seed=seed)
+        rooms, members, users = buildWorld(wcf, rng)
+        handlers = {'room': RoomMsgHandler(wcf), 'single': SingleMsgHandler(wcf), 'gh': GhMsgHandler(wcf)}
+        kinds = list(WORKLOAD)
+        weights = [WORKLOAD[kind] for kind in kinds]
+        workload = []
+        for msgId in range(messages):
+            kind = rng.choices(kinds, weights)[0]
+            workload.append((kind,) + makeMsg(kind, msgId, rng, rooms, members, users))
+
+        samples = []
+        lock = threading.Lock()
+
+        def handle(kind, handlerName, msg):
+            counter.begin()
+            start = time.perf_counter()
+            try:
+                handlers[handlerName].mainHandle(msg)
+            finally:
+                sample = counter.end()
+                sample['latency'] = time.perf_counter() - start
+                sample['kind'] = kind
+                with lock:
+                    samples.append(sample)
+
+        executor = LaneExecutor(laneNum=lanes, queueSize=messages).start()
+        start = time.perf_counter()
+        for kind, handlerName, msg in workload:
+            key = msg.roomid if handlerName == 'room' else msg.sender
+            executor.submit(key, handle, kind, handlerName, msg)
+        executor.join()
+        duration = time.perf_counter() - start
+        executor.shutdown()
+
+        report = {
+            'version': gitVersion(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'config': {'messages': messages, 'llmLatency': llmLatency, 'httpLatency': httpLatency, 'lanes': lanes, 'seed': seed},
+            'total': summarize(samples, duration),
+            'kinds': {kind: summarize([s for s in samples if s['kind'] == kind]) for kind in kinds},
+            'wcf': wcf.metrics(),
+        }
+        wcf.cleanup()
+        return report
+    finally:
+        logger.setLevel(logLevel)
+        for p in reversed(patches):
+            p.stop()
+        # 长连接不关闭时 Windows 上无法删除临时数据库
+        db_server.closeAllDb()
+        tempDir.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description='消息处理全流程压测')
+    parser.add_argument('--messages', type=int, default=2000, help='消息总数')
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='模拟 LLM 调用耗时(秒)')
+    parser.add_argument('--http-latency', type=float, default=0.02, help='模拟 HTTP 请求耗时(秒)')
+    parser.add_argument('--lanes', type=int, default=8, help='处理通道数')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    parser.add_argument('--output', default='logs/bench_msg_pipeline.json', help='报告输出文件')
+    args = parser.parse_args()
+    report = runBench(args.messages, args.llm_latency, args.http_latency, args.lanes, args.seed)
+    folder = os.path.dirname(args.output)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report['total'], ensure_ascii=False, indent=2))
+    print(f'报告已保存到 {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import unittest
+import asyncio
+import time
+import os
+import sys
+from queue import Empty
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from servers.async_server import AsyncRuntime
+
+class TestAsyncRuntime(unittest.TestCase):
+
+    def setUp(self):
+        self.runtime = AsyncRuntime(maxConcurrency=100).start()
+
+    def tearDown(self):
+        self.runtime.shutdown()
+
+    def test_many_slow_calls_wait_concurrently(self):
+        async def slowCall(i):
+            await asyncio.sleep(0.2)
+            return i
+
+        futures = [self.runtime.submit(slowCall(i), key=f'chat{i}') for i in range(100)]
+        # 100 个 0.2s 的调用并发等待, 总耗时应远小于串行的 20s
+        results = [future.result(timeout=5) for future in futures]
+        self.assertEqual(results, list(range(100)))
+        metrics = self.runtime.metrics()
+        self.assertEqual(metrics['completed'], 100)
+        self.assertEqual(metrics['inflight'], 0)
+
+    def test_same_key_runs_in_order(self):
+        results = []
+
+        async def call(i):
+            await asyncio.sleep(0.01 * (5 - i))
+            results.append(i)
+
+        futures = [self.runtime.submit(call(i), key='room@chatroom') for i in range(5)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+
+    def test_busy_chat_not_starving_others(self):
+        runtime = AsyncRuntime(maxConcurrency=2).start()
+        started = []
+
+        async def call(key, seconds):
+            started.append(key)
+            await asyncio.sleep(seconds)
+
+        hot = [runtime.submit(call('hot', 0.2), key='hot@chatroom') for _ in range(5)]
+        other = runtime.submit(call('other', 0), key='other@chatroom')
+        # 热门会话排队的 4 个协程不占名额, 其他会话不用等它们执行完
+        other.result(timeout=0.15)
+        for future in hot:
+            future.result(timeout=5)
+        # 空闲会话的锁已删除
+        self.assertEqual(runtime.metrics()['chats'], 0)
+        runtime.shutdown()
+
+    def test_failed_call_counted(self):
+        async def boom():
+            raise RuntimeError('boom')
+
+        self.assertIsNone(self.runtime.submit(boom()).result(timeout=5))
+        self.assertEqual(self.runtime.metrics()['failed'], 1)
+
+    def test_pending_limit(self):
+        runtime = AsyncRuntime(maxConcurrency=10, maxPending=2, fullPolicy='drop').start()
+        release = asyncio.Event()
+
+        async def wait():
+            await release.wait()
+
+        futures = [runtime.submit(wait()) for _ in range(2)]
+        # 积压已满, 第三个直接丢弃, 不再进入事件循环
+        self.assertIsNone(runtime.submit(wait()))
+        self.assertEqual((runtime.depth(), runtime.metrics()['rejected']), (2, 1))
+        runtime.loop.call_soon_threadsafe(release.set)
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(runtime.depth(), 0)
+        runtime.submit(wait()).result(timeout=5)
+        runtime.shutdown()
+
+    def test_pending_limit_block_timeout(self):
+        runtime = AsyncRuntime(maxPending=1, fullPolicy='block', blockTimeout=0.05).start()
+        future = runtime.submit(asyncio.sleep(0.2))
+        start = time.time()
+        self.assertIsNone(runtime.submit(asyncio.sleep(0)))
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        future.result(timeout=5)
+        runtime.shutdown()
+
+    def test_receiveLoop(self):
+        wcf = MagicMock()
+        wcf.is_receiving_msg.side_effect = [True, True, True, False]
+        wcf.get_msg.side_effect = ['msg1', Empty(), 'msg2']
+        received = []
+
+        self.runtime.run(self.runtime.receiveLoop(wcf, received.append))
+        self.assertEqual(received, ['msg1', 'msg2'])
+
+    def test_blocking_dispatch_not_stalling_loop(self):
+        wcf = MagicMock()
+        wcf.is_receiving_msg.side_effect = [True, False]
+        wcf.get_msg.return_value = 'msg'
+
+        async def ping():
+            return 'pong'
+
+        # 分发阻塞期间事件循环上的其他协程照常执行
+        receive = asyncio.run_coroutine_threadsafe(self.runtime.receiveLoop(wcf, lambda msg: time.sleep(0.5)), self.runtime.loop)
+        self.assertEqual(self.runtime.submit(ping()).result(timeout=0.3), 'pong')
+        receive.result(timeout=5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import tempfile
+import pickle
+import yaml
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.common import ConfigStore, FrozenDict, FrozenList, thawConfig
+
+class TestConfigStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempDir.name, 'config.yaml')
+        self.writeConfig({'Administrators': ['wxid_admin'], 'systemConfig': {'robotName': '小助手'}})
+        self.store = ConfigStore(self.path, checkInterval=0)
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def writeConfig(self, data, mtime=None):
+        with open(self.path, 'w', encoding='UTF-8') as f:
+            yaml.dump(data, f, allow_unicode=True)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_parse_once(self):
+        first = self.store.get()
+        self.assertIs(self.store.get(), first)
+        self.assertEqual(self.store.loads, 1)
+        self.assertEqual(first['systemConfig']['robotName'], '小助手')
+
+    def test_snapshot_readonly(self):
+        configData = self.store.get()
+        self.assertIsInstance(configData, dict)
+        self.assertIsInstance(configData['Administrators'], list)
+        with self.assertRaises(TypeError):
+            configData['systemConfig']['robotName'] = '其他'
+        with self.assertRaises(TypeError):
+            configData['Administrators'].append('wxid_other')
+        # 可以跨进程传递
+        restored = pickle.loads(pickle.dumps(configData))
+        self.assertIsInstance(restored['Administrators'], FrozenList)
+        self.assertEqual(restored, configData)
+
+    def test_reload_on_mtime_change(self):
+        changes = []
+        self.store.subscribe(changes.append)
+        self.store.get()
+        self.writeConfig({'Administrators': [], 'systemConfig': {'robotName': '新名字'}}, mtime=os.stat(self.path).st_mtime + 10)
+        configData = self.store.get()
+        self.assertEqual(configData['systemConfig']['robotName'], '新名字')
+        self.assertEqual(self.store.loads, 2)
+        self.assertEqual(changes, [configData])
+
+    def test_broken_file_keeps_old_snapshot(self):
+        first = self.store.get()
+        with open(self.path, 'w', encoding='UTF-8') as f:
+            f.write('systemConfig: [')
+        os.utime(self.path, (os.stat(self.path).st_mtime + 10,) * 2)
+        self.assertIs(self.store.get(), first)
+
+    def test_missing_file_keeps_old_snapshot(self):
+        first = self.store.get()
+        # 原子保存时旧文件已删除、新文件还未改名
+        os.remove(self.path)
+        self.assertIs(self.store.get(), first)
+        self.writeConfig({'Administrators': ['wxid_new']}, mtime=1)
+        self.assertEqual(self.store.get()['Administrators'], ['wxid_new'])
+
+    def test_save(self):
+        configData = thawConfig(self.store.get())
+        self.assertNotIsInstance(configData, FrozenDict)
+        configData['Administrators'].append('wxid_new')
+        self.store.save(configData)
+        with open(self.path, encoding='UTF-8') as f:
+            self.assertEqual(yaml.safe_load(f)['Administrators'], ['wxid_admin', 'wxid_new'])
+
+if __name__ == '__main__':
+    unittest.main()
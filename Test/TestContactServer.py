@@ -0,0 +1,140 @@
+import unittest
+import time
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.fake_wcf import FakeWcf
+from servers.contact_server import ContactIndex, RoomMemberCache, AliasCache
+from utils.wxmsg import LiteMsg
+
+class TestContactIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.wcf = FakeWcf(seed=1)
+        self.wcf.addContact('wxid_user', '张三', remark='老张')
+        self.wcf.addRoom('room@chatroom', '测试群')
+        self.index = ContactIndex(self.wcf, missInterval=60)
+
+    def tearDown(self):
+        self.wcf.cleanup()
+
+    def test_bulk_load(self):
+        self.assertEqual(self.index.getName('wxid_user'), '张三')
+        self.assertEqual(self.index.getName('room@chatroom'), '测试群')
+        self.assertEqual(self.index.getWxId('张三'), 'wxid_user')
+        self.assertEqual(self.index.getWxId('老张'), 'wxid_user')
+        # 只批量查询了一次
+        self.assertEqual(self.wcf.metrics()['calls']['query_sql'], 1)
+        metrics = self.index.metrics()
+        self.assertEqual((metrics['loads'], metrics['hits'], metrics['misses'], metrics['hitRatio']), (1, 4, 0, 1.0))
+
+    def test_miss_query(self):
+        self.index.refresh()
+        self.wcf.addContact('wxid_new', "O'Neil")
+        self.assertEqual(self.index.getName('wxid_new'), "O'Neil")
+        self.assertEqual(self.index.getWxId("O'Neil"), 'wxid_new')
+        # 不存在的 key 在 missInterval 内不重复查询
+        self.assertEqual(self.index.getName('wxid_none'), '')
+        self.assertEqual(self.index.getName('wxid_none'), '')
+        self.assertEqual(self.wcf.metrics()['calls']['query_sql'], 3)
+        self.assertEqual(self.index.metrics()['misses'], 3)
+
+    def test_reload_after_max_age(self):
+        index = ContactIndex(self.wcf, maxAge=0)
+        index.getName('wxid_user')
+        self.wcf.addContact('wxid_user', '张三丰')
+        index.loadTime -= 1
+        self.assertEqual(index.getName('wxid_user'), '张三丰')
+        self.assertEqual(index.metrics()['loads'], 2)
+
+class TestRoomMemberCache(unittest.TestCase):
+
+    def setUp(self):
+        self.wcf = FakeWcf(seed=1)
+        self.wcf.addContact('wxid_c', '小C')
+        self.wcf.addRoom('room@chatroom', '测试群', {'wxid_a': '小A', 'wxid_b': '小B'})
+        self.cache = RoomMemberCache(self.wcf, maxAge=300)
+
+    def tearDown(self):
+        self.wcf.cleanup()
+
+    def calls(self):
+        return self.wcf.metrics()['calls'].get('get_chatroom_members', 0)
+
+    def test_cached(self):
+        self.assertEqual(self.cache.count('room@chatroom'), 2)
+        self.assertTrue(self.cache.isMember('room@chatroom', 'wxid_a'))
+        self.assertFalse(self.cache.isMember('room@chatroom', 'wxid_c'))
+        self.assertEqual(self.calls(), 1)
+        self.assertEqual(self.cache.metrics()['hits'], 2)
+
+    def test_invalidate_on_system_msg(self):
+        self.cache.get('room@chatroom')
+        self.wcf.invite_chatroom_members('room@chatroom', 'wxid_c')
+        chat = LiteMsg(id=1, type=1, roomid='room@chatroom', content='加入了群聊')
+        self.assertFalse(self.cache.onSystemMsg(chat))
+        join = LiteMsg(id=2, type=10000, roomid='room@chatroom', content='"小A"邀请"小C"加入了群聊')
+        self.assertTrue(self.cache.onSystemMsg(join))
+        self.assertEqual(self.cache.count('room@chatroom'), 3)
+        self.assertEqual(self.calls(), 2)
+
+    def test_del_members(self):
+        self.cache.get('room@chatroom')
+        self.assertEqual(self.cache.delMembers('room@chatroom', 'wxid_a'), 1)
+        self.assertFalse(self.cache.isMember('room@chatroom', 'wxid_a'))
+
+    def test_background_refresh(self):
+        self.cache.get('room@chatroom')
+        self.wcf.addRoomMember('room@chatroom', 'wxid_c', '小C')
+        self.cache.maxAge = 0
+        time.sleep(0.01)
+        # 过期后先返回旧数据, 后台加载完成后再返回新数据
+        self.assertEqual(self.cache.count('room@chatroom'), 2)
+        deadline = time.time() + 2
+        while self.cache.metrics()['loads'] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.cache.maxAge = 300
+        self.assertEqual(self.cache.count('room@chatroom'), 3)
+
+class TestAliasCache(unittest.TestCase):
+
+    def setUp(self):
+        self.wcf = FakeWcf(seed=1)
+        self.wcf.addRoom('room@chatroom', '测试群', {'wxid_a': '阿A', 'wxid_b': ''})
+        self.wcf.addContact('wxid_b', '小B')
+        self.aliases = AliasCache(self.wcf, RoomMemberCache(self.wcf))
+
+    def tearDown(self):
+        self.wcf.cleanup()
+
+    def test_prefetch_room(self):
+        self.assertEqual(self.aliases.get('wxid_a', 'room@chatroom'), '阿A')
+        self.assertEqual(self.aliases.get('wxid_a', 'room@chatroom'), '阿A')
+        # 群成员列表中没有名字的成员单独查询一次
+        self.assertEqual(self.aliases.get('wxid_b', 'room@chatroom'), '小B')
+        self.assertEqual(self.aliases.get('wxid_b', 'room@chatroom'), '小B')
+        calls = self.wcf.metrics()['calls']
+        self.assertEqual((calls['get_chatroom_members'], calls['get_alias_in_chatroom']), (1, 1))
+        self.assertEqual(self.aliases.metrics()['queries'], 1)
+
+    def test_invalidate_on_rename(self):
+        self.aliases.get('wxid_a', 'room@chatroom')
+        self.wcf.addRoomMember('room@chatroom', 'wxid_a', '新A')
+        self.assertEqual(self.aliases.get('wxid_a', 'room@chatroom'), '阿A')
+        other = LiteMsg(id=1, type=10000, roomid='room@chatroom', content='"阿A"邀请"小C"加入了群聊')
+        self.assertFalse(self.aliases.onSystemMsg(other))
+        rename = LiteMsg(id=2, type=10000, roomid='room@chatroom', content='"阿A"修改了群昵称')
+        self.assertTrue(self.aliases.onSystemMsg(rename))
+        self.aliases.members.invalidate('room@chatroom')
+        self.assertEqual(self.aliases.get('wxid_a', 'room@chatroom'), '新A')
+
+    def test_ttl(self):
+        aliases = AliasCache(self.wcf, maxAge=0)
+        aliases.get('wxid_a', 'room@chatroom')
+        time.sleep(0.01)
+        aliases.get('wxid_a', 'room@chatroom')
+        self.assertEqual(self.wcf.metrics()['calls']['get_alias_in_chatroom'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 import unittest
 import os
 import sqlite3
-from datetime import datetime
+import time
+import tempfile
+import threading
+from datetime import datetime, timedelta
 from unittest.mock import patch
 from utils.common import logger  # Assuming you have a logger in utils.common
-from servers.db_server import DbInitServer, DbUserServer, DbRoomServer, DbMsgServer, openDb, closeDb
+import servers.db_server as db_server
+from servers.db_server import DbInitServer, DbUserServer, DbRoomServer, DbMsgServer, DbConnectionManager, ChatMsgWriter, loadDbPragmas, localDayRange, toUtcText, openDb, closeDb
 
 # Define test database paths
 TEST_USER_DB = 'test_user.db'
@@ -273,5 +277,258 @@ class TestDbMsgServer(unittest.TestCase):
         self.assertEqual(retrieved_wxName, wxName)
         self.assertEqual(retrieved_content, content)
 
+class TestDbConnectionManager(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.dbPath = os.path.join(self.tempDir.name, 'room.db')
+        self.manager = DbConnectionManager()
+
+    def tearDown(self):
+        self.manager.closeAll()
+        self.tempDir.cleanup()
+
+    def test_reuse_per_thread(self):
+        conn = self.manager.get(self.dbPath)
+        self.assertIs(self.manager.get(self.dbPath), conn)
+        others = []
+        thread = threading.Thread(target=lambda: others.append(self.manager.get(self.dbPath)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(others[0], conn)
+        self.assertEqual(self.manager.metrics(), {'connections': 2, 'opened': 2, 'reused': 1})
+        # 线程退出后, 下次打开新连接时关闭它留下的连接
+        self.manager.get(os.path.join(self.tempDir.name, 'user.db'))
+        self.assertEqual(self.manager.metrics()['connections'], 2)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            others[0].execute('SELECT 1')
+
+    def test_reused_concurrent(self):
+        barrier = threading.Barrier(8)
+
+        def reuse():
+            self.manager.get(self.dbPath)
+            barrier.wait()
+            for _ in range(2000):
+                self.manager.get(self.dbPath)
+
+        threads = [threading.Thread(target=reuse) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 多线程同时复用连接时计数不丢失
+        self.assertEqual(self.manager.metrics()['reused'], 8 * 2000)
+        self.assertEqual(self.manager.opened, 8)
+
+    def test_release_and_close_all(self):
+        conn = self.manager.get(self.dbPath)
+        self.manager.release(self.dbPath)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
+        conn = self.manager.get(self.dbPath)
+        self.manager.closeAll()
+        self.assertEqual(self.manager.metrics()['connections'], 0)
+        self.assertIsNot(self.manager.get(self.dbPath), conn)
+
+    def test_failed_write_rolled_back(self):
+        with patch.object(db_server, 'roomDb', self.dbPath), patch.object(db_server, 'dbConnections', self.manager):
+            conn = self.manager.get(self.dbPath)
+            conn.execute('CREATE TABLE whiteRoom (roomId varchar(255) PRIMARY KEY, roomName varchar(255))')
+            room_server = DbRoomServer()
+            self.assertTrue(room_server.addWhiteRoom('room1', '群1'))
+            self.assertFalse(room_server.addWhiteRoom('room1', '群1'))
+            self.assertFalse(conn.in_transaction)
+            self.assertTrue(room_server.addWhiteRoom('room2', '群2'))
+            self.assertEqual(len(room_server.showWhiteRoom()), 2)
+
+    def test_wal_pragmas(self):
+        manager = DbConnectionManager(pragmas={'journal_mode': 'WAL', 'busy_timeout': 2000, 'synchronous': 'NORMAL'})
+        conn = manager.get(self.dbPath)
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA busy_timeout').fetchone()[0], 2000)
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+        conn.execute('CREATE TABLE chatMessage (content varchar(255))')
+        conn.commit()
+        # 读事务未结束时, 其他连接仍可写入, 读到的仍是开始时的快照
+        reader = sqlite3.connect(self.dbPath)
+        reader.execute('BEGIN')
+        self.assertEqual(reader.execute('SELECT COUNT(*) FROM chatMessage').fetchone()[0], 0)
+        with conn:
+            conn.execute('INSERT INTO chatMessage VALUES (?)', ('消息',))
+        self.assertEqual(reader.execute('SELECT COUNT(*) FROM chatMessage').fetchone()[0], 0)
+        reader.rollback()
+        self.assertEqual(reader.execute('SELECT COUNT(*) FROM chatMessage').fetchone()[0], 1)
+        reader.close()
+        manager.closeAll()
+
+    def test_config_override(self):
+        configData = {'dbConfig': {'busyTimeout': 10000, 'synchronous': 'FULL', 'mmapSize': None}}
+        with patch.object(db_server, 'returnConfigData', return_value=configData):
+            pragmas = loadDbPragmas()
+        self.assertEqual((pragmas['busy_timeout'], pragmas['synchronous'], pragmas['journal_mode']), (10000, 'FULL', 'WAL'))
+        self.assertEqual(pragmas['mmap_size'], db_server.DB_PRAGMAS['mmap_size'])
+        # 非法的值不会拼进 SQL
+        manager = DbConnectionManager(pragmas={'synchronous': 'OFF; DROP TABLE x'})
+        self.assertEqual(manager.get(self.dbPath).execute('PRAGMA synchronous').fetchone()[0], 2)
+        manager.closeAll()
+
+class TestChatMsgWriter(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.dbPath = os.path.join(self.tempDir.name, 'message.db')
+        self.manager = DbConnectionManager(pragmas={'journal_mode': 'WAL'})
+        self.patches = [patch.object(db_server, 'messageDb', self.dbPath), patch.object(db_server, 'dbConnections', self.manager)]
+        for p in self.patches:
+            p.start()
+        conn = self.manager.get(self.dbPath)
+        conn.execute('CREATE TABLE chatMessage (id INTEGER PRIMARY KEY AUTOINCREMENT, wxId varchar(255), wxName varchar(255), roomId varchar(255), content varchar(255), createTime datetime DEFAULT CURRENT_TIMESTAMP, createTs INTEGER)')
+        conn.commit()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        self.manager.closeAll()
+        self.tempDir.cleanup()
+
+    def count(self):
+        return self.manager.get(self.dbPath).execute('SELECT COUNT(*) FROM chatMessage').fetchone()[0]
+
+    def test_batch_by_size(self):
+        writer = ChatMsgWriter(flushInterval=10, batchSize=50).start()
+        for i in range(120):
+            self.assertTrue(writer.add('wxid_a', '成员', 'room@chatroom', f'消息{i}'))
+        time.sleep(0.2)
+        # 攒够 50 条就写入, 剩余的等待间隔或退出时写入
+        self.assertGreaterEqual(self.count(), 100)
+        writer.shutdown()
+        self.assertEqual(self.count(), 120)
+        metrics = writer.metrics()
+        self.assertEqual((metrics['written'], metrics['depth']), (120, 0))
+        self.assertLessEqual(metrics['batches'], 4)
+        contents = [row[0] for row in self.manager.get(self.dbPath).execute('SELECT content FROM chatMessage ORDER BY id')]
+        self.assertEqual(contents, [f'消息{i}' for i in range(120)])
+
+    def test_batch_by_interval(self):
+        writer = ChatMsgWriter(flushInterval=0.05, batchSize=1000).start()
+        writer.add('wxid_a', '成员', 'room@chatroom', '消息')
+        time.sleep(0.3)
+        self.assertEqual(self.count(), 1)
+        writer.shutdown()
+
+    def test_queue_full_not_blocking(self):
+        writer = ChatMsgWriter(maxQueue=3)
+        results = [writer.add('wxid_a', '成员', 'room@chatroom', str(i)) for i in range(5)]
+        self.assertEqual(results, [True] * 3 + [False] * 2)
+        self.assertEqual(writer.metrics()['dropped'], 2)
+        self.assertEqual(writer.flush(), 3)
+
+    def shortBusyTimeout(self):
+        # 默认等锁 5 秒, 测试中缩短
+        self.manager.pragmas['busy_timeout'] = 20
+        self.manager.get(self.dbPath).execute('PRAGMA busy_timeout = 20')
+
+    def test_locked_batch_retried(self):
+        self.shortBusyTimeout()
+        writer = ChatMsgWriter(flushInterval=0.01, batchSize=1000, retryDelay=0.05).start()
+        # 其他连接持有写锁, 如后台建索引
+        locker = sqlite3.connect(self.dbPath)
+        locker.execute('BEGIN IMMEDIATE')
+        for i in range(3):
+            writer.add('wxid_a', '成员', 'room@chatroom', f'消息{i}')
+        time.sleep(0.2)
+        metrics = writer.metrics()
+        self.assertGreaterEqual(metrics['retried'], 1)
+        self.assertEqual((metrics['depth'], metrics['discarded'], metrics['failed']), (3, 0, 0))
+        writer.add('wxid_a', '成员', 'room@chatroom', '消息3')
+        locker.rollback()
+        locker.close()
+        writer.shutdown()
+        # 放回队首重试, 顺序不变且不丢消息
+        contents = [row[0] for row in self.manager.get(self.dbPath).execute('SELECT content FROM chatMessage ORDER BY id')]
+        self.assertEqual(contents, [f'消息{i}' for i in range(4)])
+
+    def test_locked_batch_discarded_after_retries(self):
+        self.shortBusyTimeout()
+        writer = ChatMsgWriter(flushInterval=10, batchSize=1000, maxRetries=2, retryDelay=0.01)
+        locker = sqlite3.connect(self.dbPath)
+        locker.execute('BEGIN IMMEDIATE')
+        writer.add('wxid_a', '成员', 'room@chatroom', '消息')
+        writer.shutdown()
+        locker.rollback()
+        locker.close()
+        metrics = writer.metrics()
+        self.assertEqual((metrics['retried'], metrics['discarded'], metrics['depth']), (2, 1, 0))
+        self.assertEqual(self.count(), 0)
+
+    def test_read_sees_queued(self):
+        writer = ChatMsgWriter(flushInterval=10, batchSize=1000).start()
+        with patch.object(db_server, 'chatMsgWriter', writer):
+            msg_server = DbMsgServer()
+            self.assertTrue(msg_server.addChatMessage('wxid_a', '成员', 'room@chatroom', '刚收到'))
+            self.assertEqual(writer.metrics()['depth'], 1)
+            # 读之前先写入队列中的消息
+            self.assertEqual(msg_server.showTodayRank('room@chatroom'), [('成员', 1)])
+        writer.shutdown()
+
+class TestChatQueries(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.manager = DbConnectionManager(pragmas={})
+        self.patches = [patch.object(db_server, name, os.path.join(self.tempDir.name, f'{name}.db')) for name in ('userDb', 'roomDb', 'messageDb')]
+        self.patches.append(patch.object(db_server, 'dbConnections', self.manager))
+        for p in self.patches:
+            p.start()
+        with patch.object(db_server, 'loadDbPragmas', return_value={}):
+            DbInitServer().initDb(background=False)
+        self.conn = self.manager.get(db_server.messageDb)
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        self.manager.closeAll()
+        self.tempDir.cleanup()
+
+    def addAt(self, wxId, wxName, roomId, localTime):
+        with self.conn:
+            self.conn.execute('INSERT INTO chatMessage (wxId, wxName, roomId, content, createTime) VALUES (?, ?, ?, ?, ?)',
+                              (wxId, wxName, roomId, '消息', toUtcText(localTime)))
+
+    def test_local_day_range(self):
+        start, end = localDayRange(now=datetime(2025, 1, 10, 15, 30))
+        self.assertEqual((start, end), (toUtcText(datetime(2025, 1, 10)), toUtcText(datetime(2025, 1, 11))))
+        start, _ = localDayRange(days=7, now=datetime(2025, 1, 10, 15, 30))
+        self.assertEqual(start, toUtcText(datetime(2025, 1, 4)))
+
+    def test_today_boundaries(self):
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.addAt('wxid_a', '成员A', 'room@chatroom', today)
+        self.addAt('wxid_a', '成员A', 'room@chatroom', today + timedelta(hours=23, minutes=59, seconds=59))
+        self.addAt('wxid_b', '成员B', 'room@chatroom', today - timedelta(seconds=1))
+        self.addAt('wxid_b', '成员B', 'room@chatroom', today + timedelta(days=1))
+        self.addAt('wxid_c', '成员C', 'other@chatroom', today + timedelta(hours=1))
+        msg_server = DbMsgServer()
+        self.assertEqual(msg_server.showTodayRank('room@chatroom'), [('成员A', 2)])
+        chats = msg_server.showChatMessage('room@chatroom')
+        self.assertEqual([chat[2] for chat in chats], [today.strftime('%Y-%m-%d %H:%M:%S'), (today + timedelta(hours=23, minutes=59, seconds=59)).strftime('%Y-%m-%d %H:%M:%S')])
+        self.addAt('wxid_d', '成员D', 'room@chatroom', today - timedelta(days=6))
+        self.addAt('wxid_e', '成员E', 'room@chatroom', today - timedelta(days=7))
+        self.assertEqual(dict(msg_server.showLastWeekTalkMembers('room@chatroom')), {'wxid_a': '成员A', 'wxid_b': '成员B', 'wxid_d': '成员D'})
+
+    def test_query_plans_use_index(self):
+        params = ('room@chatroom', ) + localDayRange()
+        for sql in (db_server.CHAT_HISTORY_SQL, db_server.CHAT_RANK_SQL, db_server.CHAT_MEMBERS_SQL):
+            plan = ' | '.join(row[-1] for row in self.conn.execute(f'EXPLAIN QUERY PLAN {sql}', params))
+            self.assertRegex(plan, r'SEARCH chatMessage USING (COVERING )?INDEX idx_chatMessage_room_(time|member)', sql)
+            self.assertNotIn('SCAN chatMessage', plan)
+
+    def test_migrate_once(self):
+        versions = self.conn.execute('SELECT version FROM schema_version ORDER BY version').fetchall()
+        self.assertEqual(versions, [(1, ), (2, ), (3, )])
+        with patch.object(db_server, 'loadDbPragmas', return_value={}):
+            DbInitServer().initDb(background=False)
+        self.assertEqual(self.conn.execute('SELECT COUNT(*) FROM schema_version').fetchone()[0], 3)
+        indexes = {row[1] for row in self.conn.execute('PRAGMA index_list(chatMessage)')}
+        self.assertTrue({'idx_chatMessage_room_time', 'idx_chatMessage_room_member'} <= indexes)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
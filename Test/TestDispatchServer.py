@@ -0,0 +1,317 @@
+import unittest
+import threading
+import time
+import os
+import sys
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from servers.trigger_server import AdminCommand, CommandTable
+from servers.dispatch_server import WorkerPool, LaneExecutor, LoadShedder, classifyMsg, PRIORITY_ADMIN, PRIORITY_INTERACTIVE, PRIORITY_LOG, PRIORITY_GH
+from servers.dispatch_server import SHED_NONE, SHED_STALE, SHED_OVERLOAD, MsgDeduper
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_submit_and_process(self):
+        pool = WorkerPool(workerNum=2, queueSize=10).start()
+        results = []
+        lock = threading.Lock()
+
+        def task(i):
+            with lock:
+                results.append(i)
+
+        for i in range(5):
+            self.assertTrue(pool.submit(task, i))
+        pool.join()
+        pool.shutdown()
+
+        self.assertEqual(sorted(results), [0, 1, 2, 3, 4])
+        metrics = pool.metrics()
+        self.assertEqual(metrics['submitted'], 5)
+        self.assertEqual(metrics['processed'], 5)
+        self.assertEqual(metrics['dropped'], 0)
+        self.assertEqual(metrics['depth'], 0)
+
+    def test_drop_policy_when_full(self):
+        pool = WorkerPool(workerNum=1, queueSize=1, fullPolicy='drop').start()
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocker():
+            started.set()
+            release.wait()
+
+        pool.submit(blocker)
+        started.wait()
+        self.assertTrue(pool.submit(lambda: None))  # 占满队列
+        self.assertFalse(pool.submit(lambda: None))  # 队列已满被丢弃
+        release.set()
+        pool.join()
+        pool.shutdown()
+
+        metrics = pool.metrics()
+        self.assertEqual(metrics['dropped'], 1)
+        self.assertEqual(metrics['processed'], 2)
+
+    def test_block_policy_timeout(self):
+        pool = WorkerPool(workerNum=1, queueSize=1, fullPolicy='block', blockTimeout=0.05).start()
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocker():
+            started.set()
+            release.wait()
+
+        pool.submit(blocker)
+        started.wait()
+        pool.submit(lambda: None)
+        self.assertFalse(pool.submit(lambda: None))
+        release.set()
+        pool.join()
+        pool.shutdown()
+        self.assertEqual(pool.metrics()['dropped'], 1)
+
+    def test_failed_task_counted(self):
+        pool = WorkerPool(workerNum=1, queueSize=10).start()
+
+        def boom():
+            raise RuntimeError('boom')
+
+        pool.submit(boom)
+        pool.join()
+        pool.shutdown()
+        self.assertEqual(pool.metrics()['failed'], 1)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            WorkerPool(fullPolicy='unknown')
+
+    def test_priority_order(self):
+        pool = WorkerPool(workerNum=1, queueSize=10).start()
+        release = threading.Event()
+        started = threading.Event()
+        results = []
+
+        def blocker():
+            started.set()
+            release.wait()
+
+        pool.submit(blocker)
+        started.wait()
+        pool.submit(results.append, 'log1', priority=PRIORITY_LOG)
+        pool.submit(results.append, 'gh', priority=PRIORITY_GH)
+        pool.submit(results.append, 'interactive', priority=PRIORITY_INTERACTIVE)
+        pool.submit(results.append, 'log2', priority=PRIORITY_LOG)
+        pool.submit(results.append, 'admin', priority=PRIORITY_ADMIN)
+        release.set()
+        pool.join()
+        pool.shutdown()
+
+        self.assertEqual(results, ['admin', 'interactive', 'log1', 'log2', 'gh'])
+        classes = pool.metrics()['classes']
+        self.assertEqual(classes['log']['processed'], 3)
+        self.assertEqual(classes['admin']['processed'], 1)
+
+    def test_urgent_priority_not_dropped_when_full(self):
+        pool = WorkerPool(workerNum=1, queueSize=1, fullPolicy='drop', urgentPriority=PRIORITY_INTERACTIVE).start()
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocker():
+            started.set()
+            release.wait()
+
+        pool.submit(blocker)
+        started.wait()
+        self.assertTrue(pool.submit(lambda: None, priority=PRIORITY_LOG))
+        self.assertFalse(pool.submit(lambda: None, priority=PRIORITY_LOG))
+        self.assertTrue(pool.submit(lambda: None, priority=PRIORITY_ADMIN))
+        self.assertTrue(pool.submit(lambda: None, priority=PRIORITY_INTERACTIVE))
+        release.set()
+        pool.join()
+        pool.shutdown()
+        self.assertEqual(pool.metrics()['classes']['log']['dropped'], 1)
+
+class TestClassifyMsg(unittest.TestCase):
+
+    def makeMsg(self, sender='wxid_user', roomid='', content='hello', msgType=1, isAt=False):
+        msg = MagicMock()
+        msg.sender = sender
+        msg.roomid = roomid
+        msg.content = content
+        msg.type = msgType
+        msg.from_group.return_value = roomid.endswith('@chatroom')
+        msg.is_at.return_value = isAt
+        return msg
+
+    def test_classify(self):
+        admins = {'wxid_admin'}
+        words = {'踢', '加白'}
+        room = 'room@chatroom'
+        self.assertEqual(classifyMsg(self.makeMsg(sender='gh_test', msgType=49), 'bot', admins, words), PRIORITY_GH)
+        commands = CommandTable([AdminCommand('addWhiteWord', 'adminAddWhite', ('wxId',))])
+        commands.load({'addWhiteWord': ['加白']})
+        # 超级管理员只有指令才按管理员优先级处理
+        self.assertEqual(classifyMsg(self.makeMsg(sender='wxid_admin', content='加白 room2@chatroom'), 'bot', admins, words, commands), PRIORITY_ADMIN)
+        self.assertEqual(classifyMsg(self.makeMsg(sender='wxid_admin', roomid=room, content='踢'), 'bot', admins, words), PRIORITY_ADMIN)
+        self.assertEqual(classifyMsg(self.makeMsg(sender='wxid_admin', roomid=room), 'bot', admins, words, commands), PRIORITY_LOG)
+        self.assertEqual(classifyMsg(self.makeMsg(sender='wxid_admin'), 'bot', admins, words, commands), PRIORITY_INTERACTIVE)
+        self.assertEqual(classifyMsg(self.makeMsg(roomid=room, content='@张三\u2005踢'), 'bot', admins, words), PRIORITY_ADMIN)
+        self.assertEqual(classifyMsg(self.makeMsg(roomid='wxid_user'), 'bot', admins, words), PRIORITY_INTERACTIVE)
+        self.assertEqual(classifyMsg(self.makeMsg(roomid=room, isAt=True), 'bot', admins, words), PRIORITY_INTERACTIVE)
+        self.assertEqual(classifyMsg(self.makeMsg(roomid=room), 'bot', admins, words), PRIORITY_LOG)
+        self.assertEqual(classifyMsg(self.makeMsg(roomid=room, msgType=3), 'bot', admins, words), PRIORITY_LOG)
+
+class TestLoadShedder(unittest.TestCase):
+
+    def makeMsg(self, age):
+        msg = MagicMock()
+        msg.ts = int(time.time() - age)
+        return msg
+
+    def test_judge(self):
+        shedder = LoadShedder(maxMsgAge=60, overloadDepth=100)
+        self.assertEqual(shedder.judge(self.makeMsg(1), PRIORITY_INTERACTIVE, 0), SHED_NONE)
+        self.assertEqual(shedder.judge(self.makeMsg(120), PRIORITY_INTERACTIVE, 0), SHED_STALE)
+        self.assertEqual(shedder.judge(self.makeMsg(1), PRIORITY_LOG, 100), SHED_OVERLOAD)
+        # 管理员指令从不降级
+        self.assertEqual(shedder.judge(self.makeMsg(120), PRIORITY_ADMIN, 1000), SHED_NONE)
+        self.assertEqual(shedder.metrics(), {SHED_STALE: {'interactive': 1}, SHED_OVERLOAD: {'log': 1}})
+
+    def test_disabled(self):
+        shedder = LoadShedder(maxMsgAge=0, overloadDepth=0)
+        self.assertEqual(shedder.judge(self.makeMsg(10000), PRIORITY_LOG, 10000), SHED_NONE)
+        self.assertEqual(shedder.metrics(), {})
+
+class TestMsgDeduper(unittest.TestCase):
+
+    def makeMsg(self, msgId):
+        msg = MagicMock()
+        msg.id = msgId
+        return msg
+
+    def test_duplicate_suppressed(self):
+        deduper = MsgDeduper(maxSize=10, window=60)
+        self.assertFalse(deduper.isDuplicate(self.makeMsg(1)))
+        self.assertFalse(deduper.isDuplicate(self.makeMsg(2)))
+        self.assertTrue(deduper.isDuplicate(self.makeMsg(1)))
+        # 没有 id 的消息不参与过滤
+        self.assertFalse(deduper.isDuplicate(self.makeMsg(0)))
+        self.assertFalse(deduper.isDuplicate(self.makeMsg(0)))
+        self.assertEqual(deduper.metrics(), {'checked': 3, 'suppressed': 1, 'size': 2})
+
+    def test_bounded_size(self):
+        deduper = MsgDeduper(maxSize=3, window=0)
+        for msgId in range(1, 5):
+            deduper.isDuplicate(self.makeMsg(msgId))
+        # 最早的 1 已被淘汰
+        self.assertFalse(deduper.isDuplicate(self.makeMsg(1)))
+        self.assertTrue(deduper.isDuplicate(self.makeMsg(4)))
+        self.assertEqual(deduper.metrics()['size'], 3)
+
+    def test_window_expire(self):
+        deduper = MsgDeduper(maxSize=10, window=0.05)
+        deduper.isDuplicate(self.makeMsg(1))
+        time.sleep(0.1)
+        self.assertFalse(deduper.isDuplicate(self.makeMsg(1)))
+
+class TestLaneExecutor(unittest.TestCase):
+
+    def test_same_key_runs_in_order(self):
+        executor = LaneExecutor(laneNum=4, queueSize=100).start()
+        results = []
+
+        def task(i):
+            # 前面的任务更慢, 如果并行执行则顺序会乱
+            time.sleep(0.001 * (10 - i))
+            results.append(i)
+
+        for i in range(10):
+            executor.submit('room1@chatroom', task, i)
+        executor.join()
+        executor.shutdown()
+        self.assertEqual(results, list(range(10)))
+
+    def test_same_key_keeps_order_across_priorities(self):
+        executor = LaneExecutor(laneNum=1, queueSize=10).start()
+        release = threading.Event()
+        started = threading.Event()
+        results = []
+
+        def blocker():
+            started.set()
+            release.wait()
+
+        executor.submit('busy', blocker)
+        started.wait()
+        # 同一会话内后到的高优先级消息不插队, 但整个会话排到低优先级会话前面
+        executor.submit('roomA', results.append, 'a-log', priority=PRIORITY_LOG)
+        executor.submit('roomB', results.append, 'b-log', priority=PRIORITY_LOG)
+        executor.submit('roomA', results.append, 'a-interactive', priority=PRIORITY_INTERACTIVE)
+        executor.submit('roomC', results.append, 'c-gh', priority=PRIORITY_GH)
+        executor.submit('roomC', results.append, 'c-admin', priority=PRIORITY_ADMIN)
+        self.assertEqual(executor.depth(), 5)
+        release.set()
+        executor.join()
+        executor.shutdown()
+        self.assertEqual(results, ['c-gh', 'c-admin', 'a-log', 'a-interactive', 'b-log'])
+        self.assertEqual(executor.lanes[0].keyTasks, {})
+
+    def test_urgent_lane(self):
+        executor = LaneExecutor(laneNum=1, queueSize=10, urgentPriority=PRIORITY_ADMIN).start()
+        release = threading.Event()
+        started = threading.Event()
+        done = threading.Event()
+
+        def blocker():
+            started.set()
+            release.wait()
+
+        executor.submit('room1@chatroom', blocker, priority=PRIORITY_INTERACTIVE)
+        started.wait()
+        # 同一会话的管理员命令不排在耗时任务后面
+        executor.submit('room1@chatroom', done.set, priority=PRIORITY_ADMIN)
+        self.assertTrue(done.wait(1))
+        release.set()
+        executor.join()
+        executor.shutdown()
+        metrics = executor.metrics()
+        self.assertEqual(metrics['processed'], 2)
+        self.assertEqual(len(metrics['lanes']), 1)
+        self.assertEqual(metrics['urgentLane']['processed'], 1)
+
+    def test_different_keys_run_in_parallel(self):
+        executor = LaneExecutor(laneNum=2, queueSize=10).start()
+        keyA, keyB = 'a', 'b'
+        # 找到落在不同通道的两个 key
+        while executor.laneIndex(keyA) == executor.laneIndex(keyB):
+            keyB += 'b'
+        barrier = threading.Barrier(2, timeout=2)
+        passed = []
+
+        def task():
+            barrier.wait()
+            passed.append(True)
+
+        executor.submit(keyA, task)
+        executor.submit(keyB, task)
+        executor.join()
+        executor.shutdown()
+        self.assertEqual(len(passed), 2)
+
+    def test_lane_metrics(self):
+        executor = LaneExecutor(laneNum=3, queueSize=10).start()
+        for key in ['r1', 'r2', 'r3', 'r1']:
+            executor.submit(key, lambda: None)
+        executor.join()
+        executor.shutdown()
+        metrics = executor.metrics()
+        self.assertEqual(metrics['submitted'], 4)
+        self.assertEqual(metrics['processed'], 4)
+        self.assertEqual(len(metrics['lanes']), 3)
+        self.assertEqual(sum(m['processed'] for m in metrics['lanes']), 4)
+        self.assertGreaterEqual(metrics['lanes'][executor.laneIndex('r1')]['processed'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import tempfile
+import time
+import os
+import sys
+from queue import Empty
+from unittest.mock import MagicMock, patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.fake_wcf import FakeWcf
+from utils.wxmsg import LiteMsg
+from servers.msg_server import MsgHandler
+
+class TestFakeWcf(unittest.TestCase):
+
+    def setUp(self):
+        self.wcf = FakeWcf(seed=1)
+        self.wcf.addContact('wxid_user', '张三')
+        self.wcf.addRoom('room@chatroom', '测试群', {'wxid_a': '小A', 'wxid_b': ''})
+
+    def tearDown(self):
+        self.wcf.cleanup()
+
+    def test_send_recorded(self):
+        self.assertEqual(self.wcf.send_text('你好', 'wxid_user'), 0)
+        self.assertEqual(self.wcf.send_image('a.jpg', 'room@chatroom'), 0)
+        self.assertEqual([item['content'] for item in self.wcf.sentTo('wxid_user')], ['你好'])
+        self.assertEqual(self.wcf.metrics()['sent'], 2)
+
+    def test_query_sql_contact(self):
+        rows = self.wcf.query_sql('MicroMsg.db', "SELECT NickName FROM Contact WHERE UserName = 'wxid_user';")
+        self.assertEqual(rows, [{'NickName': '张三'}])
+        self.assertEqual(self.wcf.query_sql('MSG0.db', 'SELECT 1'), [])
+
+    def test_room_members(self):
+        self.assertEqual(self.wcf.get_chatroom_members('room@chatroom'), {'wxid_a': '小A', 'wxid_b': ''})
+        self.assertEqual(self.wcf.get_alias_in_chatroom('wxid_a', 'room@chatroom'), '小A')
+        self.assertEqual(self.wcf.invite_chatroom_members('room@chatroom', 'wxid_user'), 1)
+        self.assertEqual(self.wcf.get_alias_in_chatroom('wxid_user', 'room@chatroom'), '张三')
+        self.assertEqual(self.wcf.del_chatroom_members('room@chatroom', 'wxid_a'), 1)
+        self.assertNotIn('wxid_a', self.wcf.get_chatroom_members('room@chatroom'))
+
+    def test_download_image(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = self.wcf.download_image(123, 'extra', folder)
+            self.assertTrue(os.path.exists(path))
+
+    def test_latency_and_failure(self):
+        wcf = FakeWcf(latency={'send_text': 0.02}, failRate={'send_image': 1}, seed=1)
+        start = time.time()
+        wcf.send_text('hi', 'wxid_user')
+        self.assertGreaterEqual(time.time() - start, 0.02)
+        self.assertEqual(wcf.send_image('a.jpg', 'wxid_user'), -1)
+        metrics = wcf.metrics()
+        self.assertEqual(metrics['failures'], {'send_image': 1})
+        self.assertEqual(metrics['sent'], 1)
+        wcf.cleanup()
+
+    def test_get_msg(self):
+        msg = LiteMsg(id=1, type=1, sender='wxid_user', content='hi')
+        self.wcf.feed(msg)
+        self.assertIs(self.wcf.get_msg(), msg)
+        with self.assertRaises(Empty):
+            self.wcf.get_msg(block=False)
+
+    @patch('servers.msg_server.returnConfigData', return_value={
+        'Administrators': [], 'adminFunctionWord': {}, 'roomKeyWord': {}, 'systemConfig': {'robotName': 'TestBot'}})
+    @patch('servers.msg_server.ApiServer')
+    @patch('servers.msg_server.LLMResponseApi')
+    @patch('servers.msg_server.LLMTaskApi')
+    @patch('servers.msg_server.DbMsgServer')
+    @patch('servers.msg_server.DbRoomServer')
+    @patch('servers.msg_server.DbUserServer')
+    def test_msg_handler_with_fake_wcf(self, *mocks):
+        handler = MsgHandler(self.wcf)
+        self.assertEqual(handler.wxname, '机器人')
+        self.assertEqual(handler.getWxName('room@chatroom'), '测试群')
+        self.assertEqual(handler.getWxId('张三'), 'wxid_user')
+
+if __name__ == '__main__':
+    unittest.main()
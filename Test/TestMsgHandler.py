@@ -1,6 +1,10 @@
 import unittest
+import time
+import asyncio
 from unittest.mock import MagicMock, patch
-from servers.msg_server import MsgHandler
+from servers.msg_server import MsgHandler, RoomMsgHandler
+from servers.trigger_server import compileTriggers, triggerRegistry
+from servers.dispatch_server import LoadShedder, SHED_STALE
 from utils.prompt import intentions_list
 import xml.etree.ElementTree as ET
 
@@ -18,6 +22,7 @@ class TestMsgHandler(unittest.TestCase):
         self.mock_dus = MagicMock()
         self.mock_drs = MagicMock()
         self.mock_dms = MagicMock()
+        self.mock_rt = MagicMock()
 
         # Mock the API server classes
         self.mock_lta = MagicMock()
@@ -37,6 +42,7 @@ class TestMsgHandler(unittest.TestCase):
         self.patch_dus = patch('servers.msg_server.DbUserServer', return_value=self.mock_dus)
         self.patch_drs = patch('servers.msg_server.DbRoomServer', return_value=self.mock_drs)
         self.patch_dms = patch('servers.msg_server.DbMsgServer', return_value=self.mock_dms)
+        self.patch_rt = patch('servers.msg_server.routeTable', new=self.mock_rt)
         self.patch_lta = patch('servers.msg_server.LLMTaskApi', return_value=self.mock_lta)
         self.patch_lra = patch('servers.msg_server.LLMResponseApi', return_value=self.mock_lra)
         self.patch_aps = patch('servers.msg_server.ApiServer', return_value=self.mock_aps)
@@ -46,6 +52,7 @@ class TestMsgHandler(unittest.TestCase):
         self.patch_dus.start()
         self.patch_drs.start()
         self.patch_dms.start()
+        self.patch_rt.start()
         self.patch_lta.start()
         self.patch_lra.start()
         self.patch_aps.start()
@@ -59,6 +66,7 @@ class TestMsgHandler(unittest.TestCase):
         self.patch_dus.stop()
         self.patch_drs.stop()
         self.patch_dms.stop()
+        self.patch_rt.stop()
         self.patch_lta.stop()
         self.patch_lra.stop()
         self.patch_aps.stop()
@@ -71,15 +79,19 @@ class TestMsgHandler(unittest.TestCase):
     def test_getWxName(self):
         name = self.msg_handler.getWxName('test_wxid')
         self.assertEqual(name, 'Test User')
+        # 批量加载中没有时单独查询一次并补进索引
         self.mock_wcf.query_sql.assert_called_with("MicroMsg.db",
-                                                "SELECT NickName FROM Contact WHERE UserName = 'test_wxid';")
+                                                "SELECT UserName, NickName, Remark FROM Contact WHERE UserName = 'test_wxid';")
+        self.mock_wcf.query_sql.reset_mock()
+        self.assertEqual(self.msg_handler.getWxName('test_wxid'), 'Test User')
+        self.mock_wcf.query_sql.assert_not_called()
 
     def test_getWxId(self):
         self.mock_wcf.query_sql.return_value = [{'UserName': 'wxid_test'}]
         wxid = self.msg_handler.getWxId('test_wxname')
         self.assertEqual(wxid, 'wxid_test')
         self.mock_wcf.query_sql.assert_called_with("MicroMsg.db",
-                                                "SELECT UserName FROM Contact WHERE NickName = 'test_wxname';")
+                                                "SELECT UserName, NickName, Remark FROM Contact WHERE NickName = 'test_wxname';")
 
     def test_getAtData(self):
         # Mock the message object and its attributes
@@ -136,7 +148,8 @@ class TestMsgHandler(unittest.TestCase):
         chatid = 'test_chat_id'
         self.mock_aps.get_yuanqi.return_value = 'test response'
 
-        result = self.msg_handler.triggerFunction(mock_msg, 'gzhRetrive', ['gzh'], chatid)
+        self.msg_handler.triggerTrie = compileTriggers({'gzhRetrive': ['gzh']})
+        result = self.msg_handler.runTriggers(mock_msg, chatid)
 
         self.assertTrue(result)
         self.mock_aps.get_yuanqi.assert_called_with('gzh test content')
@@ -150,7 +163,8 @@ class TestMsgHandler(unittest.TestCase):
         self.mock_lta.difySearch.return_value = 'test response'
         self.mock_wcf.send_text.return_value = 0
 
-        result = self.msg_handler.triggerFunction(mock_msg, 'difySearch', ['search'], chatid)
+        self.msg_handler.triggerTrie = compileTriggers({'difySearch': ['search']})
+        result = self.msg_handler.runTriggers(mock_msg, chatid)
 
         self.assertTrue(result)
         self.mock_lta.difySearch.assert_called_with('search test content', user='TestBot')
@@ -162,7 +176,8 @@ class TestMsgHandler(unittest.TestCase):
         mock_msg.content = '挂牌12345'
         self.mock_wcf.send_text.return_value = 0
 
-        result = self.msg_handler.triggerFunction(mock_msg, 'beikeRetrive', ['挂牌', '成交'], 'test_chat_id')
+        self.msg_handler.triggerTrie = compileTriggers({'beikeRetrive': ['挂牌', '成交']})
+        result = self.msg_handler.runTriggers(mock_msg, 'test_chat_id')
 
         self.assertTrue(result)
         self.mock_wcf.send_text.assert_called_with(msg='https://yc.ke.com/ershoufang/12345.html', receiver=mock_msg.sender)
@@ -172,7 +187,8 @@ class TestMsgHandler(unittest.TestCase):
         mock_msg.content = '成交12345'
         self.mock_wcf.send_text.return_value = 0
 
-        result = self.msg_handler.triggerFunction(mock_msg, 'beikeRetrive', ['挂牌', '成交'], 'test_chat_id')
+        self.msg_handler.triggerTrie = compileTriggers({'beikeRetrive': ['挂牌', '成交']})
+        result = self.msg_handler.runTriggers(mock_msg, 'test_chat_id')
 
         self.assertTrue(result)
         self.mock_wcf.send_text.assert_called_with(msg='https://yc.ke.com/chengjiao/12345.html', receiver=mock_msg.sender)
@@ -182,7 +198,8 @@ class TestMsgHandler(unittest.TestCase):
         mock_msg.content = 'unknown test content'
         self.mock_wcf.send_text.return_value = 0
 
-        result = self.msg_handler.triggerFunction(mock_msg, 'unknown', ['unknown'], 'test_chat_id')
+        self.msg_handler.triggerTrie = compileTriggers({'unknown': ['unknown']})
+        result = self.msg_handler.runTriggers(mock_msg, 'test_chat_id')
 
         self.assertTrue(result)
         self.mock_wcf.send_text.assert_called_with(msg='[-]: 未知的触发器类型: unknown, 请检查配置', receiver=mock_msg.sender)
@@ -200,4 +217,92 @@ class TestMsgHandler(unittest.TestCase):
         self.assertEqual(result, conId)
 
         # Test get after setting
-        result = self.msg_
\ No newline at end of file
+        result = self.msg_
+
+    def test_coreFunction_async_runtime_submit(self):
+        mock_runtime = MagicMock()
+        self.msg_handler.asyncRuntime = mock_runtime
+        mock_msg = MagicMock()
+        mock_msg.from_group.return_value = False
+        mock_msg.sender = 'test_sender'
+
+        self.msg_handler.coreFunction(mock_msg)
+
+        mock_runtime.submit.assert_called_once()
+        self.assertEqual(mock_runtime.submit.call_args.kwargs['key'], 'test_sender')
+        mock_runtime.submit.call_args.args[0].close()
+        self.mock_lra.intentionRec.assert_not_called()
+
+    def test_coreFunctionAsync_general_response(self):
+        mock_alra = MagicMock()
+        mock_alra.get_conversation_list.return_value = []
+
+        async def intentionRec(messages):
+            return '其它'
+
+        async def generalResponse(messages, bot_name):
+            return 'async response'
+
+        mock_alra.intentionRec = intentionRec
+        mock_alra.generalResponse = generalResponse
+        self.msg_handler.alra = mock_alra
+        self.mock_returnConfigData.return_value['customKeyWord'] = {}
+        mock_msg = MagicMock()
+        mock_msg.from_group.return_value = False
+        mock_msg.sender = 'test_sender'
+        mock_msg.content = 'hello'
+
+        asyncio.run(self.msg_handler.coreFunctionAsync(mock_msg))
+
+        self.mock_wcf.send_text.assert_called_with(msg='async response', receiver='test_sender')
+        mock_alra.updateMessage.assert_called_with('test_sender', ['hello', 'async response'])
+        self.mock_dms.addChatMessage.assert_called_with('test_wxid', 'TestBot', 'test_sender', 'async response')
+
+    def test_coreFunctionAsync_stale_after_queueing(self):
+        mock_alra = MagicMock()
+        self.msg_handler.alra = mock_alra
+        self.msg_handler.shedder = LoadShedder(maxMsgAge=60, busyReply='忙')
+        mock_msg = MagicMock()
+        mock_msg.from_group.return_value = False
+        mock_msg.sender = 'test_sender'
+        # 协程排到时消息已超过 maxMsgAge
+        mock_msg.ts = time.time() - 120
+
+        asyncio.run(self.msg_handler.coreFunctionAsync(mock_msg))
+
+        mock_alra.get_conversation_list.assert_not_called()
+        self.mock_wcf.send_text.assert_called_with(msg='忙', receiver='test_sender')
+        self.assertEqual(self.msg_handler.shedder.metrics(), {SHED_STALE: {'interactive': 1}})
+
+
+    def test_room_shedHandle_logs_and_replies_busy(self):
+        handler = RoomMsgHandler(self.mock_wcf)
+        self.mock_rt.isWhiteRoom.return_value = True
+        self.mock_wcf.send_text.return_value = 0
+        mock_msg = MagicMock()
+        mock_msg.type = 1
+        mock_msg.sender = 'test_sender'
+        mock_msg.roomid = 'test_room@chatroom'
+        mock_msg.content = '@TestBot 在吗'
+        mock_msg.from_group.return_value = True
+        mock_msg.is_at.return_value = True
+
+        handler.shedHandle(mock_msg, 'busy')
+
+        self.mock_dms.addChatMessage.assert_called_with('test_sender', 'Test User', 'test_room@chatroom', '@TestBot 在吗')
+        self.mock_wcf.send_text.assert_called_with(msg='@Test Alias busy', receiver='test_room@chatroom', aters='test_sender')
+        self.mock_lra.intentionRec.assert_not_called()
+
+    def test_runTriggers_registered(self):
+        mock_msg = MagicMock()
+        mock_msg.content = 'gzh 猴哥'
+        with patch.dict('servers.msg_server.triggerRegistry', {'gzhRetrive': MagicMock()}) as registry:
+            self.msg_handler.triggerTrie = compileTriggers({'gzhRetrive': ['gzh']})
+            self.assertTrue(self.msg_handler.runTriggers(mock_msg, 'test_chat_id'))
+            registry['gzhRetrive'].assert_called_once_with(self.msg_handler, mock_msg, 'gzh 猴哥', 'test_chat_id')
+        mock_msg.content = 'hello'
+        self.assertFalse(self.msg_handler.runTriggers(mock_msg, 'test_chat_id'))
+
+    def test_registered_triggers(self):
+        # 公众号、dify 搜索和贝壳查询依赖外部服务, 默认不注册
+        self.assertEqual(set(triggerRegistry), {'KfcKeyWords', 'TopWords'})
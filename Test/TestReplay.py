@@ -0,0 +1,98 @@
+import unittest
+import json
+import tempfile
+import time
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.wxmsg import LiteMsg, packMsg
+from utils.replay import MsgRecorder, MsgReplayer, readRecording, percentile, isolatedServices
+from utils.fake_wcf import FakeWcf
+
+class FakeExecutor:
+    def join(self):
+        pass
+
+class FakeServer:
+    """
+    同步处理消息的 MainServer 替身
+    """
+    def __init__(self):
+        self.wcf = FakeWcf()
+        self.executor = FakeExecutor()
+        self.handled = []
+
+    def handleMsg(self, handler, msg, priority):
+        self.handled.append(msg)
+        self.wcf.send_text(f'收到: {msg.content}', msg.sender)
+
+    def dispatchMsg(self, msg):
+        # 非文本消息不处理
+        if msg.type == 1:
+            self.handleMsg(None, msg, 1)
+
+    def metrics(self):
+        return {}
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempDir.name, 'record.jsonl')
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def writeRecording(self, msgs):
+        recorder = MsgRecorder(self.path)
+        for msg in msgs:
+            recorder.record(msg)
+        recorder.close()
+
+    def test_record_and_read(self):
+        msg = LiteMsg(id=1, type=1, ts=int(time.time()), sender='wxid_user', roomid='room@chatroom',
+                      content='你好', xml='<msgsource />', is_group=True)
+        self.writeRecording([msg])
+        records = list(readRecording(self.path))
+        self.assertEqual(len(records), 1)
+        recvTime, restored = records[0]
+        self.assertAlmostEqual(recvTime, time.time(), delta=5)
+        self.assertEqual((restored.id, restored.content, restored.xml), (1, '你好', '<msgsource />'))
+        self.assertTrue(restored.from_group())
+
+    def test_replay_report(self):
+        # 一小时前录制的消息
+        oldTs = int(time.time()) - 3600
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for i in range(10):
+                msg = LiteMsg(id=i, type=1 if i % 2 == 0 else 3, ts=oldTs, sender='wxid_user', roomid='wxid_user', content=str(i))
+                f.write(json.dumps([oldTs + 0.5, *packMsg(msg)]) + '\n')
+        server = FakeServer()
+        report = MsgReplayer(server, speed=0).replay(self.path)
+        self.assertEqual(report['messages'], 10)
+        self.assertEqual(report['handled'], 5)
+        self.assertEqual(report['sent'], 5)
+        # 消息时间平移到回放时刻
+        self.assertGreater(server.handled[0].ts, oldTs + 3000)
+        self.assertLessEqual(report['p50'], report['p99'])
+
+    def test_isolated_services(self):
+        import requests
+        from servers import db_server, api_server
+        realUserDb = db_server.userDb
+        with isolatedServices(self.tempDir.name, llmLatency=0, httpLatency=0):
+            # 数据库指向临时目录, LLM 和 HTTP 不访问外部服务
+            self.assertEqual(db_server.userDb, os.path.join(self.tempDir.name, 'user.db'))
+            self.assertEqual(api_server.unillm(['model'], [{'role': 'user', 'content': '你好'}]), '好的, 这是回放回复')
+            self.assertEqual(requests.get('http://example.invalid/').status_code, 200)
+        self.assertEqual(db_server.userDb, realUserDb)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 51)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 95), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
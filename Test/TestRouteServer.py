@@ -0,0 +1,106 @@
+import unittest
+import os
+import sys
+import sqlite3
+import time
+import threading
+from unittest.mock import MagicMock, patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from servers.route_server import RouteTable
+
+class TestRouteTable(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_dus = MagicMock()
+        self.mock_drs = MagicMock()
+        self.mock_drs.showWhiteRoom.return_value = [('white@chatroom', '白名单群')]
+        self.mock_drs.showResponseRoom.return_value = [('white@chatroom', '白名单群')]
+        self.mock_dus.showUser.return_value = [('wxid_user', '好友')]
+        self.mock_dus.showAdmin.return_value = [('wxid_admin', 'other@chatroom')]
+        self.patch_dus = patch('servers.route_server.DbUserServer', return_value=self.mock_dus)
+        self.patch_drs = patch('servers.route_server.DbRoomServer', return_value=self.mock_drs)
+        self.patch_dus.start()
+        self.patch_drs.start()
+        self.route_table = RouteTable()
+
+    def tearDown(self):
+        self.patch_dus.stop()
+        self.patch_drs.stop()
+
+    def makeMsg(self, sender, roomid, msgType=1):
+        msg = MagicMock()
+        msg.sender = sender
+        msg.roomid = roomid
+        msg.type = msgType
+        return msg
+
+    def test_lookup(self):
+        self.assertTrue(self.route_table.isWhiteRoom('white@chatroom'))
+        self.assertFalse(self.route_table.isWhiteRoom('other@chatroom'))
+        self.assertTrue(self.route_table.isResponseRoom('white@chatroom'))
+        self.assertTrue(self.route_table.isWhiteUser('wxid_user'))
+        self.assertTrue(self.route_table.isAdmin('wxid_admin', 'other@chatroom'))
+        self.assertFalse(self.route_table.isAdmin('wxid_admin', 'white@chatroom'))
+        # 只在首次查询时加载一次
+        self.assertEqual(self.mock_drs.showWhiteRoom.call_count, 1)
+
+    def test_acceptRoomMsg(self):
+        self.assertTrue(self.route_table.acceptRoomMsg(self.makeMsg('wxid_x', 'white@chatroom')))
+        self.assertFalse(self.route_table.acceptRoomMsg(self.makeMsg('wxid_x', 'other@chatroom')))
+        self.assertTrue(self.route_table.acceptRoomMsg(self.makeMsg('wxid_admin', 'other@chatroom')))
+        self.assertTrue(self.route_table.acceptRoomMsg(self.makeMsg('wxid_super', 'other@chatroom'), superAdmins={'wxid_super'}))
+        self.assertTrue(self.route_table.acceptRoomMsg(self.makeMsg('other@chatroom', 'other@chatroom', msgType=10000)))
+
+    def test_refresh(self):
+        self.assertFalse(self.route_table.isWhiteRoom('new@chatroom'))
+        self.mock_drs.showWhiteRoom.return_value = [('new@chatroom', '新群')]
+        self.route_table.refresh()
+        self.assertTrue(self.route_table.isWhiteRoom('new@chatroom'))
+        self.assertFalse(self.route_table.isWhiteRoom('white@chatroom'))
+
+    def test_refresh_failure_keeps_tables(self):
+        self.assertTrue(self.route_table.isWhiteRoom('white@chatroom'))
+        self.mock_dus.showAdmin.side_effect = sqlite3.OperationalError('database is locked')
+        self.assertFalse(self.route_table.refresh())
+        self.assertTrue(self.route_table.isWhiteRoom('white@chatroom'))
+        self.assertTrue(self.route_table.isAdmin('wxid_admin', 'other@chatroom'))
+        # 失败后按 retryDelay 重试, 而不是每条消息都访问数据库
+        self.route_table.maxAge = 60
+        self.route_table.retryDelay = 0
+        self.mock_dus.showAdmin.side_effect = None
+        self.mock_drs.showWhiteRoom.return_value = [('new@chatroom', '新群')]
+        self.assertTrue(self.route_table.isWhiteRoom('new@chatroom'))
+
+    def test_expired_table_reloads(self):
+        self.route_table.maxAge = 0
+        self.route_table.isWhiteRoom('white@chatroom')
+        self.route_table.isWhiteRoom('white@chatroom')
+        self.assertGreaterEqual(self.mock_drs.showWhiteRoom.call_count, 2)
+
+    def test_concurrent_expiry_loads_once(self):
+        rooms = self.mock_drs.showWhiteRoom.return_value
+
+        def slowShowWhiteRoom(raiseError=False):
+            time.sleep(0.1)
+            return rooms
+
+        self.mock_drs.showWhiteRoom.side_effect = slowShowWhiteRoom
+        barrier = threading.Barrier(8)
+        results = []
+
+        def lookup():
+            barrier.wait()
+            results.append(self.route_table.isWhiteRoom('white@chatroom'))
+
+        threads = [threading.Thread(target=lookup) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 同时过期的线程只加载一次, 且都能拿到新表
+        self.assertEqual(self.mock_drs.showWhiteRoom.call_count, 1)
+        self.assertEqual(results, [True] * 8)
+
+if __name__ == '__main__':
+    unittest.main()
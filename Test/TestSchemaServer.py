@@ -0,0 +1,113 @@
+import unittest
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from servers.schema_server import SchemaMigrator, Migration, Backfill
+
+class TestSchemaMigrator(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.dbPath = os.path.join(self.tempDir.name, 'message.db')
+        conn = sqlite3.connect(self.dbPath)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE chatMessage (id INTEGER PRIMARY KEY AUTOINCREMENT, roomId varchar(255), createTime datetime DEFAULT CURRENT_TIMESTAMP)')
+        conn.executemany('INSERT INTO chatMessage (roomId, createTime) VALUES (?, ?)',
+                         [(f'room{i % 10}@chatroom', f'2025-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}') for i in range(12000)])
+        conn.commit()
+        conn.close()
+        self.migrations = [
+            Migration(1, '时间戳', ['ALTER TABLE chatMessage ADD COLUMN createTs INTEGER']),
+            Migration(2, '索引', ['CREATE INDEX idx_room ON chatMessage (roomId, createTime)'], online=True),
+            Migration(3, '回填时间戳', backfill=Backfill('chatMessage', "createTs = CAST(strftime('%s', createTime) AS INTEGER)", 'createTs IS NULL'), online=True),
+        ]
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def query(self, sql):
+        conn = sqlite3.connect(self.dbPath)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_sync_then_online(self):
+        migrator = SchemaMigrator(self.dbPath, self.migrations, chunkSize=1000, pause=0.01)
+        migrator.run()
+        # 返回时同步步骤已完成, 建索引和回填在后台执行
+        columns = [row[1] for row in self.query('PRAGMA table_info(chatMessage)')]
+        self.assertIn('createTs', columns)
+        migrator.join(10)
+        self.assertEqual(self.query('SELECT version FROM schema_version ORDER BY version'), [(1, ), (2, ), (3, )])
+        self.assertEqual(self.query('SELECT COUNT(*) FROM chatMessage WHERE createTs IS NULL'), [(0, )])
+        self.assertEqual(migrator.metrics(), {'version': 3, 'pending': [], 'failed': {}, 'backfilled': 12000})
+        # 再次执行不会重复升级
+        again = SchemaMigrator(self.dbPath, self.migrations).run(background=False)
+        self.assertEqual(again.metrics()['backfilled'], 0)
+        self.assertEqual(self.query('SELECT COUNT(*) FROM schema_version'), [(3, )])
+
+    def test_backfill_not_blocking_writer(self):
+        migrator = SchemaMigrator(self.dbPath, self.migrations, chunkSize=500, pause=0.01).run()
+        conn = sqlite3.connect(self.dbPath, timeout=1)
+        # 回填期间其他连接仍能写入, 不会等到回填结束
+        waits = []
+        while migrator.thread.is_alive():
+            start = time.time()
+            with conn:
+                # 同步步骤已加上 createTs, 新写入的行自带时间戳
+                conn.execute('INSERT INTO chatMessage (roomId, createTs) VALUES (?, ?)', ('new@chatroom', int(time.time())))
+            waits.append(time.time() - start)
+            time.sleep(0.005)
+        conn.close()
+        migrator.join()
+        self.assertGreater(len(waits), 1)
+        self.assertLess(max(waits), 0.5)
+        self.assertEqual(self.query('SELECT COUNT(*) FROM chatMessage WHERE createTs IS NULL'), [(0, )])
+
+    def test_strict_version_order(self):
+        migrations = [
+            Migration(1, '索引', ['CREATE INDEX idx_room ON chatMessage (roomId, createTime)'], online=True),
+            Migration(2, '依赖版本1的同步步骤', ['DROP INDEX idx_room']),
+            Migration(3, '回填', backfill=Backfill('chatMessage', "roomId = roomId", '1'), online=True),
+        ]
+        migrator = SchemaMigrator(self.dbPath, migrations, chunkSize=1000, pause=0.01).run()
+        # 排在 online 步骤之后的同步步骤推迟到后台线程, 不会先于版本1执行
+        self.assertNotIn(2, migrator.metrics()['failed'])
+        migrator.join(10)
+        self.assertEqual(self.query('SELECT version FROM schema_version ORDER BY rowid'), [(1, ), (2, ), (3, )])
+        self.assertEqual(migrator.metrics()['failed'], {})
+
+    def test_version_contiguous(self):
+        migrator = SchemaMigrator(self.dbPath, self.migrations)
+        # 版本1未完成时, 已执行的版本2、3不算
+        migrator.applied = {2, 3}
+        self.assertEqual(migrator.metrics()['version'], 0)
+        migrator.applied = {1, 3}
+        self.assertEqual(migrator.metrics()['version'], 1)
+
+    def test_failed_step_stops(self):
+        migrations = [
+            Migration(1, '错误', ['ALTER TABLE notExist ADD COLUMN a INTEGER']),
+            Migration(2, '不会执行', ['CREATE TABLE t (a INTEGER)']),
+            Migration(3, '依赖错误步骤', ['CREATE INDEX idx_a ON t (a)'], online=True),
+        ]
+        migrator = SchemaMigrator(self.dbPath, migrations).run()
+        migrator.join(5)
+        metrics = migrator.metrics()
+        self.assertEqual((metrics['version'], metrics['pending']), (0, [2, 3]))
+        self.assertIn(1, metrics['failed'])
+        self.assertEqual(self.query("SELECT name FROM sqlite_master WHERE name IN ('t', 'idx_a')"), [])
+
+    def test_on_connect(self):
+        seen = []
+        SchemaMigrator(self.dbPath, [], onConnect=lambda conn: seen.append(conn)).run()
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(self.query('SELECT COUNT(*) FROM schema_version'), [(0, )])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import unittest
+import time
+import threading
+import os
+import sys
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.fake_wcf import FakeWcf
+from servers.dispatch_server import PRIORITY_LOG
+from servers.send_server import TokenBucket, SendServer, QueuedWcf, BroadcastEngine, SEND_SENT, SEND_FAILED, SEND_DROPPED
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=100, burst=3)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0] * 3)
+        self.assertAlmostEqual(bucket.reserve(), 0.01, delta=0.005)
+        self.assertEqual(TokenBucket(rate=0).reserve(), 0.0)
+
+class TestSendServer(unittest.TestCase):
+
+    def setUp(self):
+        self.wcf = FakeWcf(seed=1)
+        self.server = SendServer(self.wcf, rate=0, laneNum=2, backoffBase=0.01, backoffMax=0.02).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.wcf.cleanup()
+
+    def test_order_per_receiver(self):
+        queued = QueuedWcf(self.wcf, self.server)
+        for i in range(20):
+            self.assertEqual(queued.send_text(f'a{i}', 'wxid_a'), 0)
+            self.assertEqual(queued.send_text(f'b{i}', 'room@chatroom', aters='wxid_a'), 0)
+        self.assertEqual(queued.forward_msg(1, 'wxid_a'), 1)
+        self.server.join()
+        self.assertEqual([item['content'] for item in self.wcf.sentTo('wxid_a')], [f'a{i}' for i in range(20)] + [1])
+        self.assertEqual([item['content'] for item in self.wcf.sentTo('room@chatroom')], [f'b{i}' for i in range(20)])
+        self.assertEqual(self.server.metrics()['sent'], 41)
+        # 其他接口直接调用原 Wcf
+        self.assertEqual(queued.get_self_wxid(), 'wxid_fakebot')
+
+    def test_retry_with_backoff(self):
+        wcf = MagicMock()
+        wcf.send_text.side_effect = [-1, Exception('超时'), 0]
+        server = SendServer(wcf, rate=0, laneNum=1, backoffBase=0.01, backoffMax=0.02).start()
+        task = server.submit('send_text', {'msg': 'hi', 'receiver': 'wxid_a'})
+        self.assertTrue(task.wait(2))
+        self.assertEqual((task.status, task.attempts), (SEND_SENT, 3))
+        self.assertEqual(server.metrics()['retries'], 2)
+        server.shutdown()
+
+    def test_give_up(self):
+        wcf = MagicMock()
+        wcf.send_image.return_value = -1
+        server = SendServer(wcf, rate=0, laneNum=1, maxRetries=1, backoffBase=0.01).start()
+        task = server.submit('send_image', {'path': 'a.jpg', 'receiver': 'wxid_a'}, priority=PRIORITY_LOG)
+        task.wait(2)
+        self.assertEqual(server.status(task.taskId)['status'], SEND_FAILED)
+        self.assertEqual(wcf.send_image.call_count, 2)
+        self.assertEqual(server.metrics()['failed'], 1)
+        server.shutdown()
+
+    def test_retry_not_blocking_lane(self):
+        wcf = MagicMock()
+        wcf.send_text.side_effect = lambda msg, receiver, aters='': -1 if receiver == 'bad' else 0
+        server = SendServer(wcf, rate=0, laneNum=1, maxRetries=2, backoffBase=0.3, backoffMax=0.3, jitter=0).start()
+        bad = server.submit('send_text', {'msg': 'hi', 'receiver': 'bad'})
+        good = server.submit('send_text', {'msg': 'hi', 'receiver': 'good'})
+        # 同一通道内 bad 退避等待时 good 照常发送
+        self.assertTrue(good.wait(0.2))
+        self.assertEqual(good.status, SEND_SENT)
+        self.assertFalse(bad.done.is_set())
+        server.join()
+        self.assertEqual((bad.status, bad.attempts), (SEND_FAILED, 3))
+        server.shutdown()
+
+    def test_retry_keeps_order(self):
+        wcf = MagicMock()
+        wcf.send_text.side_effect = [-1, 0, 0, 0]
+        server = SendServer(wcf, rate=0, laneNum=1, backoffBase=0.05, backoffMax=0.05).start()
+        tasks = [server.submit('send_text', {'msg': f'a{i}', 'receiver': 'wxid_a'}) for i in range(3)]
+        server.join()
+        self.assertEqual([task.status for task in tasks], [SEND_SENT] * 3)
+        self.assertEqual([c.kwargs['msg'] for c in wcf.send_text.call_args_list], ['a0', 'a0', 'a1', 'a2'])
+        server.shutdown()
+
+    def test_shutdown_drops_retrying(self):
+        wcf = MagicMock()
+        wcf.send_text.return_value = -1
+        server = SendServer(wcf, rate=0, laneNum=1, backoffBase=10, backoffMax=10).start()
+        first = server.submit('send_text', {'msg': 'a0', 'receiver': 'wxid_a'})
+        second = server.submit('send_text', {'msg': 'a1', 'receiver': 'wxid_a'})
+        time.sleep(0.1)
+        server.shutdown(wait=False)
+        self.assertEqual((first.status, second.status), (SEND_DROPPED, SEND_DROPPED))
+        self.assertEqual(wcf.send_text.call_count, 1)
+
+    def test_rate_limit(self):
+        server = SendServer(self.wcf, rate=50, burst=1, laneNum=4).start()
+        start = time.time()
+        for i in range(6):
+            server.submit('send_text', {'msg': str(i), 'receiver': f'wxid_{i}'})
+        server.join()
+        # 突发 1 条, 之后每条间隔 20ms
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        self.assertGreater(server.metrics()['throttled'], 0)
+        server.shutdown()
+
+    def test_backoff_jitter(self):
+        delays = [self.server.backoff(attempt) for attempt in (1, 2, 3)]
+        self.assertLessEqual(delays[0], 0.01)
+        self.assertGreaterEqual(delays[0], 0.005)
+        self.assertLessEqual(delays[2], 0.02)
+
+class SlowWcf:
+    """
+    发送到 slow 群耗时 0.3 秒, 发送到 bad 群总是失败, 记录同时在发送中的数量
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.sent = []
+
+    def send_text(self, msg, receiver, aters=''):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(0.3 if receiver == 'slow@chatroom' else 0.01)
+            if receiver == 'bad@chatroom':
+                return -1
+            with self.lock:
+                self.sent.append(receiver)
+            return 0
+        finally:
+            with self.lock:
+                self.active -= 1
+
+class TestBroadcastEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.wcf = SlowWcf()
+        self.server = SendServer(self.wcf, rate=0, laneNum=4, maxRetries=1, backoffBase=0.01).start()
+        self.rooms = [(f'{i}@chatroom', f'群{i}') for i in range(20)]
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_slow_room_not_blocking(self):
+        rooms = [('slow@chatroom', '慢群'), ('bad@chatroom', '坏群')] + self.rooms
+        report = BroadcastEngine(self.server, maxInFlight=4).broadcast('测试', 'send_text', rooms, msg='早安')
+        self.assertEqual((report['total'], report['sent'], report['failed'], report['pending']), (22, 21, 1, 0))
+        self.assertEqual(report['rooms']['坏群'], SEND_FAILED)
+        self.assertEqual(report['rooms']['慢群'], SEND_SENT)
+        # 逐个发送至少 0.3 + 22 * 0.01 秒
+        self.assertLess(report['duration'], 0.45)
+        self.assertLessEqual(self.wcf.peak, 4)
+
+    def test_max_in_flight(self):
+        BroadcastEngine(self.server, maxInFlight=2).broadcast('测试', 'send_text', self.rooms, msg='早安')
+        self.assertEqual(len(self.wcf.sent), 20)
+        self.assertLessEqual(self.wcf.peak, 2)
+
+    def test_timeout_pending(self):
+        laneIndex = self.server.executor.laneIndex
+        # 选一个与慢群不在同一发送通道的群
+        roomId, roomName = next(room for room in self.rooms if laneIndex(room[0]) != laneIndex('slow@chatroom'))
+        rooms = [('slow@chatroom', '慢群'), (roomId, roomName)]
+        report = BroadcastEngine(self.server, timeout=0.1).broadcast('测试', 'send_text', rooms, msg='早安')
+        self.assertEqual(report['rooms'], {'慢群': 'pending', roomName: SEND_SENT})
+
+    def test_timeout_while_waiting_for_slot(self):
+        # 唯一的发送名额被慢群占住, 截止时间到了后面的群不再提交
+        rooms = [('slow@chatroom', '慢群')] + self.rooms[:3]
+        start = time.time()
+        report = BroadcastEngine(self.server, maxInFlight=1, timeout=0.1).broadcast('测试', 'send_text', rooms, msg='早安')
+        self.assertLess(time.time() - start, 0.25)
+        self.assertEqual((report['total'], report['sent'], report['pending']), (4, 0, 4))
+        self.assertEqual(report['rooms']['群0'], 'pending')
+        self.server.join()
+        self.assertEqual(self.wcf.sent, ['slow@chatroom'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+import pickle
+import threading
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.wxmsg import LiteMsg, packMsg, unpackMsg
+from servers.shard_server import ShardServer, WcfProxy, KIND_ROUTE, ROUTE_CHANGED
+from servers.dispatch_server import PRIORITY_ADMIN, PRIORITY_LOG
+
+class TestLiteMsg(unittest.TestCase):
+
+    def test_pack_roundtrip(self):
+        msg = LiteMsg(id=1, type=1, ts=100, sender='wxid_user', roomid='room@chatroom', content='@bot 你好',
+                      xml='<msgsource><atuserlist>wxid_bot</atuserlist></msgsource>', is_group=True)
+        data = packMsg(msg)
+        # 元组可以直接序列化后跨进程传递
+        restored = unpackMsg(pickle.loads(pickle.dumps(data)))
+        self.assertEqual(packMsg(restored), data)
+        self.assertTrue(restored.from_group())
+        self.assertTrue(restored.is_at('wxid_bot'))
+        self.assertFalse(restored.is_at('wxid_other'))
+
+    def test_is_at_all_excluded(self):
+        msg = LiteMsg(type=1, content='@所有人 开会', xml='<atuserlist>notify@all,wxid_bot</atuserlist>', is_group=True)
+        self.assertFalse(msg.is_at('wxid_bot'))
+        single = LiteMsg(type=1, content='你好', xml='<atuserlist>wxid_bot</atuserlist>')
+        self.assertFalse(single.is_at('wxid_bot'))
+
+class TestShardServer(unittest.TestCase):
+
+    def setUp(self):
+        self.wcf = MagicMock()
+        self.wcf.send_text.return_value = 0
+        self.server = ShardServer(self.wcf, processNum=2, rpcThreads=1)
+        # 只启动调用线程, 子进程由测试代码中的 WcfProxy 代替
+        self.thread = threading.Thread(target=self.server.serveLoop, daemon=True)
+        self.thread.start()
+        self.proxy = WcfProxy(0, self.server.reqQueue, self.server.respQueues[0], timeout=5)
+
+    def tearDown(self):
+        self.server.reqQueue.put(None)
+        self.thread.join()
+        self.proxy.close()
+
+    def test_proxy_call(self):
+        self.assertEqual(self.proxy.send_text('你好', 'wxid_user'), 0)
+        self.wcf.send_text.assert_called_once_with('你好', 'wxid_user')
+        self.assertEqual(self.server.metrics()['calls'], 1)
+
+    def test_proxy_call_error(self):
+        self.wcf.get_alias_in_chatroom.side_effect = Exception('boom')
+        with self.assertRaises(RuntimeError):
+            self.proxy.get_alias_in_chatroom('wxid_user', 'room@chatroom')
+        self.assertEqual(self.server.metrics()['callErrors'], 1)
+
+    @patch('servers.shard_server.routeTable')
+    def test_route_changed_broadcast(self, mock_rt):
+        self.proxy.call(ROUTE_CHANGED)
+        mock_rt.refresh.assert_called_once_with(notify=False)
+        # 只通知其他子进程
+        self.assertEqual(self.server.msgQueues[1].get(timeout=5), (KIND_ROUTE, None, 0))
+        self.assertTrue(self.server.msgQueues[0].empty())
+
+    def test_submit_same_key_same_shard(self):
+        msg = LiteMsg(id=1, type=1, sender='wxid_user', roomid='room@chatroom', content='hi', is_group=True)
+        for _ in range(3):
+            self.server.submit(msg.roomid, 'room', msg, 2)
+        index = self.server.shardIndex(msg.roomid)
+        self.assertEqual(self.server.metrics()['submitted'][index], 3)
+        kind, data, priority = self.server.msgQueues[index].get(timeout=5)
+        self.assertEqual((kind, unpackMsg(data).content, priority), ('room', 'hi', 2))
+
+class TestShardQueueFull(unittest.TestCase):
+
+    def test_full_queue_drops(self):
+        server = ShardServer(MagicMock(), processNum=1, dispatchConfig={'shardQueueSize': 1, 'fullPolicy': 'drop'})
+        msg = LiteMsg(id=1, type=1, sender='wxid_user', roomid='room@chatroom', content='hi', is_group=True)
+        self.assertTrue(server.submit(msg.roomid, 'room', msg, PRIORITY_LOG))
+        self.assertFalse(server.submit(msg.roomid, 'room', msg, PRIORITY_LOG))
+        # 路由表通知不阻塞调用线程
+        server.broadcastRoute()
+        self.assertEqual(server.metrics()['submitted'], [1])
+        self.assertEqual(server.metrics()['dropped'], [1])
+        self.assertEqual(server.msgQueues[0].get(timeout=5)[0], 'room')
+        # 管理员指令等待入队, 不会被丢弃
+        self.assertTrue(server.submit(msg.roomid, 'single', msg, PRIORITY_ADMIN))
+        self.assertEqual(server.msgQueues[0].get(timeout=5)[2], PRIORITY_ADMIN)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from servers.trigger_server import KeywordTrie, compileTriggers, registerTrigger, triggerRegistry, AdminCommand, CommandTable
+
+class TestKeywordTrie(unittest.TestCase):
+
+    def test_longest_prefix(self):
+        trie = KeywordTrie({'搜索': 'search', '搜索引擎': 'engine', 'top': 'rank'})
+        self.assertEqual(trie.match('搜索引擎怎么用'), ('搜索引擎', 'engine'))
+        self.assertEqual(trie.match('搜索一下'), ('搜索', 'search'))
+        self.assertEqual(trie.match('top10'), ('top', 'rank'))
+        self.assertIsNone(trie.match('帮我搜索'))
+        self.assertIsNone(trie.match(''))
+        self.assertEqual(len(trie), 3)
+
+    def test_compile_triggers(self):
+        trie = compileTriggers({'KfcKeyWords': ['Kfc', '疯狂星期四'], 'gzhRetrive': '猴哥', 'TopWords': ['top', '排行榜']})
+        self.assertEqual(trie.match('疯狂星期四v我50')[1], 'KfcKeyWords')
+        self.assertEqual(trie.match('猴哥')[1], 'gzhRetrive')
+        self.assertEqual(trie.match('排行榜')[1], 'TopWords')
+        self.assertIsNone(trie.match('今天星期四'))
+        self.assertEqual(len(compileTriggers(None)), 0)
+
+    def test_register_trigger(self):
+        @registerTrigger('testTrigger')
+        def testTrigger(handler, msg, content, chatid):
+            return content
+        try:
+            self.assertIs(triggerRegistry['testTrigger'], testTrigger)
+        finally:
+            triggerRegistry.pop('testTrigger')
+        # MsgHandler 内置的触发器已注册
+        import servers.msg_server
+        self.assertIn('KfcKeyWords', triggerRegistry)
+        self.assertIn('TopWords', triggerRegistry)
+
+class TestCommandTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = CommandTable([
+            AdminCommand('addWhiteWord', 'adminAddWhite', ('wxId',)),
+            AdminCommand('addPushWord', 'adminAddPush', ('taskName', 'wxId')),
+            AdminCommand('ShowResponseWord', 'adminShowResponse', refresh=False),
+        ])
+        self.table.load({'addWhiteWord': '加白', 'addPushWord': ['加推送', '添加推送'], 'ShowResponseWord': '查回复群', 'other': 'x'})
+
+    def test_match_args(self):
+        command, word, args = self.table.match('加白 wxid_a')
+        self.assertEqual((command.method, word, args), ('adminAddWhite', '加白', ['wxid_a']))
+        command, word, args = self.table.match('添加推送 早报 room@chatroom')
+        self.assertEqual((command.method, args), ('adminAddPush', ['早报', 'room@chatroom']))
+        command, word, args = self.table.match('查回复群')
+        self.assertEqual((command.refresh, args), (False, []))
+        # 参数不足由调用方判断
+        self.assertEqual(self.table.match('加推送 早报')[2], ['早报'])
+        self.assertIsNone(self.table.match('你好'))
+
+    def test_run_metrics(self):
+        command = self.table.commands['addWhiteWord']
+        self.assertEqual(self.table.run(command, lambda wxId: wxId, 'wxid_a'), 'wxid_a')
+        with self.assertRaises(ValueError):
+            self.table.run(command, lambda: (_ for _ in ()).throw(ValueError()))
+        metrics = self.table.metrics()['addWhiteWord']
+        self.assertEqual((metrics['count'], metrics['failed']), (2, 1))
+        self.assertGreaterEqual(metrics['timeMax'], metrics['timeAvg'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import pickle
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.wxmsg import LiteMsg, MsgEnvelope, ReferMsg, FinderFeed, packMsg
+
+QUOTE_CONTENT = ('<msg><fromusername>wxid_a</fromusername><appmsg appid="" sdkver="0"><title>这是 &lt;什么&gt;</title><des />'
+                 '<type>57</type><refermsg><type>1</type><content>原消息 &amp; 内容</content></refermsg></appmsg></msg>')
+ARTICLE_CONTENT = ('<msg><appmsg><title><![CDATA[文章 <一>]]></title><des>简介</des><url>https://mp.weixin.qq.com/s/1?a=1&amp;b=2</url>'
+                   '<type>5</type><sourcedisplayname>测试号</sourcedisplayname><webviewshared><shareUrlOpen>https://open</shareUrlOpen>'
+                   '</webviewshared></appmsg></msg>')
+FINDER_CONTENT = ('<msg><appmsg><title>视频</title><type>51</type><finderFeed><objectId>123</objectId>'
+                  '<objectNonceId>456</objectNonceId></finderFeed></appmsg></msg>')
+
+class TestMsgEnvelope(unittest.TestCase):
+
+    def test_wrap_and_replace(self):
+        lite = LiteMsg(id=1, type=1, sender='wxid_a', roomid='room@chatroom', content='hi', is_group=True)
+        msg = MsgEnvelope.wrap(lite)
+        self.assertIs(MsgEnvelope.wrap(msg), msg)
+        self.assertEqual(packMsg(msg), packMsg(lite))
+        with self.assertRaises(AttributeError):
+            msg.sender = 'wxid_b'
+        other = msg.replace(sender='wxid_b')
+        self.assertEqual((msg.sender, other.sender), ('wxid_a', 'wxid_b'))
+        # 未修改 xml/content 时共享解析结果
+        self.assertIs(other.cache, msg.cache)
+        self.assertIsNot(msg.replace(content='new').cache, msg.cache)
+        self.assertEqual(pickle.loads(pickle.dumps(packMsg(other))), packMsg(other))
+
+    def test_at_user_list(self):
+        msg = MsgEnvelope(type=1, content='@小A @小B 你好', is_group=True,
+                          xml='<msgsource><atuserlist><![CDATA[wxid_a, wxid_b,]]></atuserlist></msgsource>')
+        self.assertEqual(msg.atUserList, ('wxid_a', 'wxid_b'))
+        self.assertTrue(msg.is_at('wxid_a'))
+        self.assertFalse(msg.is_at('wxid_c'))
+        self.assertFalse(msg.replace(content='@所有人 开会').is_at('wxid_a'))
+        self.assertFalse(msg.replace(is_group=False).is_at('wxid_a'))
+        self.assertEqual(MsgEnvelope(xml='<msgsource />').atUserList, ())
+
+    def test_quote(self):
+        msg = MsgEnvelope(type=49, content=QUOTE_CONTENT)
+        self.assertEqual(msg.appType, '57')
+        self.assertEqual(msg.appTitle, '这是 <什么>')
+        self.assertEqual(msg.refer, ReferMsg('1', '原消息 & 内容'))
+        self.assertEqual(msg.fromUser, 'wxid_a')
+        self.assertEqual(msg.appDes, '')
+        self.assertIsNone(msg.finderFeed)
+
+    def test_article_and_finder(self):
+        msg = MsgEnvelope(type=49, content=ARTICLE_CONTENT)
+        self.assertEqual((msg.appType, msg.appTitle, msg.sourceName), ('5', '文章 <一>', '测试号'))
+        self.assertEqual((msg.appUrl, msg.shareUrlOpen), ('https://mp.weixin.qq.com/s/1?a=1&b=2', 'https://open'))
+        self.assertIsNone(msg.refer)
+        msg = MsgEnvelope(type=49, content=FINDER_CONTENT)
+        self.assertEqual(msg.finderFeed, FinderFeed('123', '456'))
+
+    def test_parse_once(self):
+        msg = MsgEnvelope(type=49, content=QUOTE_CONTENT)
+        root = msg.contentRoot
+        msg.refer, msg.fromUser
+        self.assertIs(msg.contentRoot, root)
+        self.assertIsNone(MsgEnvelope(content='不是 xml').contentRoot)
+        self.assertEqual(MsgEnvelope(content='<msg encryptusername="v3" ticket="v4" scene="30" />').contentAttrib['ticket'], 'v4')
+
+if __name__ == '__main__':
+    unittest.main()
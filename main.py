@@ -1,28 +1,164 @@
+import atexit
 from queue import Empty
-from wcferry import Wcf
 from threading import Thread
 
-from utils.common import logger, initCacheFolder
-from servers.db_server import DbInitServer
+from utils.common import logger, initCacheFolder, returnConfigData, subscribeConfig
+from servers.db_server import DbInitServer, closeAllDb, dbConnections, chatMsgWriter
 from servers.msg_server import SingleMsgHandler, RoomMsgHandler, GhMsgHandler
 from servers.schedule_server import ScheduleTaskServer
+from servers.dispatch_server import LaneExecutor, LoadShedder, MsgDeduper, classifyMsg, shedOrHandle, SHED_OVERLOAD, PRIORITY_ADMIN, PRIORITY_LOG
+from servers.async_server import AsyncRuntime
+from servers.route_server import routeTable
+from servers.contact_server import ContactIndex, RoomMemberCache, AliasCache
+from servers.shard_server import ShardServer
+from servers.send_server import SendServer, QueuedWcf
+from utils.replay import MsgRecorder
+from utils.wxmsg import MsgEnvelope
 
 class MainServer:
-    def __init__(self):
-        self.wcf = Wcf()
+    def __init__(self, wcf=None, enableSchedule=True):
+        """
+        :param wcf: Wcf 实例, 不传则连接本机微信, 回放压测时传入模拟的 Wcf
+        :param enableSchedule: 是否启动定时推送服务
+        """
+        if wcf is None:
+            # wcferry 只能在 Windows 上安装, 回放压测时不需要导入
+            from wcferry import Wcf
+            wcf = Wcf()
+        self.wcf = wcf
         self.wcf.enable_receiving_msg() # 开启全局接收
         self.initDateBase()
-        self.rmh = RoomMsgHandler(self.wcf)
-        self.smh = SingleMsgHandler(self.wcf)
-        self.gmh = GhMsgHandler(self.wcf)
-        self.sts = ScheduleTaskServer(self.wcf)
-        Thread(target=self.sts.run, name='定时推送服务').start()
+        self.initSender()
+        # 联系人索引: 三个处理器共享, 启动时批量加载一次
+        dispatchConfig = returnConfigData().get('dispatchConfig', {})
+        self.contacts = ContactIndex(self.wcf, maxAge=dispatchConfig.get('contactMaxAge', 600))
+        self.contacts.refresh()
+        self.members = RoomMemberCache(self.wcf, maxAge=dispatchConfig.get('memberMaxAge', 300))
+        self.aliases = AliasCache(self.wcf, self.members, maxAge=dispatchConfig.get('aliasMaxAge', 600))
+        self.rmh = RoomMsgHandler(self.wcf, self.contacts, self.members, self.aliases)
+        self.smh = SingleMsgHandler(self.wcf, self.contacts, self.members, self.aliases)
+        self.gmh = GhMsgHandler(self.wcf, self.contacts, self.members, self.aliases)
+        if enableSchedule:
+            # 定时推送排在回复消息之后发送
+            self.sts = ScheduleTaskServer(QueuedWcf(self.rawWcf, self.sendServer, priority=PRIORITY_LOG))
+            Thread(target=self.sts.run, name='定时推送服务').start()
+        self.initDispatcher()
         
     def initDateBase(self, ):
         # 初始化数据存储
         dis = DbInitServer()
         dis.initDb()
+        self.dbMigrators = dis.migrators
+        # 各线程的数据库长连接在退出时统一关闭
+        atexit.register(closeAllDb)
+        # 聊天记录批量写入, atexit 后注册的先执行, 退出时先写完队列再关闭连接
+        dbConfig = returnConfigData().get('dbConfig', {})
+        chatMsgWriter.start(
+            flushInterval=dbConfig.get('flushInterval', 0.2),
+            batchSize=dbConfig.get('batchSize', 200),
+            maxQueue=dbConfig.get('maxQueue', 20000),
+        )
+        atexit.register(chatMsgWriter.shutdown)
         initCacheFolder()
+        # 加载白名单等路由表
+        routeTable.refresh()
+
+    def initSender(self, ):
+        # 统一发送队列: 限流、同一接收方按顺序发送、失败退避重试, 处理线程只负责入队
+        sendConfig = returnConfigData().get('sendConfig', {})
+        self.rawWcf = self.wcf
+        self.sendServer = SendServer(
+            self.rawWcf,
+            rate=sendConfig.get('rate', 2.0),
+            burst=sendConfig.get('burst', 5),
+            laneNum=sendConfig.get('laneNum', 4),
+            queueSize=sendConfig.get('queueSize', 1000),
+            maxRetries=sendConfig.get('maxRetries', 3),
+            backoffBase=sendConfig.get('backoffBase', 1.0),
+            backoffMax=sendConfig.get('backoffMax', 30.0),
+        ).start()
+        self.wcf = QueuedWcf(self.rawWcf, self.sendServer)
+
+    def initDispatcher(self, ):
+        # 初始化消息分发通道: 同一群聊/私聊的消息按顺序处理, 不同会话之间并行
+        configData = returnConfigData()
+        dispatchConfig = configData.get('dispatchConfig', {})
+        # 管理员指令不受队列长度限制, 管理员指令和需要回复的消息优先处理
+        self.executor = LaneExecutor(
+            laneNum=dispatchConfig.get('laneNum', 8),
+            queueSize=dispatchConfig.get('queueSize', 200),
+            fullPolicy=dispatchConfig.get('fullPolicy', 'block'),
+            blockTimeout=dispatchConfig.get('blockTimeout'),
+            urgentPriority=PRIORITY_ADMIN,
+        ).start()
+        # 过载降级: 消息过期或队列积压过多时只记录消息, 不调用 LLM
+        self.shedder = LoadShedder(
+            maxMsgAge=dispatchConfig.get('maxMsgAge', 120),
+            overloadDepth=dispatchConfig.get('overloadDepth', 500),
+            busyReply=dispatchConfig.get('busyReply', '消息太多啦，稍后再来问我吧~'),
+        )
+        # 重复消息过滤
+        self.deduper = MsgDeduper(
+            maxSize=dispatchConfig.get('dedupSize', 10000),
+            window=dispatchConfig.get('dedupWindow', 600),
+        )
+        self.selfWxid = self.wcf.get_self_wxid()
+        self.loadAdminConfig(configData)
+        subscribeConfig(self.loadAdminConfig)
+        # asyncio 运行模式: LLM 调用统一在一个事件循环上并发等待
+        self.asyncRuntime = None
+        if dispatchConfig.get('runtimeMode', 'thread') == 'async':
+            self.asyncRuntime = AsyncRuntime(
+                maxConcurrency=dispatchConfig.get('asyncConcurrency', 1000),
+                maxPending=dispatchConfig.get('asyncMaxPending', 5000),
+                fullPolicy=dispatchConfig.get('fullPolicy', 'block'),
+                blockTimeout=dispatchConfig.get('blockTimeout'),
+            ).start()
+            for handler in (self.rmh, self.smh, self.gmh):
+                handler.attachAsyncRuntime(self.asyncRuntime, self.shedder)
+        self.handlers = {'room': self.rmh, 'single': self.smh, 'gh': self.gmh}
+        # 多进程模式: 主进程只接收和分发, 消息处理放到子进程中
+        self.shardServer = None
+        if dispatchConfig.get('processNum', 0) > 0:
+            self.shardServer = ShardServer(self.wcf, dispatchConfig['processNum'], dispatchConfig).start()
+            # 退出时等子进程处理完已转发的消息, 写完聊天记录后再结束
+            atexit.register(self.shardServer.shutdown)
+        # 录制收到的原始消息, 用于离线回放压测
+        self.recorder = None
+        if dispatchConfig.get('recordPath'):
+            self.recorder = MsgRecorder(dispatchConfig['recordPath'])
+            atexit.register(self.recorder.close)
+
+    def loadAdminConfig(self, configData):
+        # 消息分类用到的超级管理员和管理指令, 配置修改后同步更新
+        superAdmins = set(configData['Administrators'])
+        adminWords = set()
+        for words in configData['adminFunctionWord'].values():
+            adminWords.update(words if isinstance(words, list) else [words])
+        self.superAdmins, self.adminWords = superAdmins, adminWords
+
+    def metrics(self, ):
+        """
+        返回消息分发相关指标
+        """
+        data = {
+            'dispatch': self.executor.metrics(),
+            'shed': self.shedder.metrics(),
+            'dedup': self.deduper.metrics(),
+            'adminCommands': self.smh.adminCommands.metrics(),
+            'contacts': self.contacts.metrics(),
+            'members': self.members.metrics(),
+            'aliases': self.aliases.metrics(),
+            'send': self.sendServer.metrics(),
+            'db': dbConnections.metrics(),
+            'chatWriter': chatMsgWriter.metrics(),
+            'schema': {name: migrator.metrics() for name, migrator in self.dbMigrators.items()},
+        }
+        if self.asyncRuntime is not None:
+            data['async'] = self.asyncRuntime.metrics()
+        if self.shardServer is not None:
+            data['shard'] = self.shardServer.metrics()
+        return data
 
     def isLogin(self, ):
         """
@@ -39,26 +175,67 @@ class MainServer:
             \t存储地址：{userInfo.get('home')}    
             """.replace(' ', ''))
 
+    def dispatchDepth(self, ):
+        # asyncio 运行模式下 coreFunction 提交协程后立即返回, 积压在事件循环上, 需要一起计入
+        depth = self.executor.depth()
+        if self.asyncRuntime is not None:
+            depth += self.asyncRuntime.depth()
+        return depth
+
+    def handleMsg(self, handler, msg, priority):
+        shedOrHandle(self.shedder, handler, msg, priority, self.dispatchDepth())
+
+    def submitMsg(self, key, kind, msg, priority):
+        """
+        提交到本进程的处理通道, 多进程模式下转发到对应子进程
+        :param kind: room / single / gh
+        """
+        if self.shardServer is not None:
+            if not self.shardServer.submit(key, kind, msg, priority):
+                # 子进程积压时在主进程降级处理: 只记录消息, 需要回复的发送繁忙提示
+                self.shedder.count(SHED_OVERLOAD, priority)
+                self.handlers[kind].shedHandle(msg, self.shedder.busyReply)
+        else:
+            self.executor.submit(key, self.handleMsg, self.handlers[kind], msg, priority, priority=priority)
+
+    def dispatchMsg(self, msg):
+        # 重连后重复推送的消息直接丢弃, 不再调用 LLM 和写库
+        if self.deduper.isDuplicate(msg):
+            logger.warning(f'[-]: 丢弃重复消息: {msg.id} {msg.sender} {msg.roomid}')
+            return
+        # 包装为信封, 分类和各处理函数共用一次 XML 解析结果
+        msg = MsgEnvelope.wrap(msg)
+        logger.info(f'main_server 接收到消息: {msg.type} {msg.sender} {msg.roomid} {msg.content}')
+        if self.recorder is not None:
+            self.recorder.record(msg)
+        # 开始处理消息的逻辑
+        # 群聊消息处理: 非白名单群的普通消息在分发前直接丢弃
+        if '@chatroom' in msg.roomid:
+            if not routeTable.acceptRoomMsg(msg, self.superAdmins):
+                return
+            priority = classifyMsg(msg, self.selfWxid, self.superAdmins, self.adminWords, self.smh.adminCommands)
+            self.submitMsg(msg.roomid, 'room', msg, priority)
+        # 私聊消息处理
+        elif '@chatroom' not in msg.roomid and 'gh_' not in msg.sender:
+            priority = classifyMsg(msg, self.selfWxid, self.superAdmins, self.adminWords, self.smh.adminCommands)
+            self.submitMsg(msg.sender, 'single', msg, priority)
+        # 公众号消息处理
+        elif msg.sender.startswith('gh_'):
+            priority = classifyMsg(msg, self.selfWxid, self.superAdmins, self.adminWords, self.smh.adminCommands)
+            self.submitMsg(msg.sender, 'gh', msg, priority)
+        else:
+            pass
+
     def processMsg(self, ):
         # 判断是否登录
         self.isLogin()
+        if self.asyncRuntime is not None:
+            self.asyncRuntime.run(self.asyncRuntime.receiveLoop(self.wcf, self.dispatchMsg))
+            return
         while self.wcf.is_receiving_msg():
             try:
                 msg = self.wcf.get_msg() # WxMsg 对象
-                logger.info(f'main_server 接收到消息: {msg.type} {msg.sender} {msg.roomid} {msg.content}')
-                # 开始处理消息的逻辑
-                # 群聊消息处理
-                if '@chatroom' in msg.roomid:
-                    Thread(target=self.rmh.mainHandle, args=(msg,)).start()
-                # 私聊消息处理
-                elif '@chatroom' not in msg.roomid and 'gh_' not in msg.sender:
-                    Thread(target=self.smh.mainHandle, args=(msg,)).start()
-                # 公众号消息处理
-                elif msg.sender.startswith('gh_'):
-                    Thread(target=self.gmh.mainHandle, args=(msg,)).start()
-                else:
-                    pass
-
+                self.dispatchMsg(msg)
             except Empty:
                 continue
 
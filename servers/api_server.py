@@ -1,13 +1,15 @@
 import os
 import json
+import asyncio
 import requests
 from bs4 import BeautifulSoup
 from datetime import datetime, timedelta
 from utils.common import logger, returnConfigData, downloadFile, encode_image
 from utils.prompt import sys_base_prompt, sys_birthday_wish, sys_weather_report, sys_intention_rec, sys_route_plan, sys_poi_rec, sys_poi_ext, sys_video_gen, sys_room_summary, sys_room_rank_summary
-from utils.llm import UniLLM, generate_video_sf, generate_article
+from utils.llm import UniLLM, AsyncUniLLM, generate_video_sf, generate_article
 
 unillm = UniLLM()
+aunillm = AsyncUniLLM()
 
 class GaoDeApi:
     def __init__(self):
@@ -589,6 +591,50 @@ class LLMResponseApi:
         answer = unillm(['glm4v-flash'], messages=messages)
         return answer.strip()
 
+class AsyncLLMResponseApi(LLMResponseApi):
+    def __init__(self, base=None):
+        """
+        LLMResponseApi 的异步版本, 用于 asyncio 运行模式
+        :param base: 同步版本实例, 传入时共享其会话上下文
+        """
+        super().__init__()
+        if base is not None:
+            self.conversation_list = base.conversation_list
+            self.gaoDeApi = base.gaoDeApi
+
+    async def intentionRec(self, records):
+        messages = [
+            {'role': 'system', 'content': sys_intention_rec},
+            {'role': 'user', 'content': json.dumps(records, ensure_ascii=False)}
+        ]
+        res = await aunillm(self.model_name_list, messages=messages)
+        return res.strip()
+
+    async def generalResponse(self, messages, bot_name):
+        time_mk = f"\n当需要回答时间时请直接参考回复：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        messages = [{'role': 'system', 'content': sys_base_prompt + time_mk}] + messages
+        res = await aunillm(self.model_name_list, messages=messages)
+        return res if res else f'{bot_name}有点累了，稍候再试吧'
+
+    async def weatherResponse(self, user_content, bot_name):
+        messages = [{'role': 'user', 'content': f'{user_content}，用户要查询某地天气信息，请从这段聊天记录中提取出地址信息，只需回答地址'}]
+        res_address = await aunillm(model_name_list=['glm4-flash'], messages=messages)
+        # 高德接口耗时短, 放到线程中执行即可
+        wea_cast = await asyncio.to_thread(self.gaoDeApi.get_weather, res_address, extensions='all')
+        if not wea_cast:
+            messages = [{'role': 'user', 'content': user_content}]
+            response = await self.generalResponse(messages, bot_name)
+            return response
+        forecasts = wea_cast['forecasts'][0]['casts']
+        today_cast = json.dumps(forecasts[0], ensure_ascii=False)
+        future_cast = json.dumps(forecasts[1:], ensure_ascii=False)
+        messages = [
+            {'role': 'system', 'content': sys_weather_report},
+            {'role': 'user', 'content': f'地名：{res_address}；今日天气：{today_cast}；未来三天：{future_cast}；聊天记录：{user_content}'},
+        ]
+        res = await aunillm(self.model_name_list, messages=messages)
+        return res if res else f'{bot_name}有点累了，稍候再试吧'
+
 class ApiServer:
 
     def __init__(self):
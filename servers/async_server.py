@@ -0,0 +1,173 @@
+import asyncio
+import threading
+from queue import Empty
+from utils.common import logger
+
+class AsyncRuntime:
+    def __init__(self, maxConcurrency=1000, maxPending=5000, fullPolicy='block', blockTimeout=None, name='异步运行时'):
+        """
+        在后台线程中运行一个事件循环, 耗时的 LLM 调用在该循环上并发等待, 不再占用处理线程
+        :param maxConcurrency: 同时执行的协程数上限
+        :param maxPending: 已提交未完成(含排队和执行中)的协程数上限, 超出时按 fullPolicy 处理
+        :param fullPolicy: 超出上限时的策略 block-阻塞提交线程 drop-直接丢弃, 与 LaneExecutor 一致
+        :param blockTimeout: block 策略下最长等待秒数, 超时后丢弃, None 表示一直等待
+        :param name: 线程名
+        """
+        if fullPolicy not in ('block', 'drop'):
+            raise ValueError(f'未知的队列满策略: {fullPolicy}')
+        self.maxConcurrency = maxConcurrency
+        self.maxPending = maxPending
+        self.fullPolicy = fullPolicy
+        self.blockTimeout = blockTimeout
+        # 提交时占用, 协程结束时释放; 阻塞的是提交线程, 处理通道随之积压, 降级判断能看到
+        self.slots = threading.BoundedSemaphore(maxPending)
+        self.name = name
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+        self.chatLocks = {}
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.pending = 0
+        self.inflight = 0
+
+    def start(self):
+        if self.loop is not None:
+            return self
+        ready = threading.Event()
+
+        def runLoop():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.semaphore = asyncio.Semaphore(self.maxConcurrency)
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=runLoop, name=self.name, daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def submit(self, coro, key=None):
+        """
+        从事件循环以外的线程提交协程, 相同 key 的协程按提交顺序依次执行
+        :return: concurrent.futures.Future, 超出 maxPending 被丢弃时返回 None
+        """
+        if self.fullPolicy == 'block':
+            acquired = self.slots.acquire(timeout=self.blockTimeout)
+        else:
+            acquired = self.slots.acquire(blocking=False)
+        if not acquired:
+            # 未执行的协程需要关闭, 否则会有 never awaited 警告
+            coro.close()
+            with self.lock:
+                self.rejected += 1
+            logger.warning(f'[-]: {self.name}积压已满, 丢弃任务: {key}')
+            return None
+        with self.lock:
+            self.submitted += 1
+            self.pending += 1
+        return asyncio.run_coroutine_threadsafe(self.guard(coro, key), self.loop)
+
+    def depth(self):
+        """
+        :return: 已提交未完成的协程数, 包括等待会话锁、并发名额以及执行中的
+        """
+        with self.lock:
+            return self.pending
+
+    def acquireChatLock(self, key):
+        """
+        只在事件循环线程中调用, 无需加锁
+        :return: [asyncio.Lock, 引用数]
+        """
+        entry = self.chatLocks.get(key)
+        if entry is None:
+            entry = self.chatLocks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        return entry
+
+    def releaseChatLock(self, key, entry):
+        # 没有协程在使用或等待时删除, 避免 chatLocks 随会话数一直增长
+        entry[1] -= 1
+        if entry[1] == 0 and self.chatLocks.get(key) is entry:
+            del self.chatLocks[key]
+
+    async def guard(self, coro, key):
+        try:
+            if key is None:
+                return await self.runLimited(coro)
+            # 先排会话锁再占并发名额, 同一会话排队的协程不占用其他会话的名额
+            entry = self.acquireChatLock(key)
+            try:
+                async with entry[0]:
+                    return await self.runLimited(coro)
+            finally:
+                self.releaseChatLock(key, entry)
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+
+    async def runLimited(self, coro):
+        async with self.semaphore:
+            with self.lock:
+                self.inflight += 1
+            try:
+                result = await coro
+                with self.lock:
+                    self.completed += 1
+                return result
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                logger.error(f'[-]: {self.name}任务执行出错: {e}')
+            finally:
+                with self.lock:
+                    self.inflight -= 1
+
+    async def receiveLoop(self, wcf, onMsg):
+        """
+        异步接收消息循环, 阻塞的 get_msg 放到线程中等待
+        :param wcf: Wcf 实例
+        :param onMsg: 收到消息后的回调
+        """
+        while wcf.is_receiving_msg():
+            try:
+                msg = await asyncio.to_thread(wcf.get_msg)
+            except Empty:
+                continue
+            try:
+                # 分发时队列满可能阻塞, 放到线程中执行, 不能卡住事件循环上的 LLM 调用
+                await asyncio.to_thread(onMsg, msg)
+            except Exception as e:
+                logger.error(f'[-]: 消息分发出错: {e}')
+
+    def run(self, coro):
+        """
+        在事件循环上执行协程并阻塞等待结果
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'pending': self.pending,
+                'inflight': self.inflight,
+                'chats': len(self.chatLocks),
+            }
+
+    def shutdown(self):
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
@@ -0,0 +1,348 @@
+import re
+import time
+import threading
+from utils.common import logger
+
+CONTACT_SQL = 'SELECT UserName, NickName, Remark FROM Contact'
+
+def quoteSql(value):
+    """
+    query_sql 不支持参数绑定, 拼接前转义单引号
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+class ContactIndex:
+    def __init__(self, wcf, maxAge=600, missInterval=60):
+        """
+        联系人内存索引: 启动时从 MicroMsg.db 批量加载 Contact 表, wxid 和昵称双向 O(1) 查询
+        :param wcf: Wcf 实例
+        :param maxAge: 索引最长缓存秒数, 超时后重新批量加载
+        :param missInterval: 未命中的 key 单独查询后, 该时间内不再重复查询
+        """
+        self.wcf = wcf
+        self.maxAge = maxAge
+        self.missInterval = missInterval
+        self.lock = threading.Lock()
+        self.loadLock = threading.Lock()
+        self.names = {}
+        self.wxids = {}
+        self.remarks = {}
+        self.missed = {}
+        self.loadTime = 0
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self):
+        """
+        批量加载 Contact 表, 整体替换索引
+        """
+        rows = self.wcf.query_sql('MicroMsg.db', f'{CONTACT_SQL};')
+        names, wxids, remarks = {}, {}, {}
+        for row in rows or []:
+            self.indexRow(row, names, wxids, remarks)
+        with self.lock:
+            self.names, self.wxids, self.remarks = names, wxids, remarks
+            self.missed = {}
+            self.loadTime = time.time()
+            self.loads += 1
+        logger.info(f'联系人索引已加载: {len(names)}个')
+
+    @staticmethod
+    def indexRow(row, names, wxids, remarks):
+        wxid = row.get('UserName')
+        if not wxid:
+            return
+        name = row.get('NickName') or ''
+        names[wxid] = name
+        # 昵称重复时保留先出现的 wxid, 与原来 LIMIT 不定的查询结果一致即可
+        if name:
+            wxids.setdefault(name, wxid)
+        remark = row.get('Remark')
+        if remark:
+            remarks.setdefault(remark, wxid)
+
+    def ensureFresh(self):
+        if time.time() - self.loadTime <= self.maxAge:
+            return
+        # 只由一个线程重新加载, 其余线程继续使用旧索引
+        if not self.loadLock.acquire(blocking=self.loadTime == 0):
+            return
+        try:
+            if time.time() - self.loadTime > self.maxAge:
+                self.refresh()
+        except Exception as e:
+            # 加载失败时等到下个周期再试, 期间靠单独查询补齐
+            self.loadTime = time.time()
+            logger.error(f'[-]: 联系人索引加载出错: {e}')
+        finally:
+            self.loadLock.release()
+
+    def queryMissing(self, column, value):
+        """
+        索引中没有的 key 单独查询一次并补进索引, 新好友/新群不必等到下次批量加载
+        :return: 查询到的行, 没有时返回 None
+        """
+        key = (column, value)
+        now = time.time()
+        with self.lock:
+            self.misses += 1
+            if now - self.missed.get(key, 0) < self.missInterval:
+                return None
+            self.missed[key] = now
+        try:
+            rows = self.wcf.query_sql('MicroMsg.db', f'{CONTACT_SQL} WHERE {column} = {quoteSql(value)};')
+        except Exception as e:
+            logger.error(f'[-]: 查询联系人出错: {e}')
+            return None
+        if not rows:
+            return None
+        row = dict(rows[0])
+        row.setdefault(column, value)
+        with self.lock:
+            self.indexRow(row, self.names, self.wxids, self.remarks)
+        return row
+
+    def getName(self, wxid):
+        """
+        :return: 好友或群聊昵称, 没有时返回空字符串
+        """
+        self.ensureFresh()
+        name = self.names.get(wxid)
+        if name is not None:
+            with self.lock:
+                self.hits += 1
+            return name
+        row = self.queryMissing('UserName', wxid)
+        return (row.get('NickName') or '') if row else ''
+
+    def getWxId(self, name):
+        """
+        :return: 昵称对应的 wxid, 昵称没有时再按备注查找, 都没有时返回空字符串
+        """
+        self.ensureFresh()
+        wxid = self.wxids.get(name) or self.remarks.get(name)
+        if wxid is not None:
+            with self.lock:
+                self.hits += 1
+            return wxid
+        row = self.queryMissing('NickName', name)
+        return (row.get('UserName') or '') if row else ''
+
+    def metrics(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.names),
+                'loads': self.loads,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRatio': round(self.hits / total, 4) if total else 0.0,
+            }
+
+# 会引起群成员变化的系统消息: 邀请/扫码入群、移出群聊、退出群聊
+MEMBER_CHANGE_PATTERN = re.compile(r'加入了?群聊|移出了?群聊|退出了?群聊')
+
+class RoomMemberCache:
+    def __init__(self, wcf, maxAge=300):
+        """
+        群成员缓存: get_chatroom_members 的结果按群缓存, 入群/退群系统消息和踢人后失效
+        超过 maxAge 的缓存先返回旧数据, 同时在后台线程中重新加载
+        :param wcf: Wcf 实例
+        :param maxAge: 缓存秒数
+        """
+        self.wcf = wcf
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.refreshing = set()
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, roomId):
+        members = self.wcf.get_chatroom_members(roomId) or {}
+        with self.lock:
+            self.rooms[roomId] = (members, time.time())
+            self.loads += 1
+        return members
+
+    def refreshInBackground(self, roomId):
+        with self.lock:
+            if roomId in self.refreshing:
+                return
+            self.refreshing.add(roomId)
+
+        def run():
+            try:
+                self.load(roomId)
+            except Exception as e:
+                logger.error(f'[-]: 刷新群成员出错 {roomId}: {e}')
+            finally:
+                with self.lock:
+                    self.refreshing.discard(roomId)
+
+        threading.Thread(target=run, name=f'群成员刷新-{roomId}', daemon=True).start()
+
+    def get(self, roomId):
+        """
+        :return: {wxid: 群昵称}, 调用方不要修改返回的字典
+        """
+        with self.lock:
+            cached = self.rooms.get(roomId)
+            if cached is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if cached is None:
+            return self.load(roomId)
+        members, loadTime = cached
+        if time.time() - loadTime > self.maxAge:
+            self.refreshInBackground(roomId)
+        return members
+
+    def count(self, roomId):
+        return len(self.get(roomId))
+
+    def isMember(self, roomId, wxId):
+        return wxId in self.get(roomId)
+
+    def invalidate(self, roomId):
+        with self.lock:
+            self.rooms.pop(roomId, None)
+
+    def onSystemMsg(self, msg):
+        """
+        收到群系统消息时判断成员是否变化, 变化则让该群缓存失效
+        :return: 是否失效
+        """
+        if msg.type != 10000 or not MEMBER_CHANGE_PATTERN.search(msg.content or ''):
+            return False
+        self.invalidate(msg.roomid)
+        return True
+
+    def delMembers(self, roomId, wxIds):
+        """
+        踢人, 成功后让该群缓存失效
+        """
+        status = self.wcf.del_chatroom_members(roomId, wxIds)
+        if status:
+            self.invalidate(roomId)
+        return status
+
+    def inviteMembers(self, roomId, wxIds):
+        """
+        邀请进群, 成功后让该群缓存失效
+        """
+        status = self.wcf.invite_chatroom_members(roomId, wxIds)
+        if status:
+            self.invalidate(roomId)
+        return status
+
+    def metrics(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'rooms': len(self.rooms),
+                'loads': self.loads,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRatio': round(self.hits / total, 4) if total else 0.0,
+            }
+
+# 群昵称/群名修改的系统消息
+ALIAS_CHANGE_PATTERN = re.compile(r'修改.*(群昵称|群名片|群名)')
+
+class AliasCache:
+    def __init__(self, wcf, members=None, maxAge=600):
+        """
+        群昵称缓存: 按 (wxid, 群) 缓存 get_alias_in_chatroom 的结果
+        未命中时先用群成员列表批量预取整个群, 仍没有时再单独查询
+        :param wcf: Wcf 实例
+        :param members: RoomMemberCache, 用于批量预取, 不传则只单独查询
+        :param maxAge: 缓存秒数
+        """
+        self.wcf = wcf
+        self.members = members
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        # {群: {wxid: (群昵称, 写入时间)}}, 按群存放便于整群失效
+        self.rooms = {}
+        self.prefetched = {}
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+
+    def lookup(self, wxId, roomId):
+        entry = self.rooms.get(roomId, {}).get(wxId)
+        if entry is None or time.time() - entry[1] > self.maxAge:
+            return None
+        return entry[0]
+
+    def prefetch(self, roomId):
+        """
+        用群成员列表批量写入该群所有成员的群昵称
+        """
+        if self.members is None:
+            return
+        now = time.time()
+        with self.lock:
+            if now - self.prefetched.get(roomId, 0) <= self.maxAge:
+                return
+            self.prefetched[roomId] = now
+        try:
+            members = self.members.get(roomId)
+        except Exception as e:
+            logger.error(f'[-]: 预取群昵称出错 {roomId}: {e}')
+            return
+        with self.lock:
+            aliases = self.rooms.setdefault(roomId, {})
+            for wxId, name in members.items():
+                # 群成员列表中没有名字的成员留给单独查询
+                if name:
+                    aliases[wxId] = (name, now)
+
+    def get(self, wxId, roomId):
+        """
+        :return: 群昵称, 没有设置时为微信昵称
+        """
+        alias = self.lookup(wxId, roomId)
+        if alias is None:
+            self.prefetch(roomId)
+            alias = self.lookup(wxId, roomId)
+        with self.lock:
+            if alias is not None:
+                self.hits += 1
+                return alias
+            self.misses += 1
+            self.queries += 1
+        alias = self.wcf.get_alias_in_chatroom(wxId, roomId)
+        with self.lock:
+            self.rooms.setdefault(roomId, {})[wxId] = (alias, time.time())
+        return alias
+
+    def invalidate(self, roomId):
+        with self.lock:
+            self.rooms.pop(roomId, None)
+            self.prefetched.pop(roomId, None)
+
+    def onSystemMsg(self, msg):
+        """
+        收到改名的群系统消息时让该群缓存失效
+        :return: 是否失效
+        """
+        if msg.type != 10000 or not ALIAS_CHANGE_PATTERN.search(msg.content or ''):
+            return False
+        self.invalidate(msg.roomid)
+        return True
+
+    def metrics(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'rooms': len(self.rooms),
+                'hits': self.hits,
+                'misses': self.misses,
+                'queries': self.queries,
+                'hitRatio': round(self.hits / total, 4) if total else 0.0,
+            }
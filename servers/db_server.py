@@ -1,13 +1,71 @@
 import os
+import re
+import time
 import sqlite3
-from datetime import datetime
-from utils.common import logger
+import threading
+import functools
+from datetime import datetime, timedelta
+from utils.common import logger, returnConfigData
+from servers.schema_server import SchemaMigrator, Migration, Backfill
 
 current_path = os.path.dirname(__file__)
 userDb = current_path + '/../data/user.db'
 roomDb = current_path + '/../data/room.db'
 messageDb = current_path + '/../data/message.db'
 
+# 每个连接缓存的预编译语句数, 各方法的 SQL 都是固定字符串, 同一连接上重复执行时直接复用
+STATEMENT_CACHE_SIZE = 256
+
+# 默认 PRAGMA, config.yaml 中 dbConfig 的同名配置(驼峰写法)会覆盖
+DB_PRAGMAS = {
+    # WAL: 读不阻塞写, 写不阻塞读, 定时任务读聊天记录时处理线程仍可写入
+    'journal_mode': 'WAL',
+    # 遇到写锁时最多等待的毫秒数, 超时才报 database is locked
+    'busy_timeout': 5000,
+    # WAL 下 NORMAL 不会损坏数据库, 断电时最多丢失最后几个事务
+    'synchronous': 'NORMAL',
+    # 负数表示 KiB
+    'cache_size': -16000,
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+DB_CONFIG_KEYS = {
+    'journalMode': 'journal_mode',
+    'busyTimeout': 'busy_timeout',
+    'synchronous': 'synchronous',
+    'cacheSize': 'cache_size',
+    'mmapSize': 'mmap_size',
+    'tempStore': 'temp_store',
+}
+
+def loadDbPragmas():
+    """
+    :return: 默认 PRAGMA 合并 dbConfig 后的结果, 读取配置失败时使用默认值
+    """
+    pragmas = dict(DB_PRAGMAS)
+    try:
+        dbConfig = returnConfigData().get('dbConfig') or {}
+    except Exception as e:
+        logger.warning(f'[-]: 读取数据库配置失败, 使用默认配置: {e}')
+        return pragmas
+    for key, name in DB_CONFIG_KEYS.items():
+        if dbConfig.get(key) is not None:
+            pragmas[name] = dbConfig[key]
+    return pragmas
+
+def applyPragmas(conn, pragmas):
+    """
+    PRAGMA 不支持参数绑定, 只接受数字和单词形式的值
+    """
+    for name, value in pragmas.items():
+        if not re.fullmatch(r'-?\w+', str(value)):
+            logger.error(f'[-]: 无效的数据库配置 {name}: {value}')
+            continue
+        try:
+            conn.execute(f'PRAGMA {name}={value}')
+        except sqlite3.Error as e:
+            logger.error(f'[-]: 设置数据库配置 {name}={value} 出错: {e}')
+
 def openDb(dbPath, ):
     conn = sqlite3.connect(database=dbPath, )
     cursor = conn.cursor()
@@ -17,6 +75,120 @@ def closeDb(conn, cursor):
     cursor.close()
     conn.close()
 
+class DbConnectionManager:
+    def __init__(self, cachedStatements=STATEMENT_CACHE_SIZE, pragmas=None):
+        """
+        SQLite 连接管理: 每个线程对每个数据库文件保持一个长连接, 不再每次操作都打开/关闭文件
+        :param cachedStatements: 每个连接缓存的预编译语句数
+        :param pragmas: 新连接执行的 PRAGMA, 不传则在第一次连接时从配置读取
+        """
+        self.cachedStatements = cachedStatements
+        self.pragmas = pragmas
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # [(线程, 数据库路径, 连接)], 用于关闭已退出线程留下的连接和统一关闭
+        self.conns = []
+        self.opened = 0
+        self.reused = 0
+
+    def connections(self):
+        conns = getattr(self.local, 'conns', None)
+        # fork 出的子进程不能沿用父进程的连接
+        if conns is None or self.local.pid != os.getpid():
+            conns = self.local.conns = {}
+            self.local.pid = os.getpid()
+        return conns
+
+    def get(self, dbPath):
+        """
+        :return: 当前线程连接 dbPath 的长连接
+        """
+        conns = self.connections()
+        conn = conns.get(dbPath)
+        if conn is not None:
+            with self.lock:
+                self.reused += 1
+            return conn
+        conn = sqlite3.connect(database=dbPath, check_same_thread=False, cached_statements=self.cachedStatements)
+        if self.pragmas is None:
+            self.pragmas = loadDbPragmas()
+        applyPragmas(conn, self.pragmas)
+        conns[dbPath] = conn
+        thread = threading.current_thread()
+        with self.lock:
+            self.pruneDeadThreads()
+            self.conns.append((thread, dbPath, conn))
+            self.opened += 1
+        return conn
+
+    def pruneDeadThreads(self):
+        alive = []
+        for thread, dbPath, conn in self.conns:
+            if thread.is_alive():
+                alive.append((thread, dbPath, conn))
+            else:
+                conn.close()
+        self.conns = alive
+
+    def release(self, dbPath=None):
+        """
+        关闭当前线程的连接, 不传 dbPath 时关闭当前线程的全部连接
+        """
+        conns = self.connections()
+        paths = [dbPath] if dbPath is not None else list(conns)
+        closing = [conns.pop(path) for path in paths if path in conns]
+        with self.lock:
+            self.conns = [item for item in self.conns if item[2] not in closing]
+        for conn in closing:
+            conn.close()
+
+    def closeAll(self):
+        """
+        关闭所有线程的连接, 退出前调用; 之后再访问数据库会重新连接
+        """
+        with self.lock:
+            conns, self.conns = self.conns, []
+        for _, _, conn in conns:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f'[-]: 关闭数据库连接出错: {e}')
+        # 其他线程的 threading.local 无法清空, 用新的 local 让它们下次重新连接
+        self.local = threading.local()
+
+    def metrics(self):
+        with self.lock:
+            return {'connections': len(self.conns), 'opened': self.opened, 'reused': self.reused}
+
+dbConnections = DbConnectionManager()
+
+def getDb(dbPath):
+    """
+    :return: 当前线程的长连接, 用完不要关闭; 写操作放在 with conn 中, 出错时自动回滚, 不会在长连接上留下未结束的事务
+    """
+    return dbConnections.get(dbPath)
+
+def releaseDb(dbPath=None):
+    dbConnections.release(dbPath)
+
+def closeAllDb():
+    dbConnections.closeAll()
+
+# 各数据库的结构变更, 新增时追加新的版本号, 已发布的版本不要修改
+USER_MIGRATIONS = []
+ROOM_MIGRATIONS = []
+# 按版本号顺序执行: 写入聊天记录依赖 createTs 列, 加列排在建索引之前, 启动时同步完成
+MESSAGE_MIGRATIONS = [
+    Migration(1, 'chatMessage 增加秒级时间戳 createTs', [
+        'ALTER TABLE chatMessage ADD COLUMN createTs INTEGER',
+    ]),
+    Migration(2, 'chatMessage 按群和时间查询的索引', [
+        'CREATE INDEX IF NOT EXISTS idx_chatMessage_room_time ON chatMessage (roomId, createTime)',
+        'CREATE INDEX IF NOT EXISTS idx_chatMessage_room_member ON chatMessage (roomId, wxId, createTime)',
+    ], online=True),
+    Migration(3, '回填 chatMessage.createTs', backfill=Backfill('chatMessage', "createTs = CAST(strftime('%s', createTime) AS INTEGER)", 'createTs IS NULL'), online=True),
+]
+
 class DbInitServer:
     def __init__(self):
         pass
@@ -36,22 +208,37 @@ class DbInitServer:
             logger.error(f'[-]: 创建数据表出现错误, 错误信息: {e}')
             return False
 
-    def initDb(self, ):
+    def initDb(self, background=True):
+        """
+        :param background: 建索引、回填等耗时的结构变更是否在后台执行, 不阻塞启动
+        """
+        # WAL 模式写入数据库文件后一直有效, 建表时一起设置
+        pragmas = loadDbPragmas()
         # 初始化用户数据库 用户表 管理员表
         conn, cursor = openDb(userDb)
+        applyPragmas(conn, pragmas)
         self.createTable(cursor, 'whiteUser', 'wxId varchar(255) PRIMARY KEY, wxName varchar(255)')
         self.createTable(cursor, 'Admin', 'wxId varchar(255) PRIMARY KEY, roomId varchar(255)')
         closeDb(conn, cursor)
         # 初始化群聊数据库 白名单表 推送定时任务表
         conn, cursor = openDb(roomDb)
+        applyPragmas(conn, pragmas)
         self.createTable(cursor, 'whiteRoom', 'roomId varchar(255) PRIMARY KEY, roomName varchar(255)')
         self.createTable(cursor, 'pushRoom', 'taskName varchar(255), roomId varchar(255), roomName varchar(255), PRIMARY KEY (taskName, roomId)')
         self.createTable(cursor, 'responseRoom', 'roomId varchar(255) PRIMARY KEY, roomName varchar(255)')
         closeDb(conn, cursor)
         # 初始化消息数据库 消息表 群聊消息表
         conn, cursor = openDb(messageDb)
+        applyPragmas(conn, pragmas)
         self.createTable(cursor,'chatMessage', 'id INTEGER PRIMARY KEY AUTOINCREMENT, wxId varchar(255), wxName varchar(255), roomId varchar(255), content varchar(255), createTime datetime DEFAULT CURRENT_TIMESTAMP')
         closeDb(conn, cursor)
+        # 建表之后的结构变更按版本号执行
+        onConnect = functools.partial(applyPragmas, pragmas=pragmas)
+        self.migrators = {
+            'user': SchemaMigrator(userDb, USER_MIGRATIONS, onConnect, name='user.db').run(background),
+            'room': SchemaMigrator(roomDb, ROOM_MIGRATIONS, onConnect, name='room.db').run(background),
+            'message': SchemaMigrator(messageDb, MESSAGE_MIGRATIONS, onConnect, name='message.db').run(background),
+        }
         logger.info(f'数据库初始化成功！！！')
 
 class DbUserServer:
@@ -65,51 +252,48 @@ class DbUserServer:
         :param roomId: 微信昵称
         :return:
         """
-        conn, cursor = openDb(userDb)
+        conn = getDb(userDb)
         try:
-            cursor.execute('INSERT INTO whiteUser VALUES (?, ?)', (wxId, wxName))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('INSERT INTO whiteUser VALUES (?, ?)', (wxId, wxName))
             return True
         except Exception as e:
             logger.error(f'增加好友出现错误: {e}')
-            closeDb(conn, cursor)
             return False
 
     def delUser(self, wxId):
-        conn, cursor = openDb(userDb)
+        conn = getDb(userDb)
         try:
-            cursor.execute('DELETE FROM whiteUser WHERE wxId=?', (wxId, ))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('DELETE FROM whiteUser WHERE wxId=?', (wxId, ))
             return True
         except Exception as e:
             logger.error(f'删除好友出现错误: {e}')
-            closeDb(conn, cursor)
             return False
 
     def searchUser(self, wxId):
-        conn, cursor = openDb(userDb)
+        conn = getDb(userDb)
         try:
-            cursor.execute('SELECT wxId FROM whiteUser WHERE wxId=?', (wxId, ))
+            cursor = conn.execute('SELECT wxId FROM whiteUser WHERE wxId=?', (wxId, ))
             result = cursor.fetchone()
-            closeDb(conn, cursor)
             return True if result else False
         except Exception as e:
             logger.error(f'[-]: 查询好友出现错误, 错误信息: {e}')
-            closeDb(conn, cursor)
             return False
     
-    def showUser(self):
-        conn, cursor = openDb(userDb)
+    def showUser(self, raiseError=False):
+        """
+        :param raiseError: 出错时抛出异常而不是返回空列表, 路由表据此保留旧数据
+        """
+        conn = getDb(userDb)
         try:
-            cursor.execute('SELECT wxId, wxName FROM whiteUser')
+            cursor = conn.execute('SELECT wxId, wxName FROM whiteUser')
             result = cursor.fetchall()
-            closeDb(conn, cursor)
             return result
         except Exception as e:
             logger.error(f'获取白名单好友出现错误: {e}')
-            closeDb(conn, cursor)
+            if raiseError:
+                raise
             return []
 
     def addAdmin(self, wxId, roomId):
@@ -119,42 +303,51 @@ class DbUserServer:
         :param roomId: 群聊ID
         :return:
         """
-        conn, cursor = openDb(userDb)
+        conn = getDb(userDb)
         try:
-            cursor.execute('INSERT INTO Admin VALUES (?, ?)', (wxId, roomId))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('INSERT INTO Admin VALUES (?, ?)', (wxId, roomId))
             return True
         except Exception as e:
             logger.error(f'增加管理员出现错误: {e}')
-            closeDb(conn, cursor)
             return False
 
     def delAdmin(self, wxId, roomId):
-        conn, cursor = openDb(userDb)
+        conn = getDb(userDb)
         try:
-            cursor.execute('DELETE FROM Admin WHERE wxId=? AND roomId=?', (wxId, roomId))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('DELETE FROM Admin WHERE wxId=? AND roomId=?', (wxId, roomId))
             return True
         except Exception as e:
             logger.error(f'删除管理员出现错误: {e}')
-            closeDb(conn, cursor)
             return False
 
+    def showAdmin(self, raiseError=False):
+        """
+        :param raiseError: 出错时抛出异常而不是返回空列表
+        """
+        conn = getDb(userDb)
+        try:
+            cursor = conn.execute('SELECT wxId, roomId FROM Admin')
+            result = cursor.fetchall()
+            return result
+        except Exception as e:
+            logger.error(f'获取管理员出现错误: {e}')
+            if raiseError:
+                raise
+            return []
+
     def searchAdmin(self, wxId, roomId):
-        conn, cursor = openDb(userDb)
+        conn = getDb(userDb)
         try:
-            cursor.execute('SELECT wxId FROM Admin WHERE wxId=? AND roomId=?', (wxId, roomId))
+            cursor = conn.execute('SELECT wxId FROM Admin WHERE wxId=? AND roomId=?', (wxId, roomId))
             result = cursor.fetchone()
-            closeDb(conn, cursor)
             if result:
                 return True
             else:
                 return False
         except Exception as e:
             logger.error(f'[-]: 查询管理员出现错误, 错误信息: {e}')
-            closeDb(conn, cursor)
             return False
 
 class DbRoomServer:
@@ -162,195 +355,367 @@ class DbRoomServer:
         pass
 
     def addWhiteRoom(self, roomId, roomName):
-        conn, cursor = openDb(roomDb)
+        conn = getDb(roomDb)
         try:
-            cursor.execute('INSERT INTO whiteRoom VALUES (?, ?)', (roomId, roomName))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('INSERT INTO whiteRoom VALUES (?, ?)', (roomId, roomName))
             return True
         except Exception as e:
             logger.error(f'新增白名单群聊出现错误: {e}')
-            closeDb(conn, cursor)
             return False
 
     def delWhiteRoom(self, roomId):
-        conn, cursor = openDb(roomDb)
+        conn = getDb(roomDb)
         try:
-            cursor.execute('DELETE FROM whiteRoom WHERE roomId=?', (roomId,))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('DELETE FROM whiteRoom WHERE roomId=?', (roomId,))
             return True
         except Exception as e:
             logger.error(f'删除白名单群聊出现错误, 错误信息: {e}')
-            closeDb(conn, cursor)
             return False
     
     def searchWhiteRoom(self, roomId):
-        conn, cursor = openDb(roomDb)
+        conn = getDb(roomDb)
         try:
-            cursor.execute('SELECT roomId FROM whiteRoom WHERE roomId=?', (roomId,))
+            cursor = conn.execute('SELECT roomId FROM whiteRoom WHERE roomId=?', (roomId,))
             result = cursor.fetchone()
-            closeDb(conn, cursor)
             return True if result else False
         except Exception as e:
             logger.error(f'[-]: 查询白名单群聊出现错误, 错误信息: {e}')
-            closeDb(conn, cursor)
             return False
 
-    def showWhiteRoom(self, ):
-        conn, cursor = openDb(roomDb)
+    def showWhiteRoom(self, raiseError=False):
+        """
+        :param raiseError: 出错时抛出异常而不是返回空列表
+        """
+        conn = getDb(roomDb)
         try:
-            cursor.execute('SELECT roomId, roomName FROM whiteRoom')
+            cursor = conn.execute('SELECT roomId, roomName FROM whiteRoom')
             result = cursor.fetchall()
-            closeDb(conn, cursor)
             return result
         except Exception as e:
             logger.error(f'查看所有白名单群聊出现错误: {e}')
-            closeDb(conn, cursor)
+            if raiseError:
+                raise
             return []
 
     def addPushRoom(self, taskName, roomId, roomName):
-        conn, cursor = openDb(roomDb)
+        conn = getDb(roomDb)
         try:
-            cursor.execute('INSERT INTO pushRoom VALUES (?, ?, ?)', (taskName, roomId, roomName))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('INSERT INTO pushRoom VALUES (?, ?, ?)', (taskName, roomId, roomName))
             return True
         except Exception as e:
             logger.error(f'新增推送任务出现错误: {e}')
-            closeDb(conn, cursor)
             return False
     
     def delPushRoom(self, taskName, roomId, roomName):
-        conn, cursor = openDb(roomDb)
+        conn = getDb(roomDb)
         try:
-            cursor.execute('DELETE FROM pushRoom WHERE taskName=? AND roomId=? AND roomName=?', (taskName, roomId, roomName))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('DELETE FROM pushRoom WHERE taskName=? AND roomId=? AND roomName=?', (taskName, roomId, roomName))
             return True
         except Exception as e:
             logger.error(f'删除推送任务出现错误: {e}')
-            closeDb(conn, cursor)
             return False
     
     def showPushRoom(self, taskName=None):
-        conn, cursor = openDb(roomDb)
+        conn = getDb(roomDb)
         try:
             if taskName:
-                cursor.execute('SELECT roomId, roomName FROM pushRoom WHERE taskName=?', (taskName,))
+                cursor = conn.execute('SELECT roomId, roomName FROM pushRoom WHERE taskName=?', (taskName,))
             else:
-                cursor.execute('SELECT * FROM pushRoom')
+                cursor = conn.execute('SELECT * FROM pushRoom')
             result = cursor.fetchall()
-            closeDb(conn, cursor)
             return result
         except Exception as e:
             logger.error(f'查看推送任务出现错误: {e}')
-            closeDb(conn, cursor)
             return []
         
     def addResponseRoom(self, roomId, roomName):
-        conn, cursor = openDb(roomDb)
+        conn = getDb(roomDb)
         try:
-            cursor.execute('INSERT INTO responseRoom VALUES (?, ?)', (roomId, roomName))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('INSERT INTO responseRoom VALUES (?, ?)', (roomId, roomName))
             return True
         except Exception as e:
             logger.error(f'新增回复群出现错误: {e}')
-            closeDb(conn, cursor)
             return False
     
     def delResponseRoom(self, roomId):
-        conn, cursor = openDb(roomDb)
+        conn = getDb(roomDb)
         try:
-            cursor.execute('DELETE FROM responseRoom WHERE roomId=?', (roomId,))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute('DELETE FROM responseRoom WHERE roomId=?', (roomId,))
             return True
         except Exception as e:
             logger.error(f'删除回复群出现错误: {e}')
-            closeDb(conn, cursor)
             return False
     
-    def showResponseRoom(self):
-        conn, cursor = openDb(roomDb)
+    def showResponseRoom(self, raiseError=False):
+        """
+        :param raiseError: 出错时抛出异常而不是返回空列表
+        """
+        conn = getDb(roomDb)
         try:
-            cursor.execute('SELECT roomId, roomName FROM responseRoom')
+            cursor = conn.execute('SELECT roomId, roomName FROM responseRoom')
             result = cursor.fetchall()
-            closeDb(conn, cursor)
             return result
         except Exception as e:
             logger.error(f'查看回复群出现错误: {e}')
-            closeDb(conn, cursor)
+            if raiseError:
+                raise
             return []
         
     def searchResponseRoom(self, roomId):
-        conn, cursor = openDb(roomDb)
+        conn = getDb(roomDb)
         try:
-            cursor.execute('SELECT roomId, roomName FROM responseRoom WHERE roomId=?', (roomId, ))
+            cursor = conn.execute('SELECT roomId, roomName FROM responseRoom WHERE roomId=?', (roomId, ))
             result = cursor.fetchone()
-            closeDb(conn, cursor)
             return True if result else False
         except Exception as e:
             logger.error(f'查询回复群出现错误: {e}')
-            closeDb(conn, cursor)
             return []
 
+def toUtcText(localTime):
+    """
+    本地时间转为与 CURRENT_TIMESTAMP 相同格式的 UTC 字符串, 可直接与 createTime 比较
+    """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.mktime(localTime.timetuple())))
+
+def localDayRange(days=1, now=None):
+    """
+    按本地时间划分的自然日区间 [start, end), 用于 createTime 范围查询, 可以走索引
+    :param days: 包含今天在内的天数
+    :return: (start, end) UTC 字符串
+    """
+    today = (now or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    return toUtcText(today - timedelta(days=days - 1)), toUtcText(today + timedelta(days=1))
+
+# 聊天记录查询, 只在 roomId 和 createTime 上过滤, 走 (roomId, createTime) / (roomId, wxId, createTime) 索引
+CHAT_HISTORY_SQL = "SELECT wxName, content, datetime(createTime, 'localtime') FROM chatMessage WHERE roomId=? AND createTime >= ? AND createTime < ? ORDER BY createTime"
+CHAT_RANK_SQL = 'SELECT wxName, COUNT(*) AS count FROM chatMessage WHERE roomId=? AND createTime >= ? AND createTime < ? GROUP BY wxId ORDER BY count DESC'
+CHAT_MEMBERS_SQL = 'SELECT wxId, wxName FROM chatMessage WHERE roomId=? AND createTime >= ? AND createTime < ? GROUP BY wxId'
+
+CHAT_INSERT_SQL = 'INSERT INTO chatMessage (wxId, wxName, roomId, content, createTime, createTs) VALUES (?, ?, ?, ?, ?, ?)'
+
+def chatRow(wxId, wxName, roomId, content):
+    now = time.time()
+    return (wxId, wxName, roomId, content, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now)), int(now))
+
+class ChatMsgWriter:
+    def __init__(self, flushInterval=0.2, batchSize=200, maxQueue=20000, maxRetries=5, retryDelay=0.5, retryMax=10.0):
+        """
+        群聊消息批量写入: 处理线程只把消息放进内存队列, 后台线程每 flushInterval 秒或攒够 batchSize 条时
+        用 executemany 在一个事务中写入, 多条消息只提交一次
+        未启动时 addChatMessage 直接写库
+        :param flushInterval: 最长攒批秒数
+        :param batchSize: 攒够多少条立即写入
+        :param maxQueue: 待写入条数上限, 超过时丢弃新消息, 不阻塞处理线程
+        :param maxRetries: database is locked 等 OperationalError 时放回队首重试的次数, 超过后丢弃该批
+        :param retryDelay: 第一次重试前等待的秒数, 之后每次翻倍
+        :param retryMax: 重试等待秒数上限
+        """
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+        self.maxQueue = maxQueue
+        self.maxRetries = maxRetries
+        self.retryDelay = retryDelay
+        self.retryMax = retryMax
+        # 队首消息连续写入失败的次数, 以及下次重试的时间(time.monotonic)
+        self.attempts = 0
+        self.retryAt = 0
+        self.pending = []
+        self.cond = threading.Condition()
+        # 后台线程和读聊天记录前的主动写入不能同时进行, 否则顺序可能错乱
+        self.flushLock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.stopped = False
+        # dropped: 队列满丢弃 failed: 非临时错误直接丢弃 retried: 放回队首重试的批次 discarded: 重试超过次数后丢弃
+        self.stats = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'retried': 0, 'discarded': 0, 'batches': 0,
+                      'maxBatch': 0, 'flushTotal': 0.0, 'flushMax': 0.0}
+
+    def start(self, flushInterval=None, batchSize=None, maxQueue=None):
+        if flushInterval is not None:
+            self.flushInterval = flushInterval
+        if batchSize is not None:
+            self.batchSize = batchSize
+        if maxQueue is not None:
+            self.maxQueue = maxQueue
+        if self.running():
+            return self
+        self.stopped = False
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.writeLoop, name='聊天记录写入', daemon=True)
+        self.thread.start()
+        return self
+
+    def running(self):
+        # fork 出的子进程中后台线程不存在, 需要重新启动
+        return self.thread is not None and self.thread.is_alive() and self.pid == os.getpid()
+
+    def add(self, wxId, wxName, roomId, content):
+        """
+        放入待写入队列, 立即返回; createTime 取入队时间, 与 CURRENT_TIMESTAMP 一样是 UTC
+        :return: 是否入队, 队列已满时丢弃并返回 False
+        """
+        row = chatRow(wxId, wxName, roomId, content)
+        with self.cond:
+            if len(self.pending) >= self.maxQueue:
+                self.stats['dropped'] += 1
+                return False
+            self.pending.append(row)
+            self.stats['queued'] += 1
+            if len(self.pending) >= self.batchSize:
+                self.cond.notify()
+        return True
+
+    def writeLoop(self):
+        while True:
+            with self.cond:
+                if not self.stopped and len(self.pending) < self.batchSize:
+                    self.cond.wait(self.flushInterval)
+                # 上次写入失败时等到退避时间再重试, 退出时由 shutdown 负责
+                while not self.stopped and self.retryAt > time.monotonic():
+                    self.cond.wait(self.retryAt - time.monotonic())
+                stopped = self.stopped
+            self.flush()
+            if stopped:
+                break
+
+    def flush(self):
+        """
+        把当前队列中的消息全部写入, 读聊天记录前和退出时同步调用
+        :return: 本次写入条数
+        """
+        with self.flushLock:
+            with self.cond:
+                rows, self.pending = self.pending, []
+            if not rows:
+                self.attempts = 0
+                return 0
+            start = time.perf_counter()
+            try:
+                conn = getDb(messageDb)
+                with conn:
+                    conn.executemany(CHAT_INSERT_SQL, rows)
+            except sqlite3.OperationalError as e:
+                # 建索引等长事务持有写锁时 busy_timeout 后仍会 database is locked, 放回队首稍后重试
+                self.retryLater(rows, e)
+                return 0
+            except Exception as e:
+                logger.error(f'[-]: 批量写入群聊消息出现错误, 丢弃{len(rows)}条: {e}')
+                self.attempts = 0
+                with self.cond:
+                    self.stats['failed'] += len(rows)
+                return 0
+            self.attempts = 0
+            self.retryAt = 0
+            elapsed = time.perf_counter() - start
+            with self.cond:
+                self.stats['written'] += len(rows)
+                self.stats['batches'] += 1
+                self.stats['maxBatch'] = max(self.stats['maxBatch'], len(rows))
+                self.stats['flushTotal'] += elapsed
+                self.stats['flushMax'] = max(self.stats['flushMax'], elapsed)
+            return len(rows)
+
+    def retryLater(self, rows, error):
+        """
+        写入失败的消息放回队首, 保持写入顺序; 连续失败超过 maxRetries 次后丢弃
+        调用方持有 flushLock
+        """
+        self.attempts += 1
+        if self.attempts > self.maxRetries:
+            logger.error(f'[-]: 批量写入群聊消息重试{self.maxRetries}次仍失败, 丢弃{len(rows)}条: {error}')
+            self.attempts = 0
+            self.retryAt = 0
+            with self.cond:
+                self.stats['discarded'] += len(rows)
+            return
+        delay = min(self.retryDelay * 2 ** (self.attempts - 1), self.retryMax)
+        self.retryAt = time.monotonic() + delay
+        logger.warning(f'[-]: 批量写入群聊消息失败, {delay:.1f}秒后第{self.attempts}次重试{len(rows)}条: {error}')
+        with self.cond:
+            self.pending[:0] = rows
+            self.stats['retried'] += 1
+
+    def shutdown(self, timeout=10):
+        """
+        停止后台线程, 并同步写入剩余消息, 写入失败时按退避时间重试
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.running():
+            self.thread.join(timeout)
+        self.thread = None
+        self.flush()
+        while self.attempts:
+            time.sleep(max(0, self.retryAt - time.monotonic()))
+            self.flush()
+
+    def metrics(self):
+        with self.cond:
+            data = dict(self.stats)
+            data['depth'] = len(self.pending)
+        flushTotal = data.pop('flushTotal')
+        data['flushAvgMs'] = round(flushTotal / data['batches'] * 1000, 3) if data['batches'] else 0.0
+        data['flushMaxMs'] = round(data.pop('flushMax') * 1000, 3)
+        return data
+
+chatMsgWriter = ChatMsgWriter()
+
 class DbMsgServer:
     def __init__(self):
         pass
     def addChatMessage(self, wxId, wxName, roomId, content):
-        conn, cursor = openDb(messageDb)
+        if chatMsgWriter.running():
+            return chatMsgWriter.add(wxId, wxName, roomId, content)
+        conn = getDb(messageDb)
         try:
-            today = datetime.now().strftime('%Y-%m-%d')
-            cursor.execute('INSERT INTO chatMessage (wxId, wxName, roomId, content) VALUES (?, ?, ?, ?)', (wxId, wxName, roomId, content))
-            conn.commit()
-            closeDb(conn, cursor)
+            with conn:
+                conn.execute(CHAT_INSERT_SQL, chatRow(wxId, wxName, roomId, content))
             return True
         except Exception as e:
             logger.error(f'新增群聊消息出现错误: {e}')
-            closeDb(conn, cursor)
             return False
     
     def showChatMessage(self, roomId):
-        conn, cursor = openDb(messageDb)
+        # 先写入队列中的消息, 保证能读到刚收到的消息
+        chatMsgWriter.flush()
+        conn = getDb(messageDb)
         try:
-            #TODO != robot and format create time, token limit input 128k
-            cursor.execute("SELECT wxName, content, createTime FROM chatMessage WHERE roomId=? AND ('%Y-%m-%d', createTime, 'localtime') = strftime('%Y-%m-%d', 'now', 'localtime')", (roomId, ))
+            #TODO != robot, token limit input 128k
+            cursor = conn.execute(CHAT_HISTORY_SQL, (roomId, ) + localDayRange())
             result = cursor.fetchall()
-            closeDb(conn, cursor)
             return result
         except Exception as e:
             logger.error(f'查看群聊消息出现错误: {e}')
-            closeDb(conn, cursor)
             return []
 
     def showTodayRank(self, roomId):
-        conn, cursor = openDb(messageDb)
+        chatMsgWriter.flush()
+        conn = getDb(messageDb)
         try:
-            cursor.execute(
-                "select wxName, count(*) as count from chatMessage where chatMessage.roomId = ? and strftime('%Y-%m-%d', createTime, 'localtime') = strftime('%Y-%m-%d', 'now', 'localtime') group by wxId order by count desc;",
-                (roomId,))
+            cursor = conn.execute(CHAT_RANK_SQL, (roomId, ) + localDayRange())
             result = cursor.fetchall()
-            closeDb(conn, cursor)
             return result
         except Exception as e:
             logger.error(f'查看排行榜出现错误: {e}')
-            closeDb(conn, cursor)
             return []
 
     def showLastWeekTalkMembers(self, roomId):
-        conn, cursor = openDb(messageDb)
+        chatMsgWriter.flush()
+        conn = getDb(messageDb)
         try:
-            cursor.execute(
-                "select wxid, wxname from chatMessage where strftime('%Y-%m-%d', createTime) > strftime('%Y-%m-%d', DATE('now', '-7 day', 'localtime')) AND roomId = ? GROUP BY wxId",
-                (roomId,))
+            # 最近 7 个自然日内说过话的成员
+            cursor = conn.execute(CHAT_MEMBERS_SQL, (roomId, ) + localDayRange(days=7))
             result = cursor.fetchall()
-            closeDb(conn, cursor)
             return result
         except Exception as e:
             logger.error(f'查看群聊消息出现错误: {e}')
-            closeDb(conn, cursor)
             return []
 
 if __name__ == '__main__':
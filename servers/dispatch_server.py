@@ -0,0 +1,462 @@
+import re
+import sys
+import time
+import zlib
+import itertools
+import threading
+from queue import PriorityQueue
+from collections import OrderedDict, deque
+from utils.common import logger
+
+# 消息优先级, 数值越小越先处理
+PRIORITY_ADMIN = 0          # 管理员指令
+PRIORITY_INTERACTIVE = 1    # 私聊以及群聊@机器人, 需要回复
+PRIORITY_LOG = 2            # 只需记录的群聊消息
+PRIORITY_GH = 3             # 公众号消息
+priorityNames = {
+    PRIORITY_ADMIN: 'admin',
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_LOG: 'log',
+    PRIORITY_GH: 'gh',
+}
+
+def classifyMsg(msg, selfWxid, superAdmins=(), adminWords=(), adminCommands=None):
+    """
+    在分发前对消息做廉价分类, 不访问数据库
+    :param msg: WxMsg 对象
+    :param selfWxid: 机器人 wxid
+    :param superAdmins: 超级管理员列表
+    :param adminWords: 所有管理指令关键词
+    :param adminCommands: 超级管理员私聊指令表 CommandTable, 指令带参数时按前缀匹配
+    :return: 优先级
+    """
+    if msg.sender.startswith('gh_'):
+        return PRIORITY_GH
+    if msg.type == 1:
+        # 群管理员指令形如 "@张三 踢", 去掉@部分后与关键词完全一致
+        content = re.sub(r"@.*?[\u2005|\s]", "", msg.content).strip()
+        if content and content in adminWords:
+            return PRIORITY_ADMIN
+        # 超级管理员只有指令才优先处理, 普通聊天按下面的规则分类
+        if msg.sender in superAdmins and adminCommands is not None and adminCommands.match(msg.content.strip()) is not None:
+            return PRIORITY_ADMIN
+    if not msg.from_group():
+        return PRIORITY_INTERACTIVE
+    if msg.type in (1, 49) and msg.is_at(selfWxid):
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_LOG
+
+class MsgDeduper:
+    def __init__(self, maxSize=10000, window=600):
+        """
+        按 msg.id 过滤重复消息, 断线重连后 wcferry 可能重复推送
+        :param maxSize: 最多记住的消息数, 超出后淘汰最早的
+        :param window: 记住消息的秒数, 0 表示只按数量淘汰
+        """
+        self.maxSize = maxSize
+        self.window = window
+        self.lock = threading.Lock()
+        self.seenIds = OrderedDict()
+        self.checked = 0
+        self.suppressed = 0
+
+    def isDuplicate(self, msg):
+        """
+        :return: 是否为已处理过的消息
+        """
+        msgId = msg.id
+        if not msgId:
+            return False
+        now = time.time()
+        with self.lock:
+            self.checked += 1
+            # 淘汰超出时间窗口的记录, 按插入顺序从最早的开始
+            if self.window:
+                while self.seenIds:
+                    if now - next(iter(self.seenIds.values())) <= self.window:
+                        break
+                    self.seenIds.popitem(last=False)
+            if msgId in self.seenIds:
+                self.suppressed += 1
+                return True
+            self.seenIds[msgId] = now
+            if len(self.seenIds) > self.maxSize:
+                self.seenIds.popitem(last=False)
+            return False
+
+    def metrics(self):
+        with self.lock:
+            return {'checked': self.checked, 'suppressed': self.suppressed, 'size': len(self.seenIds)}
+
+# 降级处理结果
+SHED_NONE = 'none'          # 正常处理
+SHED_STALE = 'stale'        # 消息过期
+SHED_OVERLOAD = 'overload'  # 系统过载
+
+class LoadShedder:
+    def __init__(self, maxMsgAge=120, overloadDepth=500, busyReply='消息太多啦，稍后再来问我吧~'):
+        """
+        根据消息时效和队列积压判断是否降级处理: 降级后只记录消息, 不调用 LLM
+        :param maxMsgAge: 消息最长有效秒数, 按 WxMsg.ts 计算, 0 表示不限制
+        :param overloadDepth: 队列积压达到该值时进入过载模式, 0 表示不限制
+        :param busyReply: 降级时给需要回复的消息发送的提示
+        """
+        self.maxMsgAge = maxMsgAge
+        self.overloadDepth = overloadDepth
+        self.busyReply = busyReply
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def judge(self, msg, priority, depth):
+        """
+        :param msg: WxMsg 对象
+        :param priority: 消息优先级
+        :param depth: 当前队列积压
+        :return: SHED_NONE / SHED_STALE / SHED_OVERLOAD
+        """
+        # 管理员指令从不降级
+        if priority == PRIORITY_ADMIN:
+            return SHED_NONE
+        decision = SHED_NONE
+        if self.isStale(msg):
+            decision = SHED_STALE
+        elif self.overloadDepth and depth >= self.overloadDepth:
+            decision = SHED_OVERLOAD
+        if decision != SHED_NONE:
+            self.count(decision, priority)
+        return decision
+
+    def isStale(self, msg):
+        """
+        :return: 消息是否已超过 maxMsgAge, 排队较久的异步协程开始执行时再次判断
+        """
+        ts = getattr(msg, 'ts', 0)
+        return bool(self.maxMsgAge and ts and time.time() - ts > self.maxMsgAge)
+
+    def count(self, decision, priority):
+        name = priorityNames.get(priority, str(priority))
+        with self.lock:
+            counts = self.counts.setdefault(decision, {})
+            counts[name] = counts.get(name, 0) + 1
+
+    def metrics(self):
+        with self.lock:
+            return {decision: dict(counts) for decision, counts in self.counts.items()}
+
+def shedOrHandle(shedder, handler, msg, priority, depth):
+    """
+    在处理线程中执行, 此时再判断消息是否已过期或系统是否过载
+    :param shedder: LoadShedder 实例
+    :param handler: 消息处理器
+    :param depth: 当前队列积压, asyncio 运行模式下应包含事件循环上未完成的协程数
+    """
+    decision = shedder.judge(msg, priority, depth)
+    if decision == SHED_NONE:
+        handler.mainHandle(msg)
+    else:
+        logger.warning(f'[-]: 消息降级处理({decision}): {msg.type} {msg.sender} {msg.roomid}')
+        handler.shedHandle(msg, shedder.busyReply)
+
+class DispatchStats:
+    def __init__(self):
+        """
+        消息分发统计: 提交/处理/丢弃数量, 队列深度与排队等待时间, 并按优先级分别统计
+        """
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.maxDepth = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+        self.classes = {}
+
+    def classStats(self, priority):
+        stats = self.classes.get(priority)
+        if stats is None:
+            stats = self.classes[priority] = {'submitted': 0, 'processed': 0, 'dropped': 0, 'waitTotal': 0.0, 'waitMax': 0.0}
+        return stats
+
+    def onSubmit(self, depth, priority):
+        with self.lock:
+            self.submitted += 1
+            self.classStats(priority)['submitted'] += 1
+            if depth > self.maxDepth:
+                self.maxDepth = depth
+
+    def onDrop(self, priority):
+        with self.lock:
+            self.dropped += 1
+            self.classStats(priority)['dropped'] += 1
+
+    def onDone(self, wait, priority, ok=True):
+        with self.lock:
+            self.processed += 1
+            if not ok:
+                self.failed += 1
+            self.waitTotal += wait
+            if wait > self.waitMax:
+                self.waitMax = wait
+            stats = self.classStats(priority)
+            stats['processed'] += 1
+            stats['waitTotal'] += wait
+            if wait > stats['waitMax']:
+                stats['waitMax'] = wait
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'maxDepth': self.maxDepth,
+                'waitAvg': self.waitTotal / self.processed if self.processed else 0.0,
+                'waitMax': self.waitMax,
+                'classes': {priorityNames.get(p, str(p)): dict(stats) for p, stats in self.classes.items()},
+            }
+
+class WorkerPool:
+    def __init__(self, workerNum=8, queueSize=1000, fullPolicy='block', blockTimeout=None, urgentPriority=None, name='消息处理'):
+        """
+        固定线程数的工作池, 按优先级出队, 队列有界, 队列满时按策略阻塞或丢弃
+        带 key 提交的任务同一 key 内严格先进先出, 优先级只决定先处理哪个 key
+        :param workerNum: 工作线程数
+        :param queueSize: 队列长度上限
+        :param fullPolicy: 队列满时的策略 block-阻塞等待 drop-直接丢弃
+        :param blockTimeout: block 策略下最长等待秒数, 超时后丢弃, None 表示一直等待
+        :param urgentPriority: 优先级数值不大于该值的任务不受队列长度限制, 保证洪峰时也能入队, None 表示全部受限
+        :param name: 线程名前缀
+        """
+        if fullPolicy not in ('block', 'drop'):
+            raise ValueError(f'未知的队列满策略: {fullPolicy}')
+        self.workerNum = workerNum
+        self.fullPolicy = fullPolicy
+        self.blockTimeout = blockTimeout
+        self.urgentPriority = urgentPriority
+        self.name = name
+        # 队列长度由 slots 控制, 紧急任务不占用 slot
+        # 队列元素: (优先级, 序号, key, token, 任务), 带 key 的元素只代表"该 key 可以执行下一个任务"
+        self.queue = PriorityQueue()
+        self.slots = threading.BoundedSemaphore(queueSize)
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        # key -> {'tasks': 按提交顺序排队的任务, 'token': 有效队列元素的标记, 'priority': 已入队元素的优先级, 'running': 是否正在执行}
+        self.keyTasks = {}
+        self.pending = 0
+        self.stats = DispatchStats()
+        self.workers = []
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        for i in range(self.workerNum):
+            worker = threading.Thread(target=self.workerLoop, name=f'{self.name}-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        return self
+
+    def submit(self, func, *args, priority=PRIORITY_LOG, key=None):
+        """
+        提交任务, 同一优先级内先进先出
+        :param key: 会话 key, 同一 key 的任务不论优先级都按提交顺序依次执行, None 表示只按优先级排序
+        :return: 是否成功入队
+        """
+        bounded = self.urgentPriority is None or priority > self.urgentPriority
+        if bounded:
+            if self.fullPolicy == 'block':
+                acquired = self.slots.acquire(timeout=self.blockTimeout)
+            else:
+                acquired = self.slots.acquire(blocking=False)
+            if not acquired:
+                self.stats.onDrop(priority)
+                logger.warning(f'[-]: {self.name}队列已满, 丢弃任务: {getattr(func, "__name__", func)}')
+                return False
+        task = (priority, time.time(), bounded, func, args)
+        with self.lock:
+            self.pending += 1
+            depth = self.pending
+            if key is None:
+                self.queue.put((priority, next(self.seq), None, None, task))
+            else:
+                self.pushKeyed(key, task)
+        self.stats.onSubmit(depth, priority)
+        return True
+
+    def pushKeyed(self, key, task):
+        # 调用方持有 self.lock
+        state = self.keyTasks.get(key)
+        if state is None:
+            state = self.keyTasks[key] = {'tasks': deque(), 'token': 0, 'priority': None, 'running': False}
+        state['tasks'].append(task)
+        # 正在执行时由 finishKeyed 重新入队; 更紧急的任务到达时提升整个 key 的优先级, 旧元素作废
+        if not state['running'] and (state['priority'] is None or task[0] < state['priority']):
+            self.scheduleKey(key, state, task[0])
+
+    def scheduleKey(self, key, state, priority):
+        # 调用方持有 self.lock
+        state['token'] += 1
+        state['priority'] = priority
+        self.queue.put((priority, next(self.seq), key, state['token'], None))
+
+    def takeKeyed(self, key, token):
+        """
+        :return: 该 key 最早提交的任务, 队列元素已作废时返回 None
+        """
+        with self.lock:
+            state = self.keyTasks.get(key)
+            if state is None or state['running'] or state['token'] != token:
+                return None
+            state['running'] = True
+            state['priority'] = None
+            return state['tasks'].popleft()
+
+    def finishKeyed(self, key):
+        with self.lock:
+            state = self.keyTasks[key]
+            state['running'] = False
+            if state['tasks']:
+                self.scheduleKey(key, state, min(task[0] for task in state['tasks']))
+            else:
+                del self.keyTasks[key]
+
+    def workerLoop(self):
+        while True:
+            _, _, key, token, task = self.queue.get()
+            if key is not None:
+                task = self.takeKeyed(key, token)
+                if task is None:
+                    self.queue.task_done()
+                    continue
+            elif task is None:
+                self.queue.task_done()
+                break
+            priority, enqueueTime, bounded, func, args = task
+            with self.lock:
+                self.pending -= 1
+            if bounded:
+                self.slots.release()
+            wait = time.time() - enqueueTime
+            ok = True
+            try:
+                func(*args)
+            except Exception as e:
+                ok = False
+                logger.error(f'[-]: {self.name}任务执行出错: {e}')
+            finally:
+                self.stats.onDone(wait, priority, ok)
+                if key is not None:
+                    self.finishKeyed(key)
+                self.queue.task_done()
+
+    def depth(self):
+        with self.lock:
+            return self.pending
+
+    def metrics(self):
+        data = self.stats.snapshot()
+        data['depth'] = self.depth()
+        return data
+
+    def join(self):
+        """
+        等待队列中已有任务全部执行完
+        """
+        self.queue.join()
+
+    def shutdown(self, wait=True):
+        if not self.running:
+            return
+        self.running = False
+        for _ in self.workers:
+            # 退出标记排在所有任务之后
+            self.queue.put((sys.maxsize, next(self.seq), None, None, None))
+        if wait:
+            for worker in self.workers:
+                worker.join()
+        self.workers = []
+
+class LaneExecutor:
+    def __init__(self, laneNum=8, queueSize=200, fullPolicy='block', blockTimeout=None, urgentPriority=None, name='消息通道'):
+        """
+        按 key 分通道执行: 同一 key(群聊/私聊)的任务在同一通道内按提交顺序执行, 不同通道之间并行
+        通道内优先级只决定先处理哪个 key, 不会让同一会话后到的消息插队
+        :param laneNum: 通道数
+        :param queueSize: 每个通道的队列长度上限
+        :param fullPolicy: 队列满时的策略 block-阻塞等待 drop-直接丢弃
+        :param blockTimeout: block 策略下最长等待秒数
+        :param urgentPriority: 不受队列长度限制的优先级上限, 这类任务在单独的紧急通道中执行, 不会排在同一会话耗时的 LLM 调用后面
+        :param name: 线程名前缀
+        """
+        self.laneNum = laneNum
+        self.urgentPriority = urgentPriority
+        self.lanes = [
+            WorkerPool(workerNum=1, queueSize=queueSize, fullPolicy=fullPolicy, blockTimeout=blockTimeout,
+                       urgentPriority=urgentPriority, name=f'{name}{i}')
+            for i in range(laneNum)
+        ]
+        # 紧急任务之间仍按会话保持顺序, 但可能先于同一会话更早提交的普通任务执行
+        self.urgentLane = None
+        if urgentPriority is not None:
+            self.urgentLane = WorkerPool(workerNum=1, queueSize=queueSize, fullPolicy=fullPolicy, blockTimeout=blockTimeout,
+                                         urgentPriority=urgentPriority, name=f'{name}紧急')
+
+    def allLanes(self):
+        return (self.lanes + [self.urgentLane]) if self.urgentLane is not None else self.lanes
+
+    def start(self):
+        for lane in self.allLanes():
+            lane.start()
+        return self
+
+    def laneIndex(self, key):
+        # crc32 在不同进程间结果稳定, 不受 PYTHONHASHSEED 影响
+        return zlib.crc32(key.encode('utf-8')) % self.laneNum
+
+    def submit(self, key, func, *args, priority=PRIORITY_LOG):
+        if self.urgentLane is not None and priority <= self.urgentPriority:
+            return self.urgentLane.submit(func, *args, priority=priority, key=key)
+        return self.lanes[self.laneIndex(key)].submit(func, *args, priority=priority, key=key)
+
+    def depth(self):
+        return sum(lane.depth() for lane in self.allLanes())
+
+    def metrics(self):
+        """
+        返回汇总指标以及每个通道的指标, 汇总包含紧急通道
+        """
+        laneMetrics = [lane.metrics() for lane in self.allLanes()]
+        total = {
+            'submitted': sum(m['submitted'] for m in laneMetrics),
+            'processed': sum(m['processed'] for m in laneMetrics),
+            'dropped': sum(m['dropped'] for m in laneMetrics),
+            'failed': sum(m['failed'] for m in laneMetrics),
+            'depth': sum(m['depth'] for m in laneMetrics),
+            'maxDepth': max(m['maxDepth'] for m in laneMetrics),
+            'waitMax': max(m['waitMax'] for m in laneMetrics),
+        }
+        processed = total['processed']
+        total['waitAvg'] = sum(m['waitAvg'] * m['processed'] for m in laneMetrics) / processed if processed else 0.0
+        classes = {}
+        for m in laneMetrics:
+            for name, stats in m['classes'].items():
+                merged = classes.setdefault(name, {'submitted': 0, 'processed': 0, 'dropped': 0, 'waitTotal': 0.0, 'waitMax': 0.0})
+                for k in ('submitted', 'processed', 'dropped', 'waitTotal'):
+                    merged[k] += stats[k]
+                merged['waitMax'] = max(merged['waitMax'], stats['waitMax'])
+        total['classes'] = classes
+        total['lanes'] = laneMetrics[:self.laneNum]
+        if self.urgentLane is not None:
+            total['urgentLane'] = laneMetrics[-1]
+        return total
+
+    def join(self):
+        for lane in self.allLanes():
+            lane.join()
+
+    def shutdown(self, wait=True):
+        for lane in self.allLanes():
+            lane.shutdown(wait=wait)
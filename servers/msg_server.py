@@ -2,70 +2,95 @@
 import re
 import os
 import shutil
+import asyncio
 from datetime import datetime
-import xml.etree.ElementTree as ET
-from utils.common import logger, returnConfigData, returnPicCacheFolder
+from utils.common import logger, returnConfigData, subscribeConfig, returnPicCacheFolder
 from utils.prompt import intentions_list, welcome_msg
+from utils.wxmsg import MsgEnvelope
 from servers.db_server import DbRoomServer, DbUserServer, DbMsgServer
-from servers.api_server import LLMTaskApi, ApiServer, LLMResponseApi
+from servers.route_server import routeTable
+from servers.contact_server import ContactIndex, RoomMemberCache, AliasCache
+from servers.trigger_server import compileTriggers, registerTrigger, triggerRegistry, AdminCommand, CommandTable
+from servers.api_server import LLMTaskApi, ApiServer, LLMResponseApi, AsyncLLMResponseApi
+from servers.dispatch_server import SHED_STALE, PRIORITY_INTERACTIVE
 
 class MsgHandler:
-    def __init__(self, wcf):
+    def __init__(self, wcf, contacts=None, members=None, aliases=None):
+        """
+        :param contacts: 共享的 ContactIndex, 不传则单独创建
+        :param members: 共享的 RoomMemberCache, 不传则单独创建
+        :param aliases: 共享的 AliasCache, 不传则单独创建
+        """
         self.wcf = wcf
         self.wxid = wcf.get_self_wxid()
         self.wxname = wcf.get_user_info().get('name')
         self.dus = DbUserServer()
         self.drs = DbRoomServer()
         self.dms = DbMsgServer()
+        self.rt = routeTable
+        self.contacts = contacts if contacts is not None else ContactIndex(wcf)
+        self.members = members if members is not None else RoomMemberCache(wcf)
+        self.aliases = aliases if aliases is not None else AliasCache(wcf, self.members)
         self.lta = LLMTaskApi()
         self.lra = LLMResponseApi()
         self.aps = ApiServer()
-        configData = returnConfigData()
-        self.superAdmins = configData['Administrators']
-        self.adminFunctionWord = configData['adminFunctionWord']
-        self.roomKeyWord = configData['roomKeyWord']
-        self.bot_name = configData['systemConfig']['robotName']
+        self.loadConfig(returnConfigData())
+        # 配置文件修改后同步更新
+        subscribeConfig(self.loadConfig)
         self.difyImgConId = {}
+        self.asyncRuntime = None
+        self.alra = None
+        self.shedder = None
         # self.whiteUsers = set([item[0] for item in self.dus.showUser()])
         # self.whiteRooms = set([item[0] for item in self.drs.showWhiteRoom()]) # 示例：[('5xx8@chatroom', 'xx群')]
   
+    def loadConfig(self, configData):
+        self.superAdmins = configData['Administrators']
+        self.adminFunctionWord = configData['adminFunctionWord']
+        self.roomKeyWord = configData['roomKeyWord']
+        self.bot_name = configData['systemConfig']['robotName']
+        self.triggerTrie = compileTriggers(configData.get('customKeyWord'))
+
     def judgeSuperAdmin(self, wxId):
         return wxId in self.superAdmins
+
+    def attachAsyncRuntime(self, runtime, shedder=None):
+        """
+        开启 asyncio 运行模式: coreFunction 中的 LLM 调用交给事件循环执行
+        :param runtime: AsyncRuntime 实例
+        :param shedder: LoadShedder 实例, 协程拿到会话锁和并发名额后再判断一次消息是否已过期
+        """
+        self.asyncRuntime = runtime
+        self.shedder = shedder
+        self.alra = AsyncLLMResponseApi(base=self.lra)
     
     def getWxName(self, wxid):
         """
         获取好友或者群聊昵称
         """
-        name_list = self.wcf.query_sql("MicroMsg.db",
-                                f"SELECT NickName FROM Contact WHERE UserName = '{wxid}';")
-        if not name_list:
-            return ''
-        name = name_list[0]['NickName']
-        return name
+        return self.contacts.getName(wxid)
 
     def getWxId(self, wxname):
         """
         获取好友或者群聊wxid
         """
-        name_list = self.wcf.query_sql("MicroMsg.db",
-                                f"SELECT UserName FROM Contact WHERE NickName = '{wxname}';")
-        if not name_list:
-            return ''
-        name = name_list[0]['UserName']
-        return name
+        return self.contacts.getWxId(wxname)
+
+    def getAlias(self, wxid, roomId):
+        """
+        获取群昵称
+        """
+        return self.aliases.get(wxid, roomId)
        
     def getAtData(self, msg):
         noAtMsg = msg.content
         try:
-            root_xml = ET.fromstring(msg.xml)
-            atUserListsElement = root_xml.find('.//atuserlist')
-            atUserLists = atUserListsElement.text.replace(' ', '').strip().strip(',').split(
-                ',') if atUserListsElement is not None else None
+            atUserLists = list(MsgEnvelope.wrap(msg).atUserList)
             if not atUserLists:
                 return [], ''
             atNames = []
             for atUser in atUserLists:
-                atUserName = self.wcf.get_alias_in_chatroom(atUser, msg.roomid)
+                atUserName = self.getAlias(atUser, msg.roomid)
                 atNames.append(atUserName)
             for atName in atNames:
                 noAtMsg = noAtMsg.replace('@' + atName, '')
@@ -78,18 +103,12 @@ class MsgHandler:
         sender = msg.sender
         roomId = msg.roomid
         isRoom = msg.from_group()
+        # 失败重试和限流由发送队列 SendServer 负责, 这里只提交
         if isRoom:
             status = self.wcf.send_text(msg=self.renderAtPrefix(sender, roomId) + text, receiver=roomId, aters=sender)
-            logger.info(f'消息发送状态: {status}')
-            if not status == 0:
-                status = self.wcf.send_text(msg=self.renderAtPrefix(sender, roomId) + text, receiver=roomId, aters=sender)
-                logger.info(f'消息重发状态: {status}')    
         else:
             status = self.wcf.send_text(msg=text, receiver=sender)
-            logger.info(f'消息发送状态: {status}')
-            if not status == 0:
-                status = self.wcf.send_text(msg=text, receiver=sender)
-                logger.info(f'消息重发状态: {status}')
+        logger.info(f'消息发送状态: {status}')
 
     def sendFileMsg(self, msg, path, fileType='pic'):
         isRoom = msg.from_group()
@@ -100,6 +119,7 @@ class MsgHandler:
             self.wcf.send_file(path=path, receiver=receiver)
 
     def receiveImgMsg(self, msg):
+        msg = MsgEnvelope.wrap(msg)
         logger.info(f'收到图片消息: {msg.extra}')
         picPath = returnPicCacheFolder()
         img_path = self.wcf.download_image(msg.id, msg.extra, picPath)
@@ -110,56 +130,39 @@ class MsgHandler:
         answer = self.lra.isAdPic(os.path.join(picPath, new_name))
         logger.info(f'图片是否为广告图片: {answer}')
         if answer == '是':
+            logger.warning(f'检测到广告图片: {msg.sender} {msg.roomid}')
             #self.sendTextMsg(msg, '你小子是不是准备发广告？小心被群主发现！')
-            nickname = self.getWxName(msg.sender)
-            roomname = self.getWxName(msg.roomid)
-            for admin in self.superAdmins:    
-                msg.sender = admin
-                msg.roomid = admin
-                #self.sendTextMsg(msg, f"{nickname}在{roomname}群发广告啦！")
-
-    def triggerFunction(self, msg, triggerType, triggerWords, chatid):
-        content = msg.content.strip()
-        if not any(content.startswith(t) for t in triggerWords):
-            return False
-        # TODO modify
-        # if triggerType == 'gzhRetrive':
-        #     # 调用指定公众号文章进行回复
-        #     response = self.aps.get_yuanqi(content)
-        #     self.sendTextMsg(msg, response)
-        #     self.lra.updateMessage(chatid, [msg.content, response])
-        #     # 保存消息到数据库
-        #     self.addChatMsg(self.wxid, self.bot_name, chatid, response)
-        #elif triggerType == 'difySearch':
-            # 调用dify搜索智能体进行回复
-           # pre_text = f'{self.bot_name}正在调用搜索引擎为您服务，请耐心等待哦，预计20-60s'
-            #self.sendTextMsg(msg, pre_text)
-           # response = self.lta.difySearch(content, user=self.bot_name)
-            #self.sendTextMsg(msg, response)
-           # self.lra.updateMessage(chatid, [msg.content, response])
-           # self.addChatMsg(self.wxid, self.bot_name, chatid, response)
-        # elif triggerType == 'beikeRetrive':
-        #     match = re.search(r'\d+', content)
-        #     if content.startswith('挂牌'):
-        #         bot_answer = f'https://yc.ke.com/ershoufang/{match.group()}.html' if match else '请输入正确的挂牌房源号'
-        #     elif content.startswith('成交'):
-        #         bot_answer = f'https://yc.ke.com/chengjiao/{match.group()}.html' if match else '请输入正确的成交房源号'
-        #     else:
-        #         bot_answer = '请输入正确的指令'
-        #     self.sendTextMsg(msg, bot_answer)
-        elif triggerType == 'KfcKeyWords':   
-            response = self.aps.getKfc()
-            self.sendTextMsg(msg, response)
-        elif triggerType == 'TopWords':
-            ranks = self.dms.showTodayRank(chatid)
-            rank_contents = '\n'.join([f'{rank[0]}: {rank[1]}' for rank in ranks])
-            content = self.lta.getTopSummary(rank_contents)
-            self.sendTextMsg(msg, content)
-        else:
+            # 通知超级管理员, 暂未启用
+            # nickname = self.getWxName(msg.sender)
+            # roomname = self.getWxName(msg.roomid)
+            # for admin in self.superAdmins:
+            #     self.sendTextMsg(msg.replace(sender=admin, roomid=admin), f"{nickname}在{roomname}群发广告啦！")
+
+    def runTrigger(self, msg, triggerType, content, chatid):
+        """
+        执行已注册的触发器, 未注册的类型回复提示
+        :return: 是否已处理
+        """
+        func = triggerRegistry.get(triggerType)
+        if func is None:
             bot_answer = f'[-]: 未知的触发器类型: {triggerType}, 请检查配置'
             self.sendTextMsg(msg, bot_answer)
+        else:
+            func(self, msg, content, chatid)
         return True
 
+    @registerTrigger('KfcKeyWords')
+    def kfcTrigger(self, msg, content, chatid):
+        response = self.aps.getKfc()
+        self.sendTextMsg(msg, response)
+
+    @registerTrigger('TopWords')
+    def topWordsTrigger(self, msg, content, chatid):
+        ranks = self.dms.showTodayRank(chatid)
+        rank_contents = '\n'.join([f'{rank[0]}: {rank[1]}' for rank in ranks])
+        content = self.lta.getTopSummary(rank_contents)
+        self.sendTextMsg(msg, content)
+
     def getOrUpdateDifyImgConId(self, chatid, conId=''):
         if not conId:
             return self.difyImgConId.get(chatid, '')
@@ -167,17 +170,27 @@ class MsgHandler:
             self.difyImgConId[chatid] = conId
             return conId
        
+    def runTriggers(self, msg, chatid):
+        """
+        自定义关键词触发功能
+        :return: 是否有关键词被触发
+        """
+        # 加载配置时已编译为前缀树, 一次遍历找到最长匹配的关键词
+        content = msg.content.strip()
+        matched = self.triggerTrie.match(content)
+        if matched is None:
+            return False
+        return self.runTrigger(msg, matched[1], content, chatid)
+
     def coreFunction(self, msg):
-        response = ""
         chatid = msg.roomid if msg.from_group() else msg.sender
+        # asyncio 运行模式下交给事件循环处理, 同一会话按顺序执行
+        if self.asyncRuntime is not None:
+            self.asyncRuntime.submit(self.coreFunctionAsync(msg), key=chatid)
+            return
+        response = ""
         # 1. 自定义关键词触发功能
-        tStatus = []
-        for tType, tWords in returnConfigData()['customKeyWord'].items():
-            if not isinstance(tWords, list):
-                tWords = [tWords]
-            status = self.triggerFunction(msg, tType, tWords, chatid)
-            tStatus.append(status)
-        if any(tStatus):
+        if self.runTriggers(msg, chatid):
             return
         # 2. 意图识别+AI回复功能：一个群或一个私聊维护一个messages列表
         conversation_list = self.lra.get_conversation_list(chatid)
@@ -188,7 +201,7 @@ class MsgHandler:
         logger.info(f'意图识别结果：{intention}')
         # 2.0 未识别到指定意图，返回正常回复，否则根据意图进行相应的操作
         if intention not in intentions_list:
-            if msg.from_group() and not self.drs.searchResponseRoom(chatid):
+            if msg.from_group() and not self.rt.isResponseRoom(chatid):
                 self.sendTextMsg(msg, "聊天功能暂时关闭咯~")
             else:
                 response = self.lra.generalResponse(messages, self.bot_name)
@@ -217,49 +230,79 @@ class MsgHandler:
         if response != "":
             self.addChatMsg(self.wxid, self.bot_name, chatid, response)
 
+    async def coreFunctionAsync(self, msg):
+        """
+        coreFunction 的异步版本, LLM 调用在事件循环上等待, 数据库和发送等短耗时操作放到线程中执行
+        """
+        response = ""
+        chatid = msg.roomid if msg.from_group() else msg.sender
+        # 0. 在会话锁和并发名额上排队期间消息可能已过期, 不再调用 LLM
+        if self.shedder is not None and self.shedder.isStale(msg):
+            self.shedder.count(SHED_STALE, PRIORITY_INTERACTIVE)
+            logger.warning(f'[-]: 消息排队后已过期, 不再回复: {msg.sender} {msg.roomid}')
+            if self.shedder.busyReply:
+                await asyncio.to_thread(self.sendTextMsg, msg, self.shedder.busyReply)
+            return
+        # 1. 自定义关键词触发功能
+        if await asyncio.to_thread(self.runTriggers, msg, chatid):
+            return
+        # 2. 意图识别+AI回复功能
+        conversation_list = self.alra.get_conversation_list(chatid)
+        messages = [item[1] for item in conversation_list]
+        messages.append({'role': 'user', 'content': msg.content})
+        intention = await self.alra.intentionRec(messages)
+        logger.info(f'意图识别结果：{intention}')
+        # 2.0 未识别到指定意图，返回正常回复，否则根据意图进行相应的操作
+        if intention not in intentions_list:
+            if msg.from_group() and not self.rt.isResponseRoom(chatid):
+                await asyncio.to_thread(self.sendTextMsg, msg, "聊天功能暂时关闭咯~")
+            else:
+                response = await self.alra.generalResponse(messages, self.bot_name)
+                await asyncio.to_thread(self.sendTextMsg, msg, response)
+                self.alra.updateMessage(chatid, [msg.content, response])
+        # 2.1 天气预报
+        elif intention == '天气':
+            response = await self.alra.weatherResponse(msg.content, self.bot_name)
+            await asyncio.to_thread(self.sendTextMsg, msg, response)
+            self.alra.updateMessage(chatid, [msg.content, response])
+
+        # 保存消息到数据库
+        if response != "":
+            await asyncio.to_thread(self.addChatMsg, self.wxid, self.bot_name, chatid, response)
+
     def parseMsg(self, msg):
         """
         引用 type=57；公众号 type=5；视频号 type=51；音乐 type=92
         """
-        root = ET.fromstring(msg.content)
-        appmsg = root.find('appmsg')
-        eType = appmsg.find('type').text
+        msg = MsgEnvelope.wrap(msg)
+        eType = msg.appType
         if eType == '57': # 引用消息
             if msg.from_group() and (not msg.is_at(self.wxid)):
                 return 
-            curText = appmsg.find('title').text
-            oriType = appmsg.find('refermsg').find('type').text
-            oriContent = appmsg.find('refermsg').find('content').text
-            oriWxId = root.find('fromusername').text
+            curText = msg.appTitle
+            oriType, oriContent = msg.refer
+            oriWxId = msg.fromUser
             oriName = self.getWxName(oriWxId)
             logger.info(f'收到引用消息: {curText}, {oriType}, {oriContent}, {oriWxId}, {oriName}')
             if oriType == '1': # 文本消息
                 content = curText + f'\n引用{oriName}的消息：{oriContent}'
-                msg.content = content
+                msg = msg.replace(content=content)
                 logger.info(f'处理后的消息: {content}')
                 self.addChatMsg(msg.sender, self.getWxName(msg.sender), msg.roomid, msg.content)
             else:
                 # TODO: 处理图片、视频、语音等消息
-                msg.content = curText
+                msg = msg.replace(content=curText)
                 logger.info(f'暂不支持引用{oriType}消息 {oriContent}')
             self.coreFunction(msg)
         elif eType == '5': # 公众号消息
             # TODO: url 无法获取内容，待解决
-            name = appmsg.find('sourcedisplayname').text
-            title = appmsg.find('title').text
-            des = appmsg.find('des').text
-            url = appmsg.find('url').text
-            urlOri = appmsg.find('webviewshared').find('shareUrlOriginal').text
-            urlOpen = appmsg.find('webviewshared').find('shareUrlOpen').text
-            response = f'公众号：{name}\n题目：{title}\n简介：{des}'
-            data = self.lta.genArticleSum(urlOpen)
+            response = f'公众号：{msg.sourceName}\n题目：{msg.appTitle}\n简介：{msg.appDes}'
+            data = self.lta.genArticleSum(msg.shareUrlOpen)
             if data:
                 response += f'\n摘要：{data["content"]}\n发布：{data["date"]}'
             self.sendTextMsg(msg, response)
         elif eType == '51': # 视频号消息
-            finderFeed = root.find('.//finderFeed')
-            objectId = finderFeed.find('./objectId').text
-            objectNonceId = finderFeed.find('./objectNonceId').text
+            objectId, objectNonceId = msg.finderFeed
             response = self.aps.getWxVideo(objectId, objectNonceId)
             self.sendTextMsg(msg, response)
         elif eType == '33': # 小程序消息
@@ -276,16 +319,39 @@ class MsgHandler:
     def addChatMsg(self, wxId, wxName, roomId, content):
         self.dms.addChatMessage(wxId, wxName, roomId, content)
 
+    def shedHandle(self, msg, busyReply=''):
+        """
+        过载或消息过期时的降级处理, 不调用 LLM, 默认直接丢弃
+        """
+        pass
+
 class SingleMsgHandler(MsgHandler):
-    def __init__(self, wcf):
-        super().__init__(wcf)
+    # 超级管理员私聊指令表, 新增指令只需在此登记并实现对应方法
+    adminCommandList = [
+        AdminCommand('addWhiteWord', 'adminAddWhite', ('wxId',)),
+        AdminCommand('delWhiteWord', 'adminDelWhite', ('wxId',)),
+        AdminCommand('addPushWord', 'adminAddPush', ('taskName', 'wxId')),
+        AdminCommand('delPushWord', 'adminDelPush', ('taskName', 'wxId')),
+        AdminCommand('AddResponseWord', 'adminAddResponse', ('wxId',)),
+        AdminCommand('delResponseWord', 'adminDelResponse', ('wxId',)),
+        AdminCommand('ShowResponseWord', 'adminShowResponse', refresh=False),
+        AdminCommand('UnTalkMembers', 'adminUnTalkMembers', ('wxId',), refresh=False),
+    ]
+
+    def __init__(self, wcf, contacts=None, members=None, aliases=None):
+        self.adminCommands = CommandTable(self.adminCommandList)
+        super().__init__(wcf, contacts, members, aliases)
+
+    def loadConfig(self, configData):
+        super().loadConfig(configData)
+        self.adminCommands.load(self.adminFunctionWord)
     
     def autoAcceptFriendRequest(self, msg):
         try:
-            xml = ET.fromstring(msg.content)
-            v3 = xml.attrib["encryptusername"]
-            v4 = xml.attrib["ticket"]
-            scene = int(xml.attrib["scene"])
+            attrib = MsgEnvelope.wrap(msg).contentAttrib
+            v3 = attrib["encryptusername"]
+            v4 = attrib["ticket"]
+            scene = int(attrib["scene"])
             status = self.wcf.accept_new_friend(v3, v4, scene)
             logger.info(f"同意好友请求：{status}")
         except Exception as e:
@@ -300,161 +366,137 @@ class SingleMsgHandler(MsgHandler):
             # self.dus.addUser(msg.sender, msg.roomid)
             # 给超管发通知
             for admin in self.superAdmins:
-                msg.sender = admin
-                self.sendTextMsg(msg, f"{side_nickName[0]}，有好友来了")
+                self.sendTextMsg(MsgEnvelope.wrap(msg).replace(sender=admin), f"{side_nickName[0]}，有好友来了")
         if self_nickName:
             self.sendTextMsg(msg, f"Hi，{self_nickName[0]}，我通过了你的好友请求。\n\n {welcome_msg}")
 
     def superAdminFunction(self, msg):
+        """
+        超级管理员私聊指令, 按 adminCommandList 查表执行
+        :return: 是否为管理指令
+        """
         content = msg.content.strip()
-        status = False
-        # 添加私聊权限
-        addWhiteWord = self.adminFunctionWord['addWhiteWord']
-        if content.startswith(addWhiteWord):
-            status = True
-            wxId = content.replace(addWhiteWord, '').strip()
-            if wxId.endswith('@chatroom'):
-                if self.drs.addWhiteRoom(wxId, self.getWxName(wxId)):
-                    self.sendTextMsg(msg, f'{wxId} 已添加群聊权限')
-                    # self.whiteRooms.add(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 添加群聊权限失败')
+        matched = self.adminCommands.match(content)
+        if matched is None:
+            return False
+        command, word, args = matched
+        if len(args) < len(command.args):
+            self.sendTextMsg(msg, f'参数不足, 用法: {word} {" ".join(command.args)}')
+            return True
+        self.adminCommands.run(command, getattr(self, command.method), msg, *args)
+        # 白名单、回复群等可能已修改, 刷新路由表
+        if command.refresh:
+            self.rt.refresh()
+        return True
+
+    # 添加私聊/群聊权限
+    def adminAddWhite(self, msg, wxId):
+        if wxId.endswith('@chatroom'):
+            if self.drs.addWhiteRoom(wxId, self.getWxName(wxId)):
+                self.sendTextMsg(msg, f'{wxId} 已添加群聊权限')
             else:
-                if self.dus.addUser(wxId, self.getWxName(wxId)):
-                    self.sendTextMsg(msg, f'{wxId} 已添加私聊权限')
-                    # self.whiteUsers.add(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 添加私聊权限失败')
-        # 删除私聊权限
-        delWhiteWord = self.adminFunctionWord['delWhiteWord']
-        if content.startswith(delWhiteWord):
-            status = True
-            wxId = content.replace(addWhiteWord, '').strip()
-            if wxId.endswith('@chatroom'):
-                if self.drs.delWhiteRoom(wxId):
-                    self.sendTextMsg(msg, f'{wxId} 已删除群聊权限')
-                    # self.whiteRooms.remove(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 删除群聊权限失败')
+                self.sendTextMsg(msg, f'{wxId} 添加群聊权限失败')
+        else:
+            if self.dus.addUser(wxId, self.getWxName(wxId)):
+                self.sendTextMsg(msg, f'{wxId} 已添加私聊权限')
             else:
-                if self.dus.delUser(wxId):
-                    self.sendTextMsg(msg, f'{wxId} 已删除私聊权限')
-                    # self.whiteUsers.remove(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 删除私聊权限失败')
-        # 添加推送群
-        addPushWord = self.adminFunctionWord['addPushWord']
-        if content.startswith(addPushWord):
-            status = True
-            parms = content.split(" ")
-            taskName = parms[1]
-            wxId = parms[2]
-            if wxId.endswith('@chatroom'):
-                if self.drs.addPushRoom(taskName, wxId, self.getWxName(wxId)):
-                    self.sendTextMsg(msg, f'{wxId} 已添加推送群')
-                    # self.whiteRooms.add(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 添加推送群失败')
+                self.sendTextMsg(msg, f'{wxId} 添加私聊权限失败')
+
+    # 删除私聊/群聊权限
+    def adminDelWhite(self, msg, wxId):
+        if wxId.endswith('@chatroom'):
+            if self.drs.delWhiteRoom(wxId):
+                self.sendTextMsg(msg, f'{wxId} 已删除群聊权限')
             else:
-                if self.dus.addUser(wxId, self.getWxName(wxId)):
-                    self.sendTextMsg(msg, f'{wxId} 已添加推送群')
-                    # self.whiteUsers.add(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 添加推送群失败')
-        # 删除推送群
-        delPushWord = self.adminFunctionWord['delPushWord']
-        if content.startswith(delPushWord):
-            status = True
-            wxId = content.replace(delPushWord, '').strip()
-            if wxId.endswith('@chatroom'):
-                if self.drs.delPushRoom(wxId):
-                    self.sendTextMsg(msg, f'{wxId} 已删除推送群')
-                    # self.whiteRooms.add(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 删除推送群失败')
+                self.sendTextMsg(msg, f'{wxId} 删除群聊权限失败')
+        else:
+            if self.dus.delUser(wxId):
+                self.sendTextMsg(msg, f'{wxId} 已删除私聊权限')
             else:
-                if self.dus.delUser(wxId, self.getWxName(wxId)):
-                    self.sendTextMsg(msg, f'{wxId} 已删除推送群')
-                    # self.whiteUsers.add(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 删除推送群失败')
-
-         # 增加回复群
-        AddResponseWord = self.adminFunctionWord['AddResponseWord']
-        if content.startswith(AddResponseWord):
-            status = True
-            wxId = content.replace(AddResponseWord, '').strip()
-            if wxId.endswith('@chatroom'):
-                if self.drs.addResponseRoom(wxId, self.getWxName(wxId)):
-                    self.sendTextMsg(msg, f'{wxId} 已添加回复群')                    
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 添加回复群失败')
+                self.sendTextMsg(msg, f'{wxId} 删除私聊权限失败')
+
+    # 添加推送群
+    def adminAddPush(self, msg, taskName, wxId):
+        if wxId.endswith('@chatroom'):
+            if self.drs.addPushRoom(taskName, wxId, self.getWxName(wxId)):
+                self.sendTextMsg(msg, f'{wxId} 已添加推送群')
             else:
-                if self.dus.delUser(wxId, self.getWxName(wxId)):
-                    self.sendTextMsg(msg, f'{wxId} 已添加回复群')
-                    # self.whiteUsers.add(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 添加回复群失败')
-
-        # 删除回复群
-        delResponseWord = self.adminFunctionWord['delResponseWord']
-        if content.startswith(delResponseWord):
-            status = True
-            wxId = content.replace(delResponseWord, '').strip()
-            if wxId.endswith('@chatroom'):
-                if self.drs.delResponseRoom(wxId):
-                    self.sendTextMsg(msg, f'{wxId} 已删除回复群')                    
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 删除回复群失败')
+                self.sendTextMsg(msg, f'{wxId} 添加推送群失败')
+        else:
+            if self.dus.addUser(wxId, self.getWxName(wxId)):
+                self.sendTextMsg(msg, f'{wxId} 已添加推送群')
             else:
-                if self.dus.delUser(wxId, self.getWxName(wxId)):
-                    self.sendTextMsg(msg, f'{wxId} 已删除回复群')
-                    # self.whiteUsers.add(wxId)
-                else:
-                    self.sendTextMsg(msg, f'{wxId} 删除回复群失败')
-
-        # 查询回复群
-        ShowResponseWord = self.adminFunctionWord['ShowResponseWord']
-        if content.startswith(ShowResponseWord):
-            status = True
-            wxId = content.replace(ShowResponseWord, '').strip()
-            response = self.drs.showResponseRoom()
-            self.sendTextMsg(msg, f'回复群如下:\n{response}')
-
-        # 7天未说话
-        UnTalkMembers = self.adminFunctionWord['UnTalkMembers']
-        if content.startswith(UnTalkMembers):
-            status = True
-            wxId = content.replace(UnTalkMembers, '').strip()
-            if wxId.endswith('@chatroom'):
-                talkMemberResult = dict(self.dms.showLastWeekTalkMembers(wxId))
-                roomMembers = self.wcf.get_chatroom_members(wxId)
-                untalkMembers = {key: roomMembers[key] for key in roomMembers.keys() - talkMemberResult.keys()}
-                content = '\n'.join([f'{item}' for item in untalkMembers.values()])
-                if content:
-                    self.sendTextMsg(msg, f'7天未说话列表如下\n{content}')
-                else:
-                    self.sendTextMsg(msg, f'7天未说话列表为空')
-        
-        return status
-    
+                self.sendTextMsg(msg, f'{wxId} 添加推送群失败')
+
+    # 删除推送群
+    def adminDelPush(self, msg, taskName, wxId):
+        if wxId.endswith('@chatroom'):
+            if self.drs.delPushRoom(taskName, wxId, self.getWxName(wxId)):
+                self.sendTextMsg(msg, f'{wxId} 已删除推送群')
+            else:
+                self.sendTextMsg(msg, f'{wxId} 删除推送群失败')
+        else:
+            if self.dus.delUser(wxId):
+                self.sendTextMsg(msg, f'{wxId} 已删除推送群')
+            else:
+                self.sendTextMsg(msg, f'{wxId} 删除推送群失败')
+
+    # 增加回复群
+    def adminAddResponse(self, msg, wxId):
+        if not wxId.endswith('@chatroom'):
+            self.sendTextMsg(msg, f'{wxId} 不是群聊, 无法添加回复群')
+            return
+        if self.drs.addResponseRoom(wxId, self.getWxName(wxId)):
+            self.sendTextMsg(msg, f'{wxId} 已添加回复群')
+        else:
+            self.sendTextMsg(msg, f'{wxId} 添加回复群失败')
+
+    # 删除回复群
+    def adminDelResponse(self, msg, wxId):
+        if not wxId.endswith('@chatroom'):
+            self.sendTextMsg(msg, f'{wxId} 不是群聊, 无法删除回复群')
+            return
+        if self.drs.delResponseRoom(wxId):
+            self.sendTextMsg(msg, f'{wxId} 已删除回复群')
+        else:
+            self.sendTextMsg(msg, f'{wxId} 删除回复群失败')
+
+    # 查询回复群
+    def adminShowResponse(self, msg):
+        response = self.drs.showResponseRoom()
+        self.sendTextMsg(msg, f'回复群如下:\n{response}')
+
+    # 7天未说话
+    def adminUnTalkMembers(self, msg, wxId):
+        if not wxId.endswith('@chatroom'):
+            return
+        talkMemberResult = dict(self.dms.showLastWeekTalkMembers(wxId))
+        roomMembers = self.members.get(wxId)
+        untalkMembers = {key: roomMembers[key] for key in roomMembers.keys() - talkMemberResult.keys()}
+        content = '\n'.join([f'{item}' for item in untalkMembers.values()])
+        if content:
+            self.sendTextMsg(msg, f'7天未说话列表如下\n{content}')
+        else:
+            self.sendTextMsg(msg, f'7天未说话列表为空')
+
     def joinRoom(self, msg):
         sender = msg.sender
         content = msg.content.strip()
         roomId = self.roomKeyWord[content]
-        roomMember = self.wcf.get_chatroom_members(roomId)
+        roomMember = self.members.get(roomId)
         if len(roomMember) == 500:
             self.sendTextMsg(msg, f'群满员了，请等候再试')
             return
         if sender in roomMember.keys():
             self.sendTextMsg(msg, '你小子已经进群了, 还想干吗[旺柴]')
             return 
-        if self.wcf.invite_chatroom_members(roomId, sender):
+        if self.members.inviteMembers(roomId, sender):
             self.sendTextMsg(msg, '欢迎加入')
         else:
             self.sendTextMsg(msg, '邀请进群失败，请稍后再试')
 
     def mainHandle(self, msg):
+        msg = MsgEnvelope.wrap(msg)
         sender = msg.sender
         # 如果是超级管理员的消息，则进行超级管理员功能
         if self.judgeSuperAdmin(sender) and msg.type == 1:
@@ -477,7 +519,7 @@ class SingleMsgHandler(MsgHandler):
             return 
 
         # 判断是否有私聊权限
-        if not (self.dus.searchUser(sender) or self.judgeSuperAdmin(sender)):
+        if not (self.rt.isWhiteUser(sender) or self.judgeSuperAdmin(sender)):
             return
         
         # 开始处理消息
@@ -487,13 +529,23 @@ class SingleMsgHandler(MsgHandler):
             self.receiveImgMsg(msg)
         elif msg.type == 49: # 引用消息
             self.parseMsg(msg)
+
+    def shedHandle(self, msg, busyReply=''):
+        if msg.type != 1:
+            return
+        # 进群请求不需要 LLM, 照常处理
+        if msg.content.strip() in self.roomKeyWord.keys():
+            self.joinRoom(msg)
+            return
+        if busyReply and (self.rt.isWhiteUser(msg.sender) or self.judgeSuperAdmin(msg.sender)):
+            self.sendTextMsg(msg, busyReply)
         
 class RoomMsgHandler(MsgHandler):
-    def __init__(self, wcf):
-        super().__init__(wcf)
+    def __init__(self, wcf, contacts=None, members=None, aliases=None):
+        super().__init__(wcf, contacts, members, aliases)
     
     def judgeAdmin(self, wxId, roomId):
-        return self.dus.searchAdmin(wxId, roomId)
+        return self.rt.isAdmin(wxId, roomId)
     
     def AdminFunction(self, msg):
         sender = msg.sender
@@ -511,13 +563,13 @@ class RoomMsgHandler(MsgHandler):
         delUserWord = self.adminFunctionWord['delUserWord']
         if noAtMsg.strip() in delUserWord:
             for atWxId in atUserLists:
-                if self.wcf.del_chatroom_members(roomId, atWxId):
+                if self.members.delMembers(roomId, atWxId):
                     self.wcf.send_text(
-                        f'@{self.wcf.get_alias_in_chatroom(atWxId, roomId)} 基于你的表现, 给你移出群聊的奖励',
+                        f'@{self.getAlias(atWxId, roomId)} 基于你的表现, 给你移出群聊的奖励',
                         receiver=roomId)
                 else:
                     self.wcf.send_text(
-                        f'@{self.wcf.get_alias_in_chatroom(sender, roomId)} [{self.wcf.get_alias_in_chatroom(atWxId, roomId)}] 移出群聊失败',
+                        f'@{self.getAlias(sender, roomId)} [{self.getAlias(atWxId, roomId)}] 移出群聊失败',
                         receiver=roomId, aters=sender)
                 
     def superAdminFunction(self, msg):
@@ -537,17 +589,18 @@ class RoomMsgHandler(MsgHandler):
             for atUser in atUserLists:
                 if self.dus.searchAdmin(atUser, roomId):
                     logger.info(f'[-]: {atUser} 已是管理员')
-                    self.wcf.send_text(f'@{self.wcf.get_alias_in_chatroom(sender, roomId)}\n管理员 [{self.wcf.get_alias_in_chatroom(atUser, roomId)}] 已存在',
+                    self.wcf.send_text(f'@{self.getAlias(sender, roomId)}\n管理员 [{self.getAlias(atUser, roomId)}] 已存在',
                                 receiver=roomId, aters=sender)
                 else:
                     status = self.dus.addAdmin(atUser, roomId)
                     if status:
+                        self.rt.refresh()
                         logger.info(f'[+]: {atUser} 已被设置为管理员')
-                        self.wcf.send_text(f'@{self.wcf.get_alias_in_chatroom(sender, roomId)}\n管理员 [{self.wcf.get_alias_in_chatroom(atUser, roomId)}] 添加成功',
+                        self.wcf.send_text(f'@{self.getAlias(sender, roomId)}\n管理员 [{self.getAlias(atUser, roomId)}] 添加成功',
                                     receiver=roomId, aters=sender)
                     else:
                         logger.error(f'[-]: {atUser} 添加管理员失败')
-                        self.wcf.send_text(f'@{self.wcf.get_alias_in_chatroom(sender, roomId)}\n管理员 [{self.wcf.get_alias_in_chatroom(atUser, roomId)}] 添加失败',
+                        self.wcf.send_text(f'@{self.getAlias(sender, roomId)}\n管理员 [{self.getAlias(atUser, roomId)}] 添加失败',
                                     receiver=roomId, aters=sender)
         # 删除管理员
         delAdminWords = self.adminFunctionWord['delAdminWord']
@@ -555,21 +608,22 @@ class RoomMsgHandler(MsgHandler):
             for atUser in atUserLists:
                 if not self.dus.searchAdmin(atUser, roomId):
                     logger.info(f'[-]: {atUser} 不是管理员')
-                    self.wcf.send_text(f'@{self.wcf.get_alias_in_chatroom(sender, roomId)}\n管理员 [{self.wcf.get_alias_in_chatroom(atUser, roomId)}] 不存在',
+                    self.wcf.send_text(f'@{self.getAlias(sender, roomId)}\n管理员 [{self.getAlias(atUser, roomId)}] 不存在',
                                 receiver=roomId, aters=sender)
                 else:
                     status = self.dus.delAdmin(atUser, roomId)
                     if status:
+                        self.rt.refresh()
                         logger.info(f'[+]: {atUser} 已被删除为管理员')
-                        self.wcf.send_text(f'@{self.wcf.get_alias_in_chatroom(sender, roomId)}\n管理员 [{self.wcf.get_alias_in_chatroom(atUser, roomId)}] 删除成功',
+                        self.wcf.send_text(f'@{self.getAlias(sender, roomId)}\n管理员 [{self.getAlias(atUser, roomId)}] 删除成功',
                                     receiver=roomId, aters=sender)
                     else:
                         logger.error(f'[-]: {atUser} 删除管理员失败')
-                        self.wcf.send_text(f'@{self.wcf.get_alias_in_chatroom(sender, roomId)}\n管理员 [{self.wcf.get_alias_in_chatroom(atUser, roomId)}] 删除失败',
+                        self.wcf.send_text(f'@{self.getAlias(sender, roomId)}\n管理员 [{self.getAlias(atUser, roomId)}] 删除失败',
                                     receiver=roomId, aters=sender)
 
     def renderAtPrefix(self, atWxId, roomId):
-        return f'@{self.wcf.get_alias_in_chatroom(atWxId, roomId)} '
+        return f'@{self.getAlias(atWxId, roomId)} '
     
     def joinRoomWelcome(self, msg):
         content = msg.content.strip()
@@ -585,14 +639,17 @@ class RoomMsgHandler(MsgHandler):
             wx_names = wx_names.split('、')
         else:
             wx_names = [wx_names]
+        # 成员数和群名在循环外取一次, 入群消息已让缓存失效, 取到的是最新成员数
+        memberCount = self.members.count(msg.roomid)
+        roomName = self.getWxName(msg.roomid)
         for wx_name in wx_names:
-            roomMember = self.wcf.get_chatroom_members(msg.roomid)
-            text = self.lta.roomWelcome(room_name=self.getWxName(msg.roomid), invitee=wx_name, index=len(roomMember))
-            welcomePrompmtText = self.lta.roomWelcomePrompmt(room_name=self.getWxName(msg.roomid), invitee=wx_name, index=len(roomMember))
+            text = self.lta.roomWelcome(room_name=roomName, invitee=wx_name, index=memberCount)
+            welcomePrompmtText = self.lta.roomWelcomePrompmt(room_name=roomName, invitee=wx_name, index=memberCount)
             self.wcf.send_text(msg=text, receiver=msg.roomid)
             self.wcf.send_text(msg=welcomePrompmtText, receiver=msg.roomid)
             
     def mainHandle(self, msg):
+        msg = MsgEnvelope.wrap(msg)
         roomId = msg.roomid
         sender = msg.sender
 
@@ -603,40 +660,47 @@ class RoomMsgHandler(MsgHandler):
         
         # 入群欢迎
         if msg.type == 10000:
+            self.members.onSystemMsg(msg)
+            self.aliases.onSystemMsg(msg)
             self.joinRoomWelcome(msg)
 
         # 判断是否为白名单群聊
-        if not self.drs.searchWhiteRoom(roomId):
+        if not self.rt.isWhiteRoom(roomId):
             return
         
         # 开始处理消息
         if msg.type == 1: # 文本消息
             self.addChatMsg(sender, self.getWxName(sender), roomId, msg.content)
         if msg.type == 1 and msg.is_at(self.wxid): # 文本消息
-            msg.content = re.sub(r"@.*?[\u2005|\s]", "", msg.content) # 删除 content 字符串中以 @ 开头，后跟任意字符，直到遇到中文空格或普通空白字符的部分
+            msg = msg.replace(content=re.sub(r"@.*?[\u2005|\s]", "", msg.content)) # 删除 content 字符串中以 @ 开头，后跟任意字符，直到遇到中文空格或普通空白字符的部分
             logger.info(f'收到群消息: {msg.content}')
             self.coreFunction(msg)
         elif msg.type == 3: # 图片消息
             self.receiveImgMsg(msg)
         elif msg.type == 49: # 引用消息 公众号/视频号消息
             self.parseMsg(msg)
+
+    def shedHandle(self, msg, busyReply=''):
+        # 降级为只记录消息, @机器人的提问回复繁忙提示
+        roomId = msg.roomid
+        if msg.type != 1 or not self.rt.isWhiteRoom(roomId):
+            return
+        self.addChatMsg(msg.sender, self.getWxName(msg.sender), roomId, msg.content)
+        if busyReply and msg.is_at(self.wxid):
+            self.sendTextMsg(msg, busyReply)
         
 class GhMsgHandler(MsgHandler):
-    def __init__(self, wcf):
-        super().__init__(wcf)
+    def __init__(self, wcf, contacts=None, members=None, aliases=None):
+        super().__init__(wcf, contacts, members, aliases)
     
     def mainHandle(self, msg):
         if msg.type != 49:
             return
+        msg = MsgEnvelope.wrap(msg)
         gh_id  = msg.sender
         gh_name = self.getWxName(gh_id)
-        root = ET.fromstring(msg.content)
-        appmsg = root.find('appmsg')
-        title = appmsg.find('title').text
-        url = appmsg.find('url').text
         
-        info = f"公众号：{gh_name}\n标题：{title}\n链接：{url}\n时间：{datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        info = f"公众号：{gh_name}\n标题：{msg.appTitle}\n链接：{msg.appUrl}\n时间：{datetime.now().strftime('%Y-%m-%d %H:%M')}"
         for admin in self.superAdmins:
-            msg.sender = admin
-            self.sendTextMsg(msg, info)
+            self.sendTextMsg(msg.replace(sender=admin), info)
             # self.wcf.forward_msg(msg.id, admin)
\ No newline at end of file
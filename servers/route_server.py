@@ -0,0 +1,108 @@
+import time
+import threading
+from utils.common import logger
+from servers.db_server import DbUserServer, DbRoomServer
+
+class RouteTable:
+    def __init__(self, maxAge=300, retryDelay=10):
+        """
+        白名单群聊、回复群、白名单好友、群管理员的内存路由表, 消息分发前直接判断, 无需访问数据库
+        :param maxAge: 路由表最长缓存秒数, 超时后自动从数据库重新加载
+        :param retryDelay: 加载失败后保留旧表, 至少间隔该秒数再重试
+        """
+        self.maxAge = maxAge
+        self.retryDelay = retryDelay
+        self.dus = DbUserServer()
+        self.drs = DbRoomServer()
+        self.lock = threading.Lock()
+        self.whiteRooms = frozenset()
+        self.responseRooms = frozenset()
+        self.whiteUsers = frozenset()
+        self.admins = frozenset()
+        self.loadTime = 0
+        self.listeners = []
+
+    def subscribe(self, callback):
+        """
+        注册路由表变更回调, 多进程模式下用于通知其他进程重新加载
+        """
+        self.listeners.append(callback)
+
+    def refresh(self, notify=True):
+        """
+        从数据库重新加载, 管理员指令修改白名单/回复群/管理员后调用
+        :param notify: 是否通知已注册的回调, 收到其他进程的变更通知时传 False, 避免循环通知
+        :return: 是否加载成功, 失败时继续使用旧表
+        """
+        with self.lock:
+            loaded = self.load()
+        if loaded and notify:
+            for callback in self.listeners:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f'[-]: 路由表变更通知出错: {e}')
+        return loaded
+
+    def load(self):
+        """
+        调用方持有 self.lock
+        :return: 是否加载成功
+        """
+        try:
+            whiteRooms = frozenset(item[0] for item in self.drs.showWhiteRoom(raiseError=True))
+            responseRooms = frozenset(item[0] for item in self.drs.showResponseRoom(raiseError=True))
+            whiteUsers = frozenset(item[0] for item in self.dus.showUser(raiseError=True))
+            admins = frozenset((item[0], item[1]) for item in self.dus.showAdmin(raiseError=True))
+        except Exception as e:
+            # 数据库出错时不能用空表覆盖, 否则所有群消息都会被当作非白名单丢弃
+            self.loadTime = time.time() - max(self.maxAge - self.retryDelay, 0)
+            logger.error(f'[-]: 路由表刷新失败, 继续使用旧表: {e}')
+            return False
+        # 整体替换, 读线程看到的要么是旧表要么是新表
+        self.whiteRooms, self.responseRooms, self.whiteUsers, self.admins = whiteRooms, responseRooms, whiteUsers, admins
+        self.loadTime = time.time()
+        logger.info(f'路由表已刷新: 白名单群{len(whiteRooms)}个, 回复群{len(responseRooms)}个, 白名单好友{len(whiteUsers)}个, 管理员{len(admins)}个')
+        return True
+
+    def isStale(self):
+        return time.time() - self.loadTime > self.maxAge
+
+    def ensureFresh(self):
+        if not self.isStale():
+            return
+        with self.lock:
+            # 同时过期的线程只有第一个去加载, 其余拿到锁后看到已刷新直接返回
+            if self.isStale():
+                # 各进程按各自的周期重新加载, 不需要互相通知
+                self.load()
+
+    def isWhiteRoom(self, roomId):
+        self.ensureFresh()
+        return roomId in self.whiteRooms
+
+    def isResponseRoom(self, roomId):
+        self.ensureFresh()
+        return roomId in self.responseRooms
+
+    def isWhiteUser(self, wxId):
+        self.ensureFresh()
+        return wxId in self.whiteUsers
+
+    def isAdmin(self, wxId, roomId):
+        self.ensureFresh()
+        return (wxId, roomId) in self.admins
+
+    def acceptRoomMsg(self, msg, superAdmins=()):
+        """
+        群聊消息分发前过滤: 只放行白名单群、管理员消息和系统消息(入群欢迎)
+        :return: 是否需要处理
+        """
+        if msg.type == 10000:
+            return True
+        roomId = msg.roomid
+        sender = msg.sender
+        return self.isWhiteRoom(roomId) or sender in superAdmins or self.isAdmin(sender, roomId)
+
+# 全局路由表
+routeTable = RouteTable()
@@ -6,6 +6,7 @@ from lunarcalendar import Converter, Solar, Lunar
 from utils.common import logger, returnConfigData, clearCacheFolder
 from servers.api_server import ApiServer, LLMTaskApi
 from servers.db_server import DbRoomServer, DbMsgServer
+from servers.send_server import SendServer, BroadcastEngine
 
 def exception_handler(func):
     @functools.wraps(func)
@@ -34,8 +35,22 @@ def lunar_to_solar(date, leap_month=False):
 
 class ScheduleTaskServer:
     
-    def __init__(self, wcf):
+    def __init__(self, wcf, broadcaster=None):
+        """
+        :param wcf: Wcf 实例, 通常是定时推送优先级的 QueuedWcf
+        :param broadcaster: BroadcastEngine, 不传时使用 wcf 所在的发送队列
+        """
         self.wcf = wcf
+        if broadcaster is None:
+            scheduleConfig = returnConfigData().get('scheduleConfig', {})
+            sendServer = getattr(wcf, 'sendServer', None) or SendServer(wcf, rate=0).start()
+            broadcaster = BroadcastEngine(
+                sendServer,
+                maxInFlight=scheduleConfig.get('broadcastMaxInFlight', 8),
+                stagger=scheduleConfig.get('broadcastStagger', 0),
+                timeout=scheduleConfig.get('broadcastTimeout', 120),
+            )
+        self.broadcaster = broadcaster
         self.ams = ApiServer()
         self.lta = LLMTaskApi()
         self.drs = DbRoomServer()
@@ -49,9 +64,7 @@ class ScheduleTaskServer:
             return
         room_items = self.drs.showPushRoom(taskName='morningPage')
         logger.info(f'准备推送给群: {room_items}')
-        for room_id, room_name in room_items:
-            self.wcf.send_image(path=page, receiver=room_id) # 传本地文件
-            logger.info(f'早安页面推送给{room_name}成功')
+        return self.broadcaster.broadcast('早安页面', 'send_image', room_items, path=page) # 传本地文件
     
     @exception_handler
     def pushFish(self):
@@ -61,9 +74,7 @@ class ScheduleTaskServer:
             return
         room_items = self.drs.showPushRoom(taskName='fishPage')
         logger.info(f'准备推送给群: {room_items}')
-        for room_id, room_name in room_items:
-            self.wcf.send_image(path=page, receiver=room_id) # 传本地文件
-            logger.info(f'摸鱼图片推送给{room_name}成功')
+        return self.broadcaster.broadcast('摸鱼图片', 'send_image', room_items, path=page) # 传本地文件
     
     @exception_handler
     def pushAiNews(self):
@@ -73,9 +84,7 @@ class ScheduleTaskServer:
             return
         room_items = self.drs.showPushRoom(taskName='aiNews')
         logger.info(f'准备推送给群: {room_items}')
-        for room_id, room_name in room_items:
-            self.wcf.send_text(msg=text, receiver=room_id) # 传本地文件
-            logger.info(f'AI新闻页面推送给{room_name}成功')
+        return self.broadcaster.broadcast('AI新闻页面', 'send_text', room_items, msg=text)
     
     @exception_handler
     def pushGoodNight(self):
@@ -85,9 +94,7 @@ class ScheduleTaskServer:
             return
         room_items = self.drs.showPushRoom(taskName='goodNight')
         logger.info(f'准备推送给群: {room_items}')
-        for room_id, room_name in room_items:
-            self.wcf.send_text(msg=text, receiver=room_id)
-            logger.info(f'晚安页面推送给{room_name}成功')
+        return self.broadcaster.broadcast('晚安页面', 'send_text', room_items, msg=text)
     
     @exception_handler
     def pushFestivalWish(self):
@@ -116,20 +123,17 @@ class ScheduleTaskServer:
                     content = self.lta.birthdayWish(name, solar=today, lunar=today_lunar)
                     room_items = self.drs.showPushRoom(taskName='birthday')
                     logger.info(f'准备推送给群: {room_items}')
-                    for room_id, room_name in room_items:
-                        self.wcf.send_text(msg=content, receiver=room_id)
-                        logger.info(f'生日祝福推送给{room_name}成功: {name} {birthday}')
+                    self.broadcaster.broadcast(f'生日祝福({name} {birthday})', 'send_text', room_items, msg=content)
     
     @exception_handler
     def pushWeatherReport(self):
         weather_list = returnConfigData()['scheduleConfig']['weather_district']
         room_items = self.drs.showPushRoom(taskName='weatherReport')
         logger.info(f'准备推送给群: {room_items}')
-        for room_id, room_name in room_items:
-            for district in weather_list:
-                content = self.lta.getWeather(address=district)
-                self.wcf.send_text(msg=content, receiver=room_id)
-                logger.info(f'天气预报推送给{room_name}成功: {district}')
+        # 每个地区只查询一次天气, 同一个群内仍按地区顺序收到
+        for district in weather_list:
+            content = self.lta.getWeather(address=district)
+            self.broadcaster.broadcast(f'天气预报({district})', 'send_text', room_items, msg=content)
     
     @exception_handler
     def pushBeikeReport(self):
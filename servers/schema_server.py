@@ -0,0 +1,157 @@
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+from utils.common import logger
+
+# 记录已执行的结构变更版本, 每个数据库一张
+SCHEMA_VERSION_SQL = 'CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description varchar(255), appliedTime datetime DEFAULT CURRENT_TIMESTAMP)'
+
+# 分批回填: UPDATE table SET assignments WHERE condition, 按 rowid 分段执行, 每段一个事务
+Backfill = namedtuple('Backfill', ['table', 'assignments', 'condition'])
+# 一次结构变更
+# statements: 按顺序执行的 SQL
+# backfill: 可选的分批回填, 在 statements 之后执行
+# online: 是否在后台线程执行, 建索引、回填等耗时步骤设为 True, 启动时不等待
+# 所有步骤严格按版本号顺序执行, 排在未完成的 online 步骤之后的同步步骤也推迟到后台线程, 启动时就需要的结构变更应排在 online 步骤之前
+Migration = namedtuple('Migration', ['version', 'description', 'statements', 'backfill', 'online'], defaults=((), None, False))
+
+class SchemaMigrator:
+    def __init__(self, dbPath, migrations, onConnect=None, chunkSize=5000, pause=0.05, name=''):
+        """
+        按版本号顺序执行未执行过的结构变更, 已执行的版本记录在 schema_version 表中
+        第一个 online 步骤之前的同步步骤在 run 中直接执行, 从它开始的所有步骤按顺序在后台线程中执行, 回填每段之间让出写锁
+        :param dbPath: 数据库文件路径
+        :param migrations: [Migration]
+        :param onConnect: 打开连接后调用 onConnect(conn), 用于设置 busy_timeout 等 PRAGMA
+        :param chunkSize: 回填时每段的 rowid 数
+        :param pause: 回填时每段之间暂停的秒数, 让处理线程的写入插进来
+        :param name: 日志中显示的数据库名
+        """
+        self.dbPath = dbPath
+        self.migrations = sorted(migrations, key=lambda migration: migration.version)
+        self.onConnect = onConnect
+        self.chunkSize = chunkSize
+        self.pause = pause
+        self.name = name or dbPath
+        self.thread = None
+        self.lock = threading.Lock()
+        self.applied = set()
+        self.failed = {}
+        self.backfilled = 0
+
+    def connect(self):
+        conn = sqlite3.connect(database=self.dbPath)
+        if self.onConnect is not None:
+            self.onConnect(conn)
+        return conn
+
+    def appliedVersions(self, conn):
+        conn.execute(SCHEMA_VERSION_SQL)
+        return {row[0] for row in conn.execute('SELECT version FROM schema_version')}
+
+    def pending(self):
+        """
+        :return: 未执行的步骤, 按版本号排序
+        """
+        with self.lock:
+            return [migration for migration in self.migrations
+                    if migration.version not in self.applied and migration.version not in self.failed]
+
+    def run(self, background=True):
+        """
+        按版本号顺序执行同步步骤, 遇到第一个 online 步骤后, 它和之后的所有步骤在后台线程中按顺序执行
+        :param background: False 时所有步骤都在当前线程执行完再返回
+        :return: self
+        """
+        conn = self.connect()
+        try:
+            with self.lock:
+                self.applied = self.appliedVersions(conn)
+            remaining = self.pending()
+            while remaining and not remaining[0].online:
+                if not self.apply(conn, remaining.pop(0)):
+                    # 之后的步骤可能依赖失败的步骤, 一起跳过
+                    return self
+        finally:
+            conn.close()
+        if not remaining:
+            return self
+        deferred = [migration.version for migration in remaining if not migration.online]
+        if deferred:
+            logger.info(f'{self.name} 版本{deferred}排在后台步骤之后, 等待前面的版本完成后执行')
+        if background:
+            self.thread = threading.Thread(target=self.runRemaining, args=(remaining, ), name=f'数据库升级-{self.name}', daemon=True)
+            self.thread.start()
+        else:
+            self.runRemaining(remaining)
+        return self
+
+    def runRemaining(self, migrations):
+        conn = self.connect()
+        try:
+            for migration in migrations:
+                if not self.apply(conn, migration):
+                    break
+        finally:
+            conn.close()
+
+    def apply(self, conn, migration):
+        """
+        :return: 是否执行成功, 失败时不再执行之后的版本
+        """
+        start = time.time()
+        try:
+            for sql in migration.statements:
+                with conn:
+                    conn.execute(sql)
+            if migration.backfill is not None:
+                self.runBackfill(conn, migration.backfill)
+            with conn:
+                conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (migration.version, migration.description))
+        except sqlite3.Error as e:
+            with self.lock:
+                self.failed[migration.version] = str(e)
+            logger.error(f'[-]: {self.name} 升级到版本{migration.version}出现错误: {e}')
+            return False
+        with self.lock:
+            self.applied.add(migration.version)
+        logger.info(f'{self.name} 已升级到版本{migration.version}: {migration.description}, 耗时{time.time() - start:.2f}秒')
+        return True
+
+    def runBackfill(self, conn, backfill):
+        """
+        按 rowid 从小到大分段更新, 每段单独提交, 中断后重新执行时 condition 会跳过已回填的行
+        """
+        lastRowId = conn.execute(f'SELECT MAX(rowid) FROM {backfill.table}').fetchone()[0] or 0
+        sql = f'UPDATE {backfill.table} SET {backfill.assignments} WHERE rowid > ? AND rowid <= ? AND ({backfill.condition})'
+        for low in range(0, lastRowId, self.chunkSize):
+            with conn:
+                cursor = conn.execute(sql, (low, low + self.chunkSize))
+            with self.lock:
+                self.backfilled += cursor.rowcount
+            if self.pause:
+                time.sleep(self.pause)
+
+    def join(self, timeout=None):
+        """
+        等待后台步骤执行完成
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def metrics(self):
+        with self.lock:
+            # 只统计从头开始连续执行完的版本, 前面还有未完成的版本时不算已升级
+            version = 0
+            for migration in self.migrations:
+                if migration.version not in self.applied:
+                    break
+                version = migration.version
+            return {
+                'version': version,
+                'pending': [migration.version for migration in self.migrations
+                            if migration.version not in self.applied and migration.version not in self.failed],
+                'failed': dict(self.failed),
+                'backfilled': self.backfilled,
+            }
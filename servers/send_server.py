@@ -0,0 +1,432 @@
+import time
+import random
+import threading
+import itertools
+from collections import OrderedDict, deque
+from utils.common import logger
+from servers.dispatch_server import LaneExecutor, PRIORITY_INTERACTIVE, PRIORITY_LOG
+
+# 发送状态
+SEND_QUEUED = 'queued'
+SEND_RETRYING = 'retrying'
+SEND_SENT = 'sent'
+SEND_FAILED = 'failed'
+SEND_DROPPED = 'dropped'
+
+# 各发送接口成功时的返回值, 与 wcferry 一致
+SEND_OK = {
+    'send_text': 0,
+    'send_image': 0,
+    'send_file': 0,
+    'forward_msg': 1,
+}
+
+class TokenBucket:
+    def __init__(self, rate=2.0, burst=5):
+        """
+        令牌桶限流, 整个账号共用一个
+        :param rate: 每秒补充的令牌数, 不大于 0 表示不限流
+        :param burst: 桶容量, 允许的瞬时突发条数
+        """
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        预定一个令牌
+        :return: 拿到令牌前需要等待的秒数
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """
+        拿到令牌后返回
+        :return: 实际等待的秒数
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class SendTask:
+    def __init__(self, taskId, method, receiver, kwargs, priority=PRIORITY_INTERACTIVE):
+        """
+        一次发送请求及其投递状态
+        :param method: send_text / send_image / send_file / forward_msg
+        :param kwargs: 调用 wcf 接口的参数
+        :param priority: 优先级, 重试时按原优先级重新入队
+        """
+        self.taskId = taskId
+        self.method = method
+        self.receiver = receiver
+        self.kwargs = kwargs
+        self.priority = priority
+        self.status = SEND_QUEUED
+        self.attempts = 0
+        self.result = None
+        self.error = ''
+        self.createTime = time.time()
+        self.doneTime = None
+        self.done = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """
+        等待发送完成(成功或最终失败)
+        :return: 是否已完成
+        """
+        return self.done.wait(timeout)
+
+    def addDoneCallback(self, callback):
+        """
+        发送完成后调用 callback(task), 已完成时立即调用
+        """
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def setDone(self):
+        with self.lock:
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f'[-]: 发送完成回调出错: {e}')
+
+    def info(self):
+        return {
+            'taskId': self.taskId,
+            'method': self.method,
+            'receiver': self.receiver,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+        }
+
+class SendServer:
+    def __init__(self, wcf, rate=2.0, burst=5, laneNum=4, queueSize=1000, maxRetries=3, backoffBase=1.0, backoffMax=30.0, jitter=0.5, historySize=1000):
+        """
+        统一的消息发送队列: 账号级令牌桶限流, 同一接收方按提交顺序发送, 失败后指数退避重试
+        处理线程只负责入队, 不再等待发送完成; 退避期间由定时器等待, 不占用发送通道
+        :param wcf: Wcf 实例
+        :param rate: 每秒最多发送条数
+        :param burst: 允许的瞬时突发条数
+        :param laneNum: 发送通道数, 同一接收方固定在一个通道内
+        :param queueSize: 每个通道的队列长度上限, 队列满时阻塞等待
+        :param maxRetries: 失败后最多重试次数
+        :param backoffBase: 第一次重试前等待的秒数, 之后每次翻倍
+        :param backoffMax: 重试等待秒数上限
+        :param jitter: 等待时间的随机抖动比例, 避免多个接收方同时重试
+        :param historySize: 保留最近多少条发送记录供查询状态
+        """
+        self.wcf = wcf
+        self.bucket = TokenBucket(rate, burst)
+        self.executor = LaneExecutor(laneNum=laneNum, queueSize=queueSize, fullPolicy='block', name='消息发送通道')
+        self.maxRetries = maxRetries
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.jitter = jitter
+        self.historySize = historySize
+        self.random = random.Random()
+        self.seq = itertools.count(1)
+        self.lock = threading.Lock()
+        self.history = OrderedDict()
+        # 接收方 -> 排在退避重试消息之后的消息, 有记录表示该接收方正在等待重试
+        self.blocked = {}
+        # 接收方 -> (定时器, 等待重试的消息)
+        self.timers = {}
+        self.idle = threading.Condition(self.lock)
+        self.stats = {'submitted': 0, 'sent': 0, 'failed': 0, 'dropped': 0, 'retries': 0,
+                      'throttled': 0, 'throttleWait': 0.0, 'latencyTotal': 0.0, 'latencyMax': 0.0}
+
+    def start(self):
+        self.executor.start()
+        return self
+
+    def submit(self, method, kwargs, priority=PRIORITY_INTERACTIVE):
+        """
+        提交发送请求, 立即返回, 同一接收方的消息按提交顺序发送
+        :param method: send_text / send_image / send_file / forward_msg
+        :param kwargs: 调用 wcf 接口的参数, 须包含 receiver
+        :param priority: 优先级, 回复消息优先于定时推送
+        :return: SendTask
+        """
+        if method not in SEND_OK:
+            raise ValueError(f'不支持的发送接口: {method}')
+        receiver = kwargs['receiver']
+        task = SendTask(next(self.seq), method, receiver, kwargs, priority)
+        with self.lock:
+            self.stats['submitted'] += 1
+            self.history[task.taskId] = task
+            while len(self.history) > self.historySize:
+                self.history.popitem(last=False)
+        if not self.executor.submit(receiver, self.deliver, task, priority=priority):
+            self.finish(task, SEND_DROPPED)
+        return task
+
+    def backoff(self, attempt):
+        """
+        :param attempt: 第几次重试, 从 1 开始
+        :return: 本次重试前等待的秒数
+        """
+        delay = min(self.backoffMax, self.backoffBase * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * self.random.random())
+
+    def deliver(self, task):
+        """
+        在发送通道中执行: 该接收方有消息在等待重试时排到它后面, 否则立即发送
+        """
+        with self.lock:
+            backlog = self.blocked.get(task.receiver)
+            if backlog is not None:
+                backlog.append(task)
+                return
+        self.attempt(task)
+
+    def attempt(self, task):
+        """
+        限流后调用 wcf, 失败则用定时器安排重试, 通道继续处理其他接收方的消息
+        :return: 是否已结束(成功或最终失败)
+        """
+        func = getattr(self.wcf, task.method)
+        wait = self.bucket.acquire()
+        if wait > 0:
+            with self.lock:
+                self.stats['throttled'] += 1
+                self.stats['throttleWait'] += wait
+        task.attempts += 1
+        try:
+            task.result = func(**task.kwargs)
+            task.error = '' if task.result == SEND_OK[task.method] else f'返回值 {task.result}'
+        except Exception as e:
+            task.error = str(e)
+        if not task.error:
+            self.finish(task, SEND_SENT)
+            return True
+        if task.attempts > self.maxRetries:
+            logger.error(f'[-]: 消息发送失败 {task.method} {task.receiver}: {task.error}, 已尝试{task.attempts}次')
+            self.finish(task, SEND_FAILED)
+            return True
+        task.status = SEND_RETRYING
+        delay = self.backoff(task.attempts)
+        timer = threading.Timer(delay, self.resubmit, args=(task,))
+        timer.daemon = True
+        with self.lock:
+            self.stats['retries'] += 1
+            self.blocked.setdefault(task.receiver, deque())
+            self.timers[task.receiver] = (timer, task)
+        logger.warning(f'[-]: 消息发送失败 {task.method} {task.receiver}: {task.error}, {delay:.1f}秒后重试')
+        timer.start()
+        return False
+
+    def resubmit(self, task):
+        """
+        定时器线程中执行: 退避结束后把消息重新放回原通道
+        """
+        with self.lock:
+            if self.timers.get(task.receiver, (None, None))[1] is not task:
+                # 已被 shutdown 取消
+                return
+            del self.timers[task.receiver]
+        if not self.executor.submit(task.receiver, self.retry, task, priority=task.priority):
+            with self.lock:
+                backlog = self.blocked.pop(task.receiver, ())
+                self.idle.notify_all()
+            for dropped in [task, *backlog]:
+                self.finish(dropped, SEND_DROPPED)
+
+    def retry(self, task):
+        """
+        在发送通道中执行重试, 结束后在本通道内依次发送排在它后面的消息, 之后提交的消息不会插队
+        """
+        while self.attempt(task):
+            with self.lock:
+                backlog = self.blocked.get(task.receiver)
+                if not backlog:
+                    self.blocked.pop(task.receiver, None)
+                    self.idle.notify_all()
+                    return
+                task = backlog.popleft()
+
+    def finish(self, task, status):
+        task.status = status
+        task.doneTime = time.time()
+        latency = task.doneTime - task.createTime
+        with self.lock:
+            self.stats[status] += 1
+            if status == SEND_SENT:
+                self.stats['latencyTotal'] += latency
+                self.stats['latencyMax'] = max(self.stats['latencyMax'], latency)
+        task.setDone()
+
+    def status(self, taskId):
+        """
+        :return: 发送记录, 已被淘汰或不存在时返回 None
+        """
+        with self.lock:
+            task = self.history.get(taskId)
+        return task.info() if task is not None else None
+
+    def metrics(self):
+        with self.lock:
+            data = dict(self.stats)
+        latencyTotal = data.pop('latencyTotal')
+        data['latencyAvg'] = latencyTotal / data['sent'] if data['sent'] else 0.0
+        data['depth'] = self.executor.depth()
+        return data
+
+    def join(self):
+        """
+        等待已提交的消息全部发送完成, 包括正在退避等待重试的消息
+        """
+        while True:
+            self.executor.join()
+            with self.lock:
+                if not self.blocked:
+                    return
+                self.idle.wait()
+
+    def shutdown(self, wait=True):
+        """
+        :param wait: 是否先等待已提交的消息发送完成, 否则取消等待中的重试并记为 dropped
+        """
+        if wait:
+            self.join()
+        with self.lock:
+            pending = [task for _, task in self.timers.values()]
+            for timer, _ in self.timers.values():
+                timer.cancel()
+            for backlog in self.blocked.values():
+                pending.extend(backlog)
+            self.timers = {}
+            self.blocked = {}
+            self.idle.notify_all()
+        self.executor.shutdown(wait=wait)
+        for task in pending:
+            self.finish(task, SEND_DROPPED)
+
+class QueuedWcf:
+    def __init__(self, wcf, sendServer, priority=PRIORITY_INTERACTIVE):
+        """
+        Wcf 包装: 发送接口改为提交到发送队列并立即返回成功, 其余接口直接调用原 Wcf
+        :param wcf: Wcf 实例
+        :param sendServer: SendServer 实例
+        :param priority: 通过本包装提交的消息优先级
+        """
+        self.wcf = wcf
+        self.sendServer = sendServer
+        self.priority = priority
+
+    def __getattr__(self, name):
+        return getattr(self.wcf, name)
+
+    def enqueue(self, method, **kwargs):
+        task = self.sendServer.submit(method, kwargs, priority=self.priority)
+        if task.status == SEND_DROPPED:
+            # 与 wcferry 失败时的返回值一致
+            return 0 if method == 'forward_msg' else -1
+        return SEND_OK[method]
+
+    def send_text(self, msg, receiver, aters=''):
+        return self.enqueue('send_text', msg=msg, receiver=receiver, aters=aters)
+
+    def send_image(self, path, receiver):
+        return self.enqueue('send_image', path=path, receiver=receiver)
+
+    def send_file(self, path, receiver):
+        return self.enqueue('send_file', path=path, receiver=receiver)
+
+    def forward_msg(self, id, receiver):
+        return self.enqueue('forward_msg', id=id, receiver=receiver)
+
+class BroadcastEngine:
+    def __init__(self, sendServer, maxInFlight=8, stagger=0.0, timeout=120):
+        """
+        定时推送的群发: 同一份内容提交给所有推送群, 单个群发送慢或失败不影响其他群
+        :param sendServer: SendServer 实例, 限流和重试由它负责
+        :param maxInFlight: 同时在发送中的群数上限
+        :param stagger: 相邻两个群提交之间的间隔秒数, 0 表示只靠 SendServer 限流
+        :param timeout: 等待全部群发送完成的最长秒数, 超时的群记为 pending
+        """
+        self.sendServer = sendServer
+        self.maxInFlight = max(1, maxInFlight)
+        self.stagger = stagger
+        self.timeout = timeout
+
+    def broadcast(self, taskName, method, rooms, **payload):
+        """
+        :param taskName: 推送任务名, 用于日志
+        :param method: send_text / send_image / send_file
+        :param rooms: [(群id, 群名称)]
+        :param payload: 除 receiver 外的发送参数, 如 msg=... 或 path=...
+        :return: 推送报告
+        """
+        startTime = time.time()
+        deadline = startTime + self.timeout
+        slots = threading.BoundedSemaphore(self.maxInFlight)
+        rooms = list(rooms)
+        tasks = []
+        for index, (roomId, roomName) in enumerate(rooms):
+            if index and self.stagger:
+                time.sleep(min(self.stagger, max(0, deadline - time.time())))
+            # 发送中的群一直没有完成时不能无限等待, 到截止时间后剩余的群不再提交
+            if not slots.acquire(timeout=max(0, deadline - time.time())):
+                break
+            task = self.sendServer.submit(method, dict(payload, receiver=roomId), priority=PRIORITY_LOG)
+            task.addDoneCallback(lambda _: slots.release())
+            tasks.append((roomName, task))
+        unsubmitted = rooms[len(tasks):]
+        for _, task in tasks:
+            task.wait(max(0, deadline - time.time()))
+        report = self.summarize(taskName, tasks, time.time() - startTime, unsubmitted)
+        failedRooms = [roomName for roomName, status in report['rooms'].items() if status != SEND_SENT]
+        logger.info(f'{taskName}推送完成: 共{report["total"]}个群, 成功{report["sent"]}个, 失败{report["failed"]}个, 未完成{report["pending"]}个, 耗时{report["duration"]}秒')
+        if failedRooms:
+            logger.warning(f'[-]: {taskName}推送未成功的群: {failedRooms}')
+        return report
+
+    @staticmethod
+    def summarize(taskName, tasks, duration, unsubmitted=()):
+        """
+        :param tasks: [(群名称, SendTask)]
+        :param unsubmitted: 截止时间前没能提交的 [(群id, 群名称)], 记为 pending
+        """
+        rooms = {}
+        counts = {SEND_SENT: 0, SEND_FAILED: 0, 'pending': 0}
+        for roomName, task in tasks:
+            status = task.status
+            if status == SEND_DROPPED:
+                status = SEND_FAILED
+            elif status not in (SEND_SENT, SEND_FAILED):
+                status = 'pending'
+            rooms[roomName or task.receiver] = status
+            counts[status] += 1
+        for roomId, roomName in unsubmitted:
+            rooms[roomName or roomId] = 'pending'
+            counts['pending'] += 1
+        return {
+            'taskName': taskName,
+            'total': len(tasks) + len(unsubmitted),
+            'sent': counts[SEND_SENT],
+            'failed': counts[SEND_FAILED],
+            'pending': counts['pending'],
+            'duration': round(duration, 3),
+            'rooms': rooms,
+        }
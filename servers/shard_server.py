@@ -0,0 +1,283 @@
+import zlib
+import queue
+import itertools
+import threading
+import functools
+import multiprocessing
+from utils.common import logger, returnConfigData
+from utils.wxmsg import packMsg, MsgEnvelope
+from servers.dispatch_server import LaneExecutor, LoadShedder, shedOrHandle, PRIORITY_ADMIN
+from servers.route_server import routeTable
+from servers.db_server import closeAllDb, chatMsgWriter
+
+# 进程间控制消息
+KIND_ROUTE = 'route'            # 路由表已变更, 需要重新加载
+ROUTE_CHANGED = '__route_changed__'
+
+class WcfProxy:
+    def __init__(self, index, reqQueue, respQueue, timeout=60):
+        """
+        子进程中代替 Wcf 使用, 所有方法调用转发到主进程执行并等待结果
+        :param index: 子进程序号
+        :param reqQueue: 调用请求队列, 所有子进程共用
+        :param respQueue: 本进程的调用结果队列
+        :param timeout: 单次调用最长等待秒数
+        """
+        self.index = index
+        self.reqQueue = reqQueue
+        self.respQueue = respQueue
+        self.timeout = timeout
+        self.seq = itertools.count()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.responseLoop, name=f'Wcf代理-{index}', daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def call(self, name, *args, **kwargs):
+        callId = next(self.seq)
+        waiter = [threading.Event(), None, None]
+        with self.lock:
+            self.pending[callId] = waiter
+        self.reqQueue.put((self.index, callId, name, args, kwargs))
+        if not waiter[0].wait(self.timeout):
+            with self.lock:
+                self.pending.pop(callId, None)
+            raise TimeoutError(f'Wcf 调用超时: {name}')
+        if waiter[2] is not None:
+            raise RuntimeError(f'Wcf 调用出错: {name} {waiter[2]}')
+        return waiter[1]
+
+    def responseLoop(self):
+        while True:
+            item = self.respQueue.get()
+            if item is None:
+                break
+            callId, result, error = item
+            with self.lock:
+                waiter = self.pending.pop(callId, None)
+            # 已超时的调用直接忽略结果
+            if waiter is None:
+                continue
+            waiter[1], waiter[2] = result, error
+            waiter[0].set()
+
+    def close(self):
+        self.respQueue.put(None)
+        self.thread.join()
+
+def shardMain(index, msgQueue, reqQueue, respQueue, dispatchConfig):
+    """
+    子进程入口: 用 Wcf 代理创建消息处理器, 按会话分通道处理主进程转发来的消息
+    """
+    # 在子进程中导入, 避免主进程为每个子进程重复创建处理器
+    from servers.msg_server import SingleMsgHandler, RoomMsgHandler, GhMsgHandler
+    from servers.async_server import AsyncRuntime
+    from servers.contact_server import ContactIndex, RoomMemberCache, AliasCache
+
+    wcf = WcfProxy(index, reqQueue, respQueue)
+    routeTable.refresh(notify=False)
+    dbConfig = returnConfigData().get('dbConfig', {})
+    chatMsgWriter.start(
+        flushInterval=dbConfig.get('flushInterval', 0.2),
+        batchSize=dbConfig.get('batchSize', 200),
+        maxQueue=dbConfig.get('maxQueue', 20000),
+    )
+    # 本进程修改白名单等之后, 通知主进程和其他子进程重新加载
+    routeTable.subscribe(functools.partial(wcf.call, ROUTE_CHANGED))
+    # 联系人索引、群成员和群昵称缓存在本进程内共享
+    contacts = ContactIndex(wcf, maxAge=dispatchConfig.get('contactMaxAge', 600))
+    members = RoomMemberCache(wcf, maxAge=dispatchConfig.get('memberMaxAge', 300))
+    aliases = AliasCache(wcf, members, maxAge=dispatchConfig.get('aliasMaxAge', 600))
+    handlers = {
+        'room': RoomMsgHandler(wcf, contacts, members, aliases),
+        'single': SingleMsgHandler(wcf, contacts, members, aliases),
+        'gh': GhMsgHandler(wcf, contacts, members, aliases),
+    }
+    executor = LaneExecutor(
+        laneNum=dispatchConfig.get('laneNum', 8),
+        queueSize=dispatchConfig.get('queueSize', 200),
+        fullPolicy=dispatchConfig.get('fullPolicy', 'block'),
+        blockTimeout=dispatchConfig.get('blockTimeout'),
+        urgentPriority=PRIORITY_ADMIN,
+        name=f'分片{index}通道',
+    ).start()
+    shedder = LoadShedder(
+        maxMsgAge=dispatchConfig.get('maxMsgAge', 120),
+        overloadDepth=dispatchConfig.get('overloadDepth', 500),
+        busyReply=dispatchConfig.get('busyReply', '消息太多啦，稍后再来问我吧~'),
+    )
+    asyncRuntime = None
+    if dispatchConfig.get('runtimeMode', 'thread') == 'async':
+        asyncRuntime = AsyncRuntime(
+            maxConcurrency=dispatchConfig.get('asyncConcurrency', 1000),
+            maxPending=dispatchConfig.get('asyncMaxPending', 5000),
+            fullPolicy=dispatchConfig.get('fullPolicy', 'block'),
+            blockTimeout=dispatchConfig.get('blockTimeout'),
+        ).start()
+        for handler in handlers.values():
+            handler.attachAsyncRuntime(asyncRuntime, shedder)
+
+    def handleMsg(handler, msg, priority):
+        # 事件循环上未完成的协程也算积压
+        depth = executor.depth() + (asyncRuntime.depth() if asyncRuntime is not None else 0)
+        shedOrHandle(shedder, handler, msg, priority, depth)
+
+    logger.info(f'消息分片进程{index}启动成功')
+    while True:
+        item = msgQueue.get()
+        if item is None:
+            break
+        kind, data, priority = item
+        if kind == KIND_ROUTE:
+            routeTable.refresh(notify=False)
+            continue
+        msg = MsgEnvelope(*data)
+        key = msg.roomid if kind == 'room' else msg.sender
+        executor.submit(key, handleMsg, handlers[kind], msg, priority, priority=priority)
+    executor.join()
+    executor.shutdown()
+    if asyncRuntime is not None:
+        asyncRuntime.shutdown()
+    chatMsgWriter.shutdown()
+    closeAllDb()
+    logger.info(f'消息分片进程{index}已退出: {executor.metrics()["processed"]}条消息')
+    wcf.close()
+
+class ShardServer:
+    def __init__(self, wcf, processNum=2, dispatchConfig=None, rpcThreads=4):
+        """
+        多进程分片处理消息: 主进程只负责接收和分发, 按 roomid/sender 哈希到固定子进程处理,
+        子进程发消息等 Wcf 调用转发回主进程执行
+        :param wcf: 主进程中的 Wcf 实例
+        :param processNum: 子进程数
+        :param dispatchConfig: 消息分发配置, 子进程按该配置创建处理通道;
+                               shardQueueSize 为每个子进程的转发队列长度, 默认等于子进程内各通道队列长度之和,
+                               队列满时按 fullPolicy/blockTimeout 阻塞或丢弃, 管理员指令一直等待
+        :param rpcThreads: 主进程中执行 Wcf 调用的线程数
+        """
+        self.wcf = wcf
+        self.processNum = processNum
+        self.dispatchConfig = dict(dispatchConfig or {})
+        self.rpcThreads = rpcThreads
+        self.queueSize = self.dispatchConfig.get('shardQueueSize',
+                                                 self.dispatchConfig.get('laneNum', 8) * self.dispatchConfig.get('queueSize', 200))
+        self.fullPolicy = self.dispatchConfig.get('fullPolicy', 'block')
+        self.blockTimeout = self.dispatchConfig.get('blockTimeout')
+        # 统一使用 spawn, 与 Windows 下的行为一致
+        self.ctx = multiprocessing.get_context('spawn')
+        self.reqQueue = self.ctx.Queue()
+        self.msgQueues = [self.ctx.Queue(maxsize=self.queueSize) for _ in range(processNum)]
+        self.respQueues = [self.ctx.Queue() for _ in range(processNum)]
+        self.processes = []
+        self.threads = []
+        self.lock = threading.Lock()
+        self.submitted = [0] * processNum
+        self.dropped = [0] * processNum
+        self.calls = 0
+        self.callErrors = 0
+
+    def start(self):
+        # 先启动调用线程, 子进程创建处理器时就需要调用 Wcf
+        for i in range(self.rpcThreads):
+            thread = threading.Thread(target=self.serveLoop, name=f'Wcf调用-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        for i in range(self.processNum):
+            process = self.ctx.Process(
+                target=shardMain,
+                args=(i, self.msgQueues[i], self.reqQueue, self.respQueues[i], self.dispatchConfig),
+                name=f'消息分片-{i}',
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        return self
+
+    def shardIndex(self, key):
+        return zlib.crc32(key.encode('utf-8')) % self.processNum
+
+    def submit(self, key, kind, msg, priority):
+        """
+        把消息转发到 key 对应的子进程
+        :param key: 群聊为 roomid, 私聊/公众号为 sender
+        :param kind: room / single / gh
+        :return: 是否成功转发, 子进程积压导致队列已满时返回 False, 由调用方降级处理
+        """
+        index = self.shardIndex(key)
+        item = (kind, packMsg(msg), priority)
+        try:
+            if priority == PRIORITY_ADMIN:
+                self.msgQueues[index].put(item)
+            elif self.fullPolicy == 'block':
+                self.msgQueues[index].put(item, timeout=self.blockTimeout)
+            else:
+                self.msgQueues[index].put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.dropped[index] += 1
+            logger.warning(f'[-]: 子进程{index}的消息队列已满: {kind} {msg.sender} {msg.roomid}')
+            return False
+        with self.lock:
+            self.submitted[index] += 1
+        return True
+
+    def serveLoop(self):
+        while True:
+            item = self.reqQueue.get()
+            if item is None:
+                break
+            index, callId, name, args, kwargs = item
+            result, error = None, None
+            try:
+                if name == ROUTE_CHANGED:
+                    routeTable.refresh(notify=False)
+                    self.broadcastRoute(exclude=index)
+                else:
+                    result = getattr(self.wcf, name)(*args, **kwargs)
+            except Exception as e:
+                error = repr(e)
+                logger.error(f'[-]: 子进程{index}的 Wcf 调用出错: {name} {e}')
+            with self.lock:
+                self.calls += 1
+                if error is not None:
+                    self.callErrors += 1
+            self.respQueues[index].put((callId, result, error))
+
+    def broadcastRoute(self, exclude=None):
+        for i, msgQueue in enumerate(self.msgQueues):
+            if i != exclude:
+                # 不能阻塞调用线程, 子进程可能正在等待本线程执行 Wcf 调用; 通知丢失时子进程按 maxAge 自行重新加载
+                try:
+                    msgQueue.put_nowait((KIND_ROUTE, None, 0))
+                except queue.Full:
+                    logger.warning(f'[-]: 子进程{i}的消息队列已满, 路由表变更通知未送达')
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'submitted': list(self.submitted),
+                'dropped': list(self.dropped),
+                'calls': self.calls,
+                'callErrors': self.callErrors,
+                'alive': sum(1 for process in self.processes if process.is_alive()),
+            }
+
+    def shutdown(self, timeout=30):
+        # 子进程处理完已转发的消息后退出, 期间仍需要调用线程执行 Wcf 调用
+        if not self.processes and not self.threads:
+            return
+        for msgQueue in self.msgQueues:
+            msgQueue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+        for _ in self.threads:
+            self.reqQueue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.processes = []
+        self.threads = []
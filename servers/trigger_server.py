@@ -0,0 +1,151 @@
+import time
+import threading
+from collections import namedtuple
+from utils.common import logger
+
+class KeywordTrie:
+    def __init__(self, words=None):
+        """
+        关键词前缀树, 一次遍历找出内容开头匹配的最长关键词
+        :param words: {关键词: 值}
+        """
+        self.root = {}
+        self.size = 0
+        for word, value in (words or {}).items():
+            self.add(word, value)
+
+    def add(self, word, value):
+        if not word:
+            return
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+        if None not in node:
+            self.size += 1
+        # 用 None 作为结束标记, 不会与字符冲突
+        node[None] = (word, value)
+
+    def match(self, content):
+        """
+        :param content: 待匹配的内容
+        :return: (关键词, 值), 没有匹配时返回 None
+        """
+        node = self.root
+        found = None
+        for char in content:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found = node[None]
+        return found
+
+    def __len__(self):
+        return self.size
+
+def compileTriggers(customKeyWord):
+    """
+    把 customKeyWord 配置编译为前缀树, 在加载配置时执行一次
+    :param customKeyWord: {触发器类型: 关键词或关键词列表}
+    :return: KeywordTrie, 值为触发器类型
+    """
+    trie = KeywordTrie()
+    for triggerType, triggerWords in (customKeyWord or {}).items():
+        if not isinstance(triggerWords, list):
+            triggerWords = [triggerWords]
+        for word in triggerWords:
+            word = str(word)
+            exist = trie.match(word)
+            if exist is not None and exist[0] == word and exist[1] != triggerType:
+                logger.warning(f'[-]: 关键词 {word} 同时配置在 {exist[1]} 和 {triggerType} 中, 使用 {triggerType}')
+            trie.add(word, triggerType)
+    return trie
+
+# 触发器注册表: {触发器类型: 处理函数}
+triggerRegistry = {}
+
+def registerTrigger(triggerType):
+    """
+    注册触发器处理函数, 新增触发器类型时只需注册, 无需修改 MsgHandler
+    处理函数签名: func(handler, msg, content, chatid), handler 为 MsgHandler 实例
+
+        @registerTrigger('KfcKeyWords')
+        def kfcTrigger(handler, msg, content, chatid):
+            handler.sendTextMsg(msg, handler.aps.getKfc())
+    """
+    def decorator(func):
+        if triggerType in triggerRegistry:
+            logger.warning(f'[-]: 触发器 {triggerType} 被重复注册, 使用新的处理函数')
+        triggerRegistry[triggerType] = func
+        return func
+    return decorator
+
+# 管理指令定义: key-adminFunctionWord 中的配置项 method-处理方法名 args-参数名 refresh-执行后是否刷新路由表
+AdminCommand = namedtuple('AdminCommand', ['key', 'method', 'args', 'refresh'], defaults=((), True))
+
+class CommandTable:
+    def __init__(self, commands):
+        """
+        表驱动的管理指令路由: 指令关键词编译为前缀树, 一次查找定位指令并解析参数
+        :param commands: AdminCommand 列表
+        """
+        self.commands = {command.key: command for command in commands}
+        self.trie = KeywordTrie()
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def load(self, wordConfig):
+        """
+        按配置的关键词重新编译, 加载配置时调用
+        :param wordConfig: adminFunctionWord 配置
+        """
+        trie = KeywordTrie()
+        for key in self.commands:
+            words = wordConfig.get(key)
+            if not words:
+                continue
+            for word in (words if isinstance(words, list) else [words]):
+                trie.add(str(word), key)
+        self.trie = trie
+
+    def match(self, content):
+        """
+        :return: (AdminCommand, 关键词, 参数列表), 不是管理指令时返回 None
+        """
+        matched = self.trie.match(content)
+        if matched is None:
+            return None
+        word, key = matched
+        command = self.commands[key]
+        rest = content[len(word):].strip()
+        args = rest.split(maxsplit=len(command.args) - 1) if command.args and rest else []
+        return command, word, args
+
+    def run(self, command, func, *args):
+        """
+        执行指令并统计耗时
+        """
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = func(*args)
+            ok = True
+            return result
+        finally:
+            self.record(command.key, time.perf_counter() - start, ok)
+
+    def record(self, key, elapsed, ok):
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = {'count': 0, 'failed': 0, 'timeTotal': 0.0, 'timeMax': 0.0}
+            stats['count'] += 1
+            if not ok:
+                stats['failed'] += 1
+            stats['timeTotal'] += elapsed
+            if elapsed > stats['timeMax']:
+                stats['timeMax'] = elapsed
+
+    def metrics(self):
+        with self.lock:
+            return {key: dict(stats, timeAvg=stats['timeTotal'] / stats['count']) for key, stats in self.stats.items()}
@@ -1,5 +1,7 @@
 import os
+import time
 import yaml
+import threading
 import base64
 import logging
 import requests
@@ -32,14 +34,148 @@ def setup_logger():
 logger = setup_logger()
 
 # 设置全局配置
+class FrozenDict(dict):
+    """
+    只读的配置字典, 仍是 dict 的子类, 原有的 isinstance 判断和 json 序列化不受影响
+    """
+    def readonly(self, *args, **kwargs):
+        raise TypeError('配置快照只读, 请通过 saveConfigData 修改')
+
+    __setitem__ = __delitem__ = update = pop = popitem = setdefault = clear = readonly
+
+    def __reduce__(self):
+        # 跨进程传递和 copy 时按普通字典重建, 不经过 __setitem__
+        return (FrozenDict, (dict(self),))
+
+    __reduce_ex__ = lambda self, protocol: self.__reduce__()
+
+class FrozenList(list):
+    """
+    只读的配置列表
+    """
+    def readonly(self, *args, **kwargs):
+        raise TypeError('配置快照只读, 请通过 saveConfigData 修改')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = remove = pop = clear = sort = reverse = readonly
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+    __reduce_ex__ = lambda self, protocol: self.__reduce__()
+
+def freezeConfig(data):
+    if isinstance(data, dict):
+        return FrozenDict((key, freezeConfig(value)) for key, value in data.items())
+    if isinstance(data, list):
+        return FrozenList(freezeConfig(value) for value in data)
+    return data
+
+def thawConfig(data):
+    """
+    还原为普通的 dict/list, 用于修改后保存
+    """
+    if isinstance(data, dict):
+        return {key: thawConfig(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [thawConfig(value) for value in data]
+    return data
+
+class ConfigStore:
+    def __init__(self, path, checkInterval=1.0):
+        """
+        进程内共享的配置: 只解析一次, 文件修改时间变化后才重新加载
+        :param path: 配置文件路径
+        :param checkInterval: 检查文件修改时间的最短间隔秒数, 避免每次读取都访问文件系统
+        """
+        self.path = path
+        self.checkInterval = checkInterval
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.mtime = None
+        self.lastCheck = 0
+        self.listeners = []
+        self.loads = 0
+
+    def get(self):
+        """
+        :return: 当前配置的只读快照
+        """
+        if self.snapshot is not None and time.monotonic() - self.lastCheck < self.checkInterval:
+            return self.snapshot
+        changed = None
+        with self.lock:
+            if self.snapshot is None or time.monotonic() - self.lastCheck >= self.checkInterval:
+                self.lastCheck = time.monotonic()
+                try:
+                    mtime = os.stat(self.path).st_mtime_ns
+                except OSError as e:
+                    # 编辑器原子保存时文件会短暂不存在, 已加载过则继续使用旧配置
+                    if self.snapshot is None:
+                        raise
+                    logger.warning(f'[-]: 读取配置文件状态失败, 继续使用旧配置: {e}')
+                    mtime = self.mtime
+                if mtime != self.mtime:
+                    changed = self.reload(mtime)
+            snapshot = self.snapshot
+        if changed:
+            self.notify(snapshot)
+        return snapshot
+
+    def reload(self, mtime):
+        """
+        :return: 是否为热加载(不是第一次加载)
+        """
+        try:
+            with open(self.path, mode='r', encoding='UTF-8') as f:
+                configData = freezeConfig(yaml.load(f, yaml.Loader))
+        except Exception as e:
+            # 第一次加载失败直接抛出; 热加载失败(如文件正在编辑)时继续使用旧配置
+            if self.snapshot is None:
+                raise
+            logger.error(f'[-]: 配置文件加载失败, 继续使用旧配置: {e}')
+            return False
+        hotReload = self.snapshot is not None
+        self.snapshot = configData
+        self.mtime = mtime
+        self.loads += 1
+        if hotReload:
+            logger.info('配置文件已更新, 重新加载成功')
+        return hotReload
+
+    def subscribe(self, callback):
+        """
+        注册配置变更回调, 热加载后以新的配置快照调用
+        """
+        self.listeners.append(callback)
+
+    def notify(self, snapshot):
+        for callback in self.listeners:
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logger.error(f'[-]: 配置变更回调出错: {e}')
+
+    def save(self, configData):
+        with self.lock:
+            with open(self.path, mode='w') as file:
+                yaml.dump(thawConfig(configData), file)
+            # 下次读取时立即检查文件
+            self.lastCheck = 0
+
+configStore = ConfigStore(os.path.join(os.path.dirname(__file__), '../config.yaml'))
+
 def returnConfigData():
     """
-    返回配置文件数据（YAML格式）
+    返回配置文件数据（YAML格式）, 为只读快照, 文件修改后自动重新加载
     :return:
     """
-    current_path = os.path.dirname(__file__)
-    configData = yaml.load(open(current_path + '/../config.yaml', mode='r', encoding='UTF-8'), yaml.Loader)
-    return configData
+    return configStore.get()
+
+def subscribeConfig(callback):
+    """
+    注册配置变更回调
+    """
+    configStore.subscribe(callback)
 
 def saveConfigData(configData):
     """
@@ -47,9 +183,7 @@ def saveConfigData(configData):
     :param configData:
     :return:
     """
-    current_path = os.path.dirname(__file__)
-    with open(current_path + '/../config.yaml', mode='w') as file:
-        yaml.dump(configData, file)
+    configStore.save(configData)
 
 # 设置数据存储
 def returnCachePath():
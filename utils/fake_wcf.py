@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import sqlite3
+import threading
+from queue import Queue
+
+class FakeWcf:
+    def __init__(self, selfWxid='wxid_fakebot', selfName='机器人', dbPath=':memory:', latency=None, failRate=None, seed=None):
+        """
+        模拟 wcferry.Wcf, 不依赖微信客户端, 用于离线测试和压测
+        联系人和群成员存放在本地 SQLite 中, 发出的消息记录在 outbox 中
+        :param selfWxid: 机器人 wxid
+        :param selfName: 机器人昵称
+        :param dbPath: 联系人库路径, 默认存放在内存中
+        :param latency: 各方法的模拟耗时, 如 {'send_text': 0.05, 'query_sql': (0.001, 0.005)}, 元组表示随机区间
+        :param failRate: 各方法的模拟失败率, 如 {'send_text': 0.01}
+        :param seed: 随机种子, 便于复现
+        """
+        self.selfWxid = selfWxid
+        self.selfName = selfName
+        self.latency = dict(latency or {})
+        self.failRate = dict(failRate or {})
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbPath, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS Contact (UserName TEXT PRIMARY KEY, NickName TEXT, Remark TEXT DEFAULT '', Alias TEXT DEFAULT '');
+            CREATE TABLE IF NOT EXISTS ChatRoomMember (RoomId TEXT, UserName TEXT, DisplayName TEXT, PRIMARY KEY (RoomId, UserName));
+        ''')
+        self.addContact(selfWxid, selfName)
+        self.msgQueue = Queue()
+        self.receiving = False
+        self.outbox = []
+        self.calls = {}
+        self.failures = {}
+
+    # ---------- 模拟数据 ----------
+    def addContact(self, wxid, name, remark='', alias=''):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO Contact VALUES (?, ?, ?, ?)', (wxid, name, remark, alias))
+            self.conn.commit()
+
+    def addRoom(self, roomId, name, members=None):
+        """
+        :param members: {wxid: 群昵称}, 群成员同时加入联系人表
+        """
+        self.addContact(roomId, name)
+        for wxid, displayName in (members or {}).items():
+            self.addContact(wxid, displayName)
+            self.addRoomMember(roomId, wxid, displayName)
+
+    def addRoomMember(self, roomId, wxid, displayName=''):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO ChatRoomMember VALUES (?, ?, ?)', (roomId, wxid, displayName))
+            self.conn.commit()
+
+    def feed(self, msg):
+        """
+        投递一条收到的消息, 由 get_msg 取出
+        """
+        self.msgQueue.put(msg)
+
+    def sentTo(self, receiver):
+        with self.lock:
+            return [item for item in self.outbox if item['receiver'] == receiver]
+
+    def simulate(self, name):
+        """
+        记录调用次数, 按配置等待并判断本次调用是否失败
+        :return: 是否成功
+        """
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            delay = self.latency.get(name, 0)
+            if isinstance(delay, (tuple, list)):
+                delay = self.random.uniform(*delay)
+            failed = self.random.random() < self.failRate.get(name, 0)
+            if failed:
+                self.failures[name] = self.failures.get(name, 0) + 1
+        if delay:
+            time.sleep(delay)
+        return not failed
+
+    def addOutbox(self, msgType, receiver, content, aters=''):
+        with self.lock:
+            self.outbox.append({'type': msgType, 'receiver': receiver, 'content': content, 'aters': aters, 'ts': time.time()})
+
+    def metrics(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'failures': dict(self.failures), 'sent': len(self.outbox)}
+
+    # ---------- Wcf 接口 ----------
+    def is_login(self):
+        return True
+
+    def get_self_wxid(self):
+        return self.selfWxid
+
+    def get_user_info(self):
+        return {'wxid': self.selfWxid, 'name': self.selfName, 'mobile': '', 'home': ''}
+
+    def enable_receiving_msg(self, pyq=False):
+        self.receiving = True
+        return True
+
+    def disable_recv_msg(self):
+        self.receiving = False
+        return 0
+
+    def is_receiving_msg(self):
+        return self.receiving
+
+    def get_msg(self, block=True):
+        # 与 Wcf.get_msg 一致, 没有消息时抛出 Empty
+        return self.msgQueue.get(block, timeout=1)
+
+    def send_text(self, msg, receiver, aters=''):
+        if not self.simulate('send_text'):
+            return -1
+        self.addOutbox('text', receiver, msg, aters)
+        return 0
+
+    def send_image(self, path, receiver):
+        if not self.simulate('send_image'):
+            return -1
+        self.addOutbox('image', receiver, path)
+        return 0
+
+    def send_file(self, path, receiver):
+        if not self.simulate('send_file'):
+            return -1
+        self.addOutbox('file', receiver, path)
+        return 0
+
+    def forward_msg(self, id, receiver):
+        if not self.simulate('forward_msg'):
+            return 0
+        self.addOutbox('forward', receiver, id)
+        return 1
+
+    def query_sql(self, db, sql):
+        if not self.simulate('query_sql'):
+            return []
+        # 只模拟联系人所在的 MicroMsg.db
+        if db != 'MicroMsg.db':
+            return []
+        with self.lock:
+            try:
+                return [dict(row) for row in self.conn.execute(sql).fetchall()]
+            except sqlite3.Error:
+                return []
+
+    def get_contacts(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT UserName, NickName, Remark FROM Contact').fetchall()
+        return [{'wxid': row['UserName'], 'name': row['NickName'], 'remark': row['Remark']} for row in rows]
+
+    def get_chatroom_members(self, roomid):
+        if not self.simulate('get_chatroom_members'):
+            return {}
+        with self.lock:
+            rows = self.conn.execute('SELECT UserName, DisplayName FROM ChatRoomMember WHERE RoomId = ?', (roomid,)).fetchall()
+        return {row['UserName']: row['DisplayName'] for row in rows}
+
+    def get_alias_in_chatroom(self, wxid, roomid):
+        if not self.simulate('get_alias_in_chatroom'):
+            return ''
+        with self.lock:
+            row = self.conn.execute('SELECT DisplayName FROM ChatRoomMember WHERE RoomId = ? AND UserName = ?', (roomid, wxid)).fetchone()
+            if row is None or not row['DisplayName']:
+                row = self.conn.execute('SELECT NickName AS DisplayName FROM Contact WHERE UserName = ?', (wxid,)).fetchone()
+        return row['DisplayName'] if row else ''
+
+    def invite_chatroom_members(self, roomid, wxids):
+        if not self.simulate('invite_chatroom_members'):
+            return 0
+        with self.lock:
+            for wxid in wxids.split(','):
+                row = self.conn.execute('SELECT NickName FROM Contact WHERE UserName = ?', (wxid,)).fetchone()
+                self.conn.execute('INSERT OR REPLACE INTO ChatRoomMember VALUES (?, ?, ?)', (roomid, wxid, row['NickName'] if row else wxid))
+            self.conn.commit()
+        return 1
+
+    add_chatroom_members = invite_chatroom_members
+
+    def del_chatroom_members(self, roomid, wxids):
+        if not self.simulate('del_chatroom_members'):
+            return 0
+        with self.lock:
+            for wxid in wxids.split(','):
+                self.conn.execute('DELETE FROM ChatRoomMember WHERE RoomId = ? AND UserName = ?', (roomid, wxid))
+            self.conn.commit()
+        return 1
+
+    def download_image(self, id, extra, dir, timeout=30):
+        if not self.simulate('download_image'):
+            return ''
+        # 生成一个占位图片文件
+        os.makedirs(dir, exist_ok=True)
+        path = os.path.join(dir, f'{id}.jpg')
+        with open(path, 'wb') as f:
+            f.write(b'\xff\xd8\xff\xd9')
+        return path
+
+    def accept_new_friend(self, v3, v4, scene=30):
+        if not self.simulate('accept_new_friend'):
+            return 0
+        return 1
+
+    def cleanup(self):
+        self.receiving = False
+        with self.lock:
+            self.conn.close()
@@ -4,7 +4,7 @@ import time
 import requests
 from bs4 import BeautifulSoup
 from datetime import datetime
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from utils.common import logger, returnConfigData, returnVideoCacheFolder, downloadFile, encode_image
 
 configData = returnConfigData()['llmServer']
@@ -135,6 +135,45 @@ class UniLLM:
                 return res.strip()
         return ''
 
+class AsyncLLM_API:
+    def __init__(self, api_key, base_url, model):
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+        )
+        self.model = model
+
+    async def __call__(self, messages, temperature=0.7):
+        try:
+            completion = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                stream=False
+            )
+            return completion.choices[-1].message.content
+        except Exception as e:
+            logger.error(f'LLM error: {e}')
+            return ''
+
+class AsyncUniLLM:
+    """
+    UniLLM 的异步版本, 等待模型返回时不占用线程
+    """
+    def __init__(self):
+        model_names = list(model_dict.keys())
+        self.models = {name: AsyncLLM_API(api_key=model_dict[name]['api_key'], base_url=model_dict[name]['base_url'], model=model_dict[name]['model_name']) for name in model_names}
+
+    async def __call__(self, model_name_list, messages, temperature=0.7):
+        for model_name in model_name_list:
+            model = self.models.get(model_name)
+            if model is None:
+                continue
+            res = await model(messages, temperature=temperature)
+            if res:
+                return res.strip()
+        return ''
+
 def generate_image(prompt='a cat', model='flux', img_size=None, batch_size=1):
     model_name = image_model_dict[model]['model_name']
     if not img_size:
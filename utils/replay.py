@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import threading
+import contextlib
+from unittest.mock import patch
+from utils.common import logger
+from utils.wxmsg import packMsg, unpackMsg
+from utils.fake_wcf import FakeWcf
+
+class MsgRecorder:
+    def __init__(self, path, flushEvery=1):
+        """
+        把收到的原始消息追加写入文件, 每行一条 JSON 数组: [接收时间, *packMsg(msg)]
+        :param path: 录制文件路径
+        :param flushEvery: 每写入多少条刷新一次磁盘
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.flushEvery = flushEvery
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def record(self, msg):
+        line = json.dumps([round(time.time(), 3), *packMsg(msg)], ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.count += 1
+            if self.count % self.flushEvery == 0:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def readRecording(path):
+    """
+    读取录制文件
+    :return: 生成 (接收时间, LiteMsg)
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            yield data[0], unpackMsg(data[1:])
+
+def percentile(values, p):
+    """
+    :param values: 已排序的数值列表
+    :param p: 0-100
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+class MsgReplayer:
+    def __init__(self, server, speed=1.0):
+        """
+        把录制的消息按原始时间间隔重新送入 MainServer, 统计吞吐和处理延迟
+        延迟只在默认的线程模式下准确, async 模式下只统计到协程提交
+        :param server: MainServer 实例
+        :param speed: 回放倍速, 0 表示不等待, 尽快送入
+        """
+        self.server = server
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.feedTimes = {}
+        # 包装处理入口, 记录每条消息从送入到处理完成的耗时
+        handleMsg = server.handleMsg
+
+        def timedHandleMsg(handler, msg, priority):
+            try:
+                handleMsg(handler, msg, priority)
+            finally:
+                with self.lock:
+                    feedTime = self.feedTimes.pop(msg.id, None)
+                    if feedTime is not None:
+                        self.latencies.append(time.time() - feedTime)
+
+        server.handleMsg = timedHandleMsg
+
+    def replay(self, path):
+        """
+        :return: 回放报告
+        """
+        records = list(readRecording(path))
+        count = 0
+        startTime = time.time()
+        firstRecv = records[0][0] if records else 0
+        for recvTime, msg in records:
+            if self.speed:
+                delay = (recvTime - firstRecv) / self.speed - (time.time() - startTime)
+                if delay > 0:
+                    time.sleep(delay)
+            # 消息时间平移到当前, 避免被当作过期消息降级
+            if msg.ts:
+                msg.ts = int(msg.ts - recvTime + time.time())
+            with self.lock:
+                self.feedTimes[msg.id] = time.time()
+            self.server.dispatchMsg(msg)
+            count += 1
+        self.server.executor.join()
+        duration = time.time() - startTime
+        # 回复进入发送队列后异步发送, 等发送完再统计发出条数
+        sendServer = getattr(self.server, 'sendServer', None)
+        if sendServer is not None:
+            sendServer.join()
+        with self.lock:
+            latencies = sorted(self.latencies)
+        return {
+            'messages': count,
+            'handled': len(latencies),
+            'duration': round(duration, 3),
+            'throughput': round(len(latencies) / duration, 2) if duration else 0.0,
+            'p50': round(percentile(latencies, 50), 4),
+            'p95': round(percentile(latencies, 95), 4),
+            'p99': round(percentile(latencies, 99), 4),
+            'max': round(latencies[-1], 4) if latencies else 0.0,
+            'sent': len(getattr(self.server.wcf, 'outbox', [])),
+            'dispatch': self.server.metrics(),
+        }
+
+@contextlib.contextmanager
+def isolatedServices(folder, llmLatency=0.05, httpLatency=0.02):
+    """
+    回放期间数据库改用 folder 下的临时文件, LLM 和 HTTP 调用改为固定延迟的模拟实现, 不影响线上数据和外部服务
+    :param folder: 临时目录
+    :param llmLatency: 模拟的 LLM 调用耗时
+    :param httpLatency: 模拟的 HTTP 请求耗时
+    """
+    import requests
+    from servers import db_server
+
+    def fakeUnillm(model_name_list, messages, **kwargs):
+        time.sleep(llmLatency)
+        # 图片广告判断回复 "否", 其余返回普通回复
+        return '否' if isinstance(messages[-1]['content'], list) else '好的, 这是回放回复'
+
+    def fakeRequest(session, method, url, **kwargs):
+        time.sleep(httpLatency)
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = b'<html><body></body></html>'
+        return response
+
+    picFolder = os.path.join(folder, 'pic')
+    os.makedirs(picFolder, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(patch.object(db_server, 'userDb', os.path.join(folder, 'user.db')))
+        stack.enter_context(patch.object(db_server, 'roomDb', os.path.join(folder, 'room.db')))
+        stack.enter_context(patch.object(db_server, 'messageDb', os.path.join(folder, 'message.db')))
+        stack.enter_context(patch('servers.api_server.unillm', new=fakeUnillm))
+        stack.enter_context(patch('requests.Session.request', new=fakeRequest))
+        stack.enter_context(patch('servers.msg_server.returnPicCacheFolder', return_value=picFolder))
+        try:
+            yield
+        finally:
+            # 临时数据库删除前写完聊天记录并关闭连接, 避免退出时写到正式数据库
+            db_server.chatMsgWriter.shutdown()
+            db_server.closeAllDb()
+
+def main():
+    parser = argparse.ArgumentParser(description='回放录制的消息, 统计吞吐和处理延迟')
+    parser.add_argument('path', help='录制文件路径')
+    parser.add_argument('--speed', type=float, default=1.0, help='回放倍速, 0 表示尽快送入')
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='模拟的 LLM 调用秒数')
+    parser.add_argument('--http-latency', type=float, default=0.02, help='模拟的 HTTP 请求秒数')
+    parser.add_argument('--output', default='', help='报告输出文件, 不填则打印')
+    args = parser.parse_args()
+
+    from main import MainServer
+    with tempfile.TemporaryDirectory() as folder, isolatedServices(folder, args.llm_latency, args.http_latency):
+        server = MainServer(wcf=FakeWcf(), enableSchedule=False)
+        # 回放时不再录制
+        if server.recorder is not None:
+            server.recorder.close()
+            server.recorder = None
+        for migrator in server.dbMigrators.values():
+            migrator.join()
+        report = MsgReplayer(server, speed=args.speed).replay(args.path)
+        server.executor.shutdown()
+        server.sendServer.shutdown()
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    logger.info(f'回放完成: {report["messages"]}条消息, {report["throughput"]}条/秒')
+
+if __name__ == '__main__':
+    # 在项目根目录执行: python -m utils.replay logs/record.jsonl --speed 10
+    main()
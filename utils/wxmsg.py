@@ -0,0 +1,277 @@
+import re
+import html
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+# packMsg 输出的字段顺序
+MSG_FIELDS = ('id', 'type', 'ts', 'sender', 'roomid', 'content', 'xml', 'extra', 'thumb', 'sign', 'is_self', 'is_group')
+
+class LiteMsg:
+    """
+    与 wcferry.WxMsg 接口一致的轻量消息对象, 可以在进程之间传递, 也可从录制文件中还原
+    """
+    __slots__ = MSG_FIELDS
+
+    def __init__(self, id=0, type=0, ts=0, sender='', roomid='', content='', xml='', extra='', thumb='', sign='', is_self=False, is_group=False):
+        self.id = id
+        self.type = type
+        self.ts = ts
+        self.sender = sender
+        self.roomid = roomid
+        self.content = content
+        self.xml = xml
+        self.extra = extra
+        self.thumb = thumb
+        self.sign = sign
+        self.is_self = is_self
+        self.is_group = is_group
+
+    def __str__(self):
+        return f'{self.type} {self.sender} {self.roomid} {self.content}'
+
+    def from_self(self):
+        return self.is_self
+
+    def from_group(self):
+        return self.is_group
+
+    def is_text(self):
+        return self.type == 1
+
+    def is_at(self, wxid):
+        # 与 WxMsg.is_at 保持一致
+        if not self.from_group():
+            return False
+        if not re.findall(f"<atuserlist>[\\s|\\S]*({wxid})[\\s|\\S]*</atuserlist>", self.xml):
+            return False
+        if re.findall(r"@(?:所有人|all|All)", self.content):
+            return False
+        return True
+
+def packMsg(msg):
+    """
+    把 WxMsg 压缩为元组, 用于跨进程传递和录制
+    :param msg: WxMsg 或 LiteMsg
+    :return: 按 MSG_FIELDS 顺序排列的元组
+    """
+    return (msg.id, msg.type, msg.ts, msg.sender, msg.roomid, msg.content, msg.xml,
+            msg.extra, msg.thumb, msg.sign, bool(msg.from_self()), bool(msg.from_group()))
+
+def unpackMsg(data):
+    """
+    从 packMsg 的结果还原消息对象
+    :return: LiteMsg
+    """
+    return LiteMsg(*data)
+
+# 快速路径: 常用字段直接用正则提取, 不构建 XML 树
+AT_USER_PATTERN = re.compile(r'<atuserlist>(?:<!\[CDATA\[)?(.*?)(?:\]\]>)?</atuserlist>', re.S)
+AT_ALL_PATTERN = re.compile(r'@(?:所有人|all|All)')
+APP_TYPE_PATTERN = re.compile(r'<appmsg\b[^>]*>.*?<type>\s*(\d+)\s*</type>', re.S)
+TAG_PATTERNS = {}
+
+def fastTag(text, tag):
+    """
+    取第一个 <tag> 的文本, 处理 CDATA 和转义字符
+    :return: 文本, 没有该标签时返回 None
+    """
+    pattern = TAG_PATTERNS.get(tag)
+    if pattern is None:
+        pattern = TAG_PATTERNS[tag] = re.compile(f'<{tag}>(?:<!\\[CDATA\\[(.*?)\\]\\]>|([^<]*))</{tag}>', re.S)
+    matched = pattern.search(text)
+    if matched is None:
+        return None
+    cdata, plain = matched.groups()
+    return cdata if cdata is not None else html.unescape(plain)
+
+def elementText(root, path):
+    if root is None:
+        return ''
+    element = root.find(path)
+    return (element.text or '') if element is not None else ''
+
+def cachedField(func):
+    """
+    消息信封的延迟字段: 首次访问时计算并缓存, 多线程下重复计算的结果相同
+    """
+    name = func.__name__
+
+    def getter(self):
+        cache = self.cache
+        if name not in cache:
+            cache[name] = func(self)
+        return cache[name]
+    return property(getter, doc=func.__doc__)
+
+# 引用消息: type-被引用消息类型 content-被引用消息内容
+ReferMsg = namedtuple('ReferMsg', ['type', 'content'])
+# 视频号消息
+FinderFeed = namedtuple('FinderFeed', ['objectId', 'objectNonceId'])
+
+class MsgEnvelope:
+    """
+    不可变的消息信封: 包装 WxMsg/LiteMsg, xml 和 content 只在首次访问字段时解析一次
+    需要修改字段时用 replace 生成新的信封, 未改动 xml/content 时共享已解析的结果
+    """
+    __slots__ = MSG_FIELDS + ('cache',)
+
+    def __init__(self, id=0, type=0, ts=0, sender='', roomid='', content='', xml='', extra='', thumb='', sign='', is_self=False, is_group=False, cache=None):
+        setField = object.__setattr__
+        setField(self, 'id', id)
+        setField(self, 'type', type)
+        setField(self, 'ts', ts)
+        setField(self, 'sender', sender)
+        setField(self, 'roomid', roomid)
+        setField(self, 'content', content or '')
+        setField(self, 'xml', xml or '')
+        setField(self, 'extra', extra)
+        setField(self, 'thumb', thumb)
+        setField(self, 'sign', sign)
+        setField(self, 'is_self', is_self)
+        setField(self, 'is_group', is_group)
+        setField(self, 'cache', {} if cache is None else cache)
+
+    @classmethod
+    def wrap(cls, msg):
+        """
+        :param msg: WxMsg / LiteMsg / MsgEnvelope
+        :return: MsgEnvelope, 已经是信封时原样返回
+        """
+        if isinstance(msg, cls):
+            return msg
+        return cls(*packMsg(msg))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'MsgEnvelope 不可修改, 请使用 replace 生成新消息: {name}')
+
+    def replace(self, **changes):
+        """
+        :return: 修改部分字段后的新信封
+        """
+        fields = {name: getattr(self, name) for name in MSG_FIELDS}
+        fields.update(changes)
+        cache = None
+        if 'xml' not in changes and 'content' not in changes:
+            cache = self.cache
+        return MsgEnvelope(cache=cache, **fields)
+
+    def __str__(self):
+        return f'{self.type} {self.sender} {self.roomid} {self.content}'
+
+    def from_self(self):
+        return self.is_self
+
+    def from_group(self):
+        return self.is_group
+
+    def is_text(self):
+        return self.type == 1
+
+    def fastField(self, tag, path, text=None):
+        """
+        先用正则取第一个 <tag>, 取不到时再解析 XML 树按 path 查找
+        """
+        value = fastTag(self.content if text is None else text, tag)
+        return value if value is not None else elementText(self.contentRoot, path)
+
+    def is_at(self, wxid):
+        if not self.is_group or wxid not in self.atUserList:
+            return False
+        return not AT_ALL_PATTERN.search(self.content)
+
+    @cachedField
+    def atUserList(self):
+        """
+        被@的 wxid 列表
+        """
+        matched = AT_USER_PATTERN.search(self.xml)
+        if matched is None:
+            return ()
+        return tuple(wxid for wxid in matched.group(1).replace(' ', '').split(',') if wxid)
+
+    @cachedField
+    def contentRoot(self):
+        """
+        content 解析后的 XML 树, 不是 XML 时为 None
+        """
+        try:
+            return ET.fromstring(self.content)
+        except (ET.ParseError, TypeError):
+            return None
+
+    @cachedField
+    def appType(self):
+        """
+        type 49 消息的 appmsg 类型, 如 57-引用 5-公众号文章 51-视频号
+        """
+        matched = APP_TYPE_PATTERN.search(self.content)
+        if matched is not None:
+            return matched.group(1)
+        return elementText(self.contentRoot, 'appmsg/type')
+
+    @cachedField
+    def appTitle(self):
+        """
+        appmsg 标题, 公众号推送和引用消息的正文
+        """
+        return self.fastField('title', 'appmsg/title')
+
+    @cachedField
+    def appUrl(self):
+        return self.fastField('url', 'appmsg/url')
+
+    @cachedField
+    def appDes(self):
+        return self.fastField('des', 'appmsg/des')
+
+    @cachedField
+    def sourceName(self):
+        """
+        分享文章的公众号名称
+        """
+        return self.fastField('sourcedisplayname', 'appmsg/sourcedisplayname')
+
+    @cachedField
+    def shareUrlOpen(self):
+        return self.fastField('shareUrlOpen', 'appmsg/webviewshared/shareUrlOpen')
+
+    @cachedField
+    def fromUser(self):
+        """
+        appmsg 外层的 fromusername
+        """
+        # 只有一个 fromusername 时才能确定是外层的
+        if self.content.count('<fromusername>') == 1:
+            return self.fastField('fromusername', 'fromusername')
+        return elementText(self.contentRoot, 'fromusername')
+
+    @cachedField
+    def refer(self):
+        """
+        引用消息中被引用的消息, 不是引用消息时为 None
+        """
+        start = self.content.find('<refermsg>')
+        if start < 0:
+            return None
+        # 被引用的内容已转义, 不会出现嵌套标签
+        part = self.content[start:]
+        return ReferMsg(self.fastField('type', 'appmsg/refermsg/type', part), self.fastField('content', 'appmsg/refermsg/content', part))
+
+    @cachedField
+    def finderFeed(self):
+        """
+        视频号消息的 objectId/objectNonceId, 不是视频号消息时为 None
+        """
+        start = self.content.find('<finderFeed>')
+        if start < 0:
+            return None
+        part = self.content[start:]
+        return FinderFeed(self.fastField('objectId', './/finderFeed/objectId', part), self.fastField('objectNonceId', './/finderFeed/objectNonceId', part))
+
+    @cachedField
+    def contentAttrib(self):
+        """
+        content 根节点属性, 好友请求的 encryptusername/ticket/scene 在其中
+        """
+        root = self.contentRoot
+        return dict(root.attrib) if root is not None else {}